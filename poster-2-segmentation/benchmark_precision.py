@@ -0,0 +1,100 @@
+import time
+import argparse
+import numpy as np
+import torch
+
+from models.models import EncDec, UNet
+from models.losses import bce_loss
+from models.shape_planner import model_shape_plan
+from utils.logger import logger
+from utils.precision import PRECISIONS, autocast, to_memory_format
+
+
+def train_step(model, optimizer, images, masks, device, precision):
+    """
+    One training step like in `train_model`: the forward pass under autocast, the loss and backward in fp32.
+    """
+    optimizer.zero_grad()
+    with autocast(device, precision):
+        outputs = model(images)
+    loss = bce_loss(outputs.float(), masks)
+    loss.backward()
+    optimizer.step()
+    return loss.item()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def benchmark(args, device, precision, channels_last):
+    torch.manual_seed(args.seed)
+    if args.model == 'unet':
+        model = UNet(in_channels=3, num_classes=1, padding=args.padding)
+    else:
+        model = EncDec(input_channels=3, output_channels=1, padding=args.padding)
+    model = to_memory_format(model.to(device), channels_last).train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    # The same random batch for every configuration
+    generator = torch.Generator().manual_seed(args.seed)
+    images = torch.randn((args.batch_size, 3, args.crop_size, args.crop_size), generator=generator)
+    masks = (torch.rand((args.batch_size, 1, args.crop_size, args.crop_size), generator=generator) > 0.5).float()
+    images = to_memory_format(images.to(device), channels_last)
+    masks = masks.to(device)
+
+    # Warm up (oneDNN / cuDNN kernel selection, lazy allocations)
+    for _ in range(args.warmup):
+        train_step(model, optimizer, images, masks, device, precision)
+
+    times, losses = [], []
+    for _ in range(args.steps):
+        synchronize(device)
+        start = time.perf_counter()
+        losses.append(train_step(model, optimizer, images, masks, device, precision))
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+
+    return np.median(times), losses[0]
+
+
+def main(args):
+    device = torch.device(args.device if args.device else ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    if args.padding == 0:
+        model = UNet(in_channels=3, num_classes=1, padding=0) if args.model == 'unet' else EncDec(padding=0)
+        plan = model_shape_plan(model, args.crop_size)
+        logger.info(f"Unpadded {args.model}: {args.crop_size} x {args.crop_size} crops give {plan.output_size} x {plan.output_size} outputs")
+
+    logger.info(f"Training steps of {args.model} (padding {args.padding}) on {args.batch_size} x 3 x {args.crop_size} x {args.crop_size} "
+                f"batches ({device}, {args.steps} steps after {args.warmup} warm-up steps)")
+
+    results = {}
+    for precision in args.precisions:
+        for channels_last in [False, True]:
+            step_time, loss = benchmark(args, device, precision, channels_last)
+            results[(precision, channels_last)] = step_time
+            print(f"{precision:>5} {'channels_last' if channels_last else 'NCHW':>13}: {1000 * step_time:.1f} ms/step "
+                  f"({args.batch_size / step_time:.1f} images/s), first loss {loss:.4f}")
+
+    baseline = results[('fp32', False)] if ('fp32', False) in results else None
+    if baseline is not None:
+        for (precision, channels_last), step_time in results.items():
+            logger.info(f"{precision} {'channels_last' if channels_last else 'NCHW'}: {baseline / step_time:.2f}x the speed of fp32 NCHW")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the training step time of fp32 and bf16 autocast, NCHW and channels-last.")
+    parser.add_argument('--model', type=str, default='unet', choices=['unet', 'encdec'])
+    parser.add_argument('--padding', type=int, default=1, help='Padding of the convolutions (0 for the unpadded models)')
+    parser.add_argument('--crop_size', type=int, default=256, help='Height and width of the random input batch')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=10, help='Number of timed training steps per configuration')
+    parser.add_argument('--warmup', type=int, default=2, help='Number of training steps before timing')
+    parser.add_argument('--precisions', type=str, nargs='+', default=PRECISIONS, choices=PRECISIONS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', type=str, default=None, help='cuda or cpu (defaults to cuda when available)')
+    args = parser.parse_args()
+
+    main(args)
@@ -4,19 +4,22 @@ import numpy as np
 import wandb
 import random
 
+from functools import partial
 from torchvision import transforms
 from torch.utils.data import DataLoader
 
 from utils.load_data import load_data
 from utils.logger import logger
 from utils.transforms import JointTransform, JointTransform_weak
+from utils.batch_transforms import ToUint8Tensors, BatchJointTransform, AugmentedLoader, MultiCropDataset, AugmentedSamples, pad_collate, concat_collate
 from utils.visualize import display_random_images_and_masks, visualize_predictions, display_random_images_and_weak_supervision_masks, visualize_weak_supervision_predictions
-from utils.helper import compute_pos_weight
+from utils.dataset_stats import dataset_stats
 from models.train import train_model, train_model_weak
 from models.models import EncDec, UNet
 from models.losses import bce_loss, masked_bce_loss, weighted_bce_loss, focal_loss
 from models.metrics import dice_overlap, IoU, accuracy, sensitivity, specificity
 from models.evaluation import evaluate_model
+from models.shape_planner import model_shape_plan, model_config, recommend_input_size
 
 def main():
     # Argument parser
@@ -40,6 +43,25 @@ def main():
     parser.add_argument('--jobid', type=str, default=f"job-{random.randint(1,10**8)}")
     parser.add_argument('--num_clicks', type=int, default=15)
     parser.add_argument('--sampling_strategy', type=str, default="random")
+    parser.add_argument('--batch_augment', action='store_true',
+                        help='Crop and augment the training batches on the device instead of per sample in the workers')
+    parser.add_argument('--hflip', type=float, default=0.0, help='Probability of a horizontal flip (with --batch_augment)')
+    parser.add_argument('--vflip', type=float, default=0.0, help='Probability of a vertical flip (with --batch_augment)')
+    parser.add_argument('--rotation', type=float, default=0.0, help='Maximum random rotation in degrees (with --batch_augment)')
+    parser.add_argument('--crops_per_image', type=int, default=1,
+                        help='Random crops per decoded training image, a batch still holds about --batch_size crops')
+    parser.add_argument('--foreground_bias', type=float, default=0.0,
+                        help='Probability that a training crop is centered on a foreground pixel (with --batch_augment or --crops_per_image > 1)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='fp32, or bf16 autocast for the forward passes of training and evaluation')
+    parser.add_argument('--channels_last', action='store_true', help='Use the channels-last memory format for the model and inputs')
+    parser.add_argument('--stats_cache', type=str, default='dataset_stats', help='Directory for the cached dataset statistics')
+    parser.add_argument('--image_cache', type=str, default=None, help='Directory for the decoded image cache (decode the files every time if not set)')
+    parser.add_argument('--weak_label_cache', type=str, default=None, help='Directory to save the generated weak supervision masks in (memory only if not set)')
+    parser.add_argument('--tile_batch_size', type=int, default=8, help='Number of patches per forward pass when evaluating whole images')
+    parser.add_argument('--blend', type=str, default='none', choices=['none', 'linear', 'gaussian'],
+                        help='How overlapping patches are combined when evaluating whole images')
+    parser.add_argument('--tile_overlap', type=int, default=0, help='Overlap in pixels between patches for linear/gaussian blending')
     
     args = parser.parse_args()
 
@@ -58,18 +80,30 @@ def main():
     RESIZE = (args.resize, args.resize) if args.resize else None
     CROP_SIZE = (args.crop_size, args.crop_size) if args.crop_size else None
 
-    if args.data == "ph2":
-        mean =  torch.tensor([0.7475, 0.5721, 0.4836])
-        std = torch.tensor([0.2004, 0.1972, 0.2023])
-    elif args.data == "drive":
-        mean =  torch.tensor([0.4820, 0.2620, 0.1546])
-        std = torch.tensor([0.3359, 0.1838, 0.1030])
+    # Normalization and class balance from the full training images and masks (cached in --stats_cache)
+    stats = dataset_stats(load_data(args.data, split='train'), name=args.data, split='train', cache_dir=args.stats_cache)
+    mean = torch.tensor(stats['mean'], dtype=torch.float32)
+    std = torch.tensor(stats['std'], dtype=torch.float32)
 
     if args.weak:
         transform_train = JointTransform_weak(crop_size=CROP_SIZE, resize=RESIZE, mean=mean, std=std)
     else:
         transform_train = JointTransform(crop_size=CROP_SIZE, resize=RESIZE, mean = mean, std=std)
 
+    # With batch augmentation the training workers only convert to uint8 tensors, the crops, flips, rotations and
+    # the normalization run on whole batches on the device (resize first, then crop, like JointTransform)
+    # With several crops per image, the workers decode an image once and cut all of its crops
+    transform_train_dataset = transform_train
+    if args.batch_augment or args.crops_per_image > 1:
+        # Without crops the padding of pad_collate would be trained on with the images, and several crops per image
+        # would only be identical copies of images of different sizes
+        assert CROP_SIZE is not None, "--batch_augment and --crops_per_image > 1 need a --crop_size"
+        mask_fill = float('nan') if args.weak else 0.0
+        transform_train_dataset = ToUint8Tensors()
+        batch_transform = BatchJointTransform(crop_size=CROP_SIZE, resize=RESIZE, hflip=args.hflip, vflip=args.vflip,
+                                              rotation=args.rotation, mean=mean, std=std,
+                                              crops_per_image=args.crops_per_image, foreground_bias=args.foreground_bias,
+                                              mask_fill=mask_fill)
 
     transform_val_test = transforms.Compose([
         transforms.ToTensor(),
@@ -80,13 +114,16 @@ def main():
     # Load data
     logger.working_on(f"Loading data for {args.data.upper()}")
     if args.weak:
-        train_dataset = load_data('ph2_weak_supervision', split='train',transform=transform_train,num_clicks=args.num_clicks, radius=10, crop=True,seed=SEED,
-            return_ground_truth=False, sampling=args.sampling_strategy)
+        train_dataset = load_data('ph2_weak_supervision', split='train',transform=transform_train_dataset,num_clicks=args.num_clicks, radius=10, crop=True,seed=SEED,
+            return_ground_truth=False, sampling=args.sampling_strategy, cache_dir=args.weak_label_cache,
+            image_cache_dir=args.image_cache)
 
         val_dataset = load_data(
-            'ph2_weak_supervision',split='val',transform=transform_train,num_clicks=args.num_clicks,radius=10,crop=True,seed=SEED, return_ground_truth=True, sampling=args.sampling_strategy)
+            'ph2_weak_supervision',split='val',transform=transform_train,num_clicks=args.num_clicks,radius=10,crop=True,seed=SEED, return_ground_truth=True, sampling=args.sampling_strategy,
+            cache_dir=args.weak_label_cache, image_cache_dir=args.image_cache)
 
-        test_dataset = load_data('ph2_weak_supervision',split='test',transform=transform_val_test,return_ground_truth=True)
+        test_dataset = load_data('ph2_weak_supervision',split='test',transform=transform_val_test,return_ground_truth=True,
+            cache_dir=args.weak_label_cache, image_cache_dir=args.image_cache)
 
         image, mask = train_dataset[1]
         print('Image shape:', image.shape)
@@ -94,9 +131,9 @@ def main():
         assert len(np.unique(mask.numpy()[0])) <= 3, "mask needs to have binary values (0,1 and nan)"
 
     else:
-        train_dataset = load_data(args.data, split='train', transform=transform_train, crop=True)
-        val_dataset = load_data(args.data, split='val', transform=transform_train, crop=True)
-        test_dataset = load_data(args.data, split='test', transform=transform_val_test)
+        train_dataset = load_data(args.data, split='train', transform=transform_train_dataset, crop=True, image_cache_dir=args.image_cache)
+        val_dataset = load_data(args.data, split='val', transform=transform_train, crop=True, image_cache_dir=args.image_cache)
+        test_dataset = load_data(args.data, split='test', transform=transform_val_test, image_cache_dir=args.image_cache)
         # Check mask values
         image, mask = train_dataset[1]
         print('Image shape:', image.shape)
@@ -104,19 +141,34 @@ def main():
         assert len(np.unique(mask.numpy()[0])) <= 2, "Mask needs to have binary values (0,1)"
 
     # Data loaders
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers = 4)
+    # Every image gives crops_per_image crops, so fewer images are loaded per batch
+    images_per_batch = max(1, args.batch_size // args.crops_per_image)
+    if args.batch_augment:
+        train_loader = DataLoader(train_dataset, batch_size=images_per_batch, shuffle=True, num_workers = 4,
+                                  collate_fn=partial(pad_collate, mask_fill=mask_fill), pin_memory=DEVICE.type == 'cuda')
+        train_loader = AugmentedLoader(train_loader, batch_transform, DEVICE)
+    elif args.crops_per_image > 1:
+        train_loader = DataLoader(MultiCropDataset(train_dataset, batch_transform), batch_size=images_per_batch,
+                                  shuffle=True, num_workers = 4, collate_fn=concat_collate)
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers = 4)
     val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers = 4)
     test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers = 4)
 
     logger.success("Data loaded")
 
-    # Display some images
+    # Display some images, with the batch augmentation the dataset only returns uint8 tensors, so show them augmented
+    display_dataset = train_dataset
+    if args.batch_augment or args.crops_per_image > 1:
+        display_dataset = AugmentedSamples(train_dataset, batch_transform)
     if args.weak:
-        display_random_images_and_weak_supervision_masks(train_dataset, figname=f"{args.jobid}-weak_supervision_random.png", num_images=3)
+        display_random_images_and_weak_supervision_masks(display_dataset, figname=f"{args.jobid}-weak_supervision_random.png", num_images=3,
+                                                         mean=stats['mean'], std=stats['std'])
         logger.success(f"Saved example images and masks for weak supervision to 'figures'")
 
     else:
-        display_random_images_and_masks(train_dataset, figname=f"{args.jobid}-{args.data}_random.png", num_images=3)
+        display_random_images_and_masks(display_dataset, figname=f"{args.jobid}-{args.data}_random.png", num_images=3,
+                                        mean=stats['mean'], std=stats['std'])
         logger.success(f"Saved example images and masks for {args.data.upper()} to 'figures'")
 
     # Model selection
@@ -136,6 +188,12 @@ def main():
         if args.weak:
             architecture = "UNet-weak"
 
+    # With a crop size where pooling drops rows or UpSample crops unevenly, the output is shifted against the mask
+    plan = model_shape_plan(model, args.crop_size)
+    logger.info(f"Output of the model for {args.crop_size}x{args.crop_size} crops: {plan.output_size}x{plan.output_size} (margin {plan.margin})")
+    if not plan.centered:
+        logger.warning(f"The output is not centered for --crop_size {args.crop_size}, "
+                       f"use --crop_size {recommend_input_size(*model_config(model), args.crop_size)} instead")
 
     model = model.to(DEVICE)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate)
@@ -145,7 +203,7 @@ def main():
     elif args.loss_fn == 'masked_bce':
         loss_fn = masked_bce_loss
     elif args.loss_fn == 'weighted_bce':
-        pos_weight = compute_pos_weight(train_dataset).to(DEVICE)
+        pos_weight = torch.tensor(stats['pos_weight'], dtype=torch.float32).to(DEVICE)
         logger.info(f"Computed pos_weight: {pos_weight.item()}")
         loss_fn = lambda y_pred, y_real: weighted_bce_loss(y_pred, y_real, pos_weight)
 
@@ -157,10 +215,12 @@ def main():
     logger.working_on(f"Training {architecture} on {args.data.upper()}")
 
     if args.weak:
-        train_model_weak(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=args.epochs, device=DEVICE)
+        train_model_weak(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=args.epochs, device=DEVICE,
+                         precision=args.precision, channels_last=args.channels_last)
 
     else:
-        train_model(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=args.epochs, device=DEVICE)
+        train_model(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=args.epochs, device=DEVICE,
+                    precision=args.precision, channels_last=args.channels_last)
 
     if args.visualize:
         if args.weak:
@@ -179,9 +239,9 @@ def main():
     logger.working_on(f"Evaluating {architecture}...")
 
     # Reload datasets without cropping for evaluation
-    train_dataset = load_data(args.data, split='train', transform=transform_val_test, crop=False)
-    val_dataset = load_data(args.data, split='val', transform=transform_val_test, crop=False)
-    test_dataset = load_data(args.data, split='test', transform=transform_val_test, crop=False)
+    train_dataset = load_data(args.data, split='train', transform=transform_val_test, crop=False, image_cache_dir=args.image_cache)
+    val_dataset = load_data(args.data, split='val', transform=transform_val_test, crop=False, image_cache_dir=args.image_cache)
+    test_dataset = load_data(args.data, split='test', transform=transform_val_test, crop=False, image_cache_dir=args.image_cache)
 
     # Data loaders for evaluation
     eval_train_loader = DataLoader(train_dataset, batch_size=1, shuffle=False, num_workers = 4)
@@ -197,13 +257,19 @@ def main():
         add_edge = False
 
     evaluate_model(model, eval_train_loader, DEVICE, metrics, dataset_name=args.data.upper(),
-                   patch_size=args.crop_size, name = "train", add_edge=add_edge)
+                   patch_size=args.crop_size, name = "train", add_edge=add_edge,
+                   tile_batch_size=args.tile_batch_size, blend=args.blend, overlap=args.tile_overlap,
+                   precision=args.precision, channels_last=args.channels_last)
 
     evaluate_model(model, eval_val_loader, DEVICE, metrics, dataset_name=args.data.upper(),
-                   patch_size=args.crop_size, name = "val", add_edge=add_edge)
+                   patch_size=args.crop_size, name = "val", add_edge=add_edge,
+                   tile_batch_size=args.tile_batch_size, blend=args.blend, overlap=args.tile_overlap,
+                   precision=args.precision, channels_last=args.channels_last)
 
     evaluate_model(model, eval_test_loader, DEVICE, metrics, dataset_name=args.data.upper(),
-                   patch_size=args.crop_size, name = "test", add_edge=add_edge)
+                   patch_size=args.crop_size, name = "test", add_edge=add_edge,
+                   tile_batch_size=args.tile_batch_size, blend=args.blend, overlap=args.tile_overlap,
+                   precision=args.precision, channels_last=args.channels_last)
     logger.success("Model evaluated and results logged to wandb")
 
     wandb.finish()
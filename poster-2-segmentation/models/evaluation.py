@@ -4,11 +4,16 @@ import wandb
 
 from utils.logger import logger
 from models.split_image import split_image_into_patches  
+from models.metrics import ConfusionMatrixMeter
+from utils.precision import to_memory_format
 
-def evaluate_model(model, data_loader, device, metrics, dataset_name, patch_size, name, add_edge = False):
+def evaluate_model(model, data_loader, device, metrics, dataset_name, patch_size, name, add_edge = False,
+                   tile_batch_size = 8, blend = 'none', overlap = 0, average = 'macro', precision = 'fp32',
+                   channels_last = False):
+    # metrics selects which of the ConfusionMatrixMeter metrics are reported, 'macro' averages them per image
     model.eval()
-    metric_totals = {metric.__name__: 0.0 for metric in metrics}
-    num_images = 0
+    model = to_memory_format(model, channels_last)
+    meter = ConfusionMatrixMeter()
 
     with torch.no_grad():
         for images, masks in data_loader:
@@ -19,20 +24,19 @@ def evaluate_model(model, data_loader, device, metrics, dataset_name, patch_size
             image = images.squeeze(0)
             mask = masks.squeeze(0)
 
-            # Process the image by splitting into patches
-            predicted_mask = split_image_into_patches(image, patch_size, model, add_edge=add_edge)
+            # Process the image by splitting into patches, tile_batch_size patches per forward pass
+            predicted_mask = split_image_into_patches(image, patch_size, model, add_edge=add_edge,
+                                                      batch_size=tile_batch_size, blend=blend, overlap=overlap,
+                                                      precision=precision, channels_last=channels_last)
 
             assert mask.shape == predicted_mask.shape, "Predicted mask needs to have same shape as the target mask"
 
-            # Compute metrics
-            for metric in metrics:
-                metric_value = metric(predicted_mask.unsqueeze(0), mask.unsqueeze(0))
-                metric_totals[metric.__name__] += metric_value
-
-            num_images += 1
+            # Count TP/FP/TN/FN on the device, the metrics are computed once at the end
+            meter.update(predicted_mask.unsqueeze(0), mask.unsqueeze(0))
 
     # Calculate average metrics
-    metric_averages = {metric: total / num_images for metric, total in metric_totals.items()}
+    results = meter.compute(average)
+    metric_averages = {metric.__name__: results[metric.__name__] for metric in metrics}
 
     wandb.log({f"{name}/{dataset_name}/{metric}": average for metric, average in metric_averages.items()})
 
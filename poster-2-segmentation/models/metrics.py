@@ -1,14 +1,11 @@
-def reshape_input(y_pred, y_real):
-
-        _, _, y_pred_height, y_pred_width = y_pred.shape
-        _, _, y_real_height, y_real_width = y_real.shape
+import torch
 
-        diff_height = (y_real_height - y_pred_height) // 2
-        diff_width = (y_real_width - y_pred_width) // 2
+from models.shape_planner import center_crop_like
 
-        y_real = y_real[:, :, diff_height:y_real_height-diff_height, diff_width:y_real_width-diff_width]
 
-        return y_real
+def reshape_input(y_pred, y_real):
+        # Crop the target to the (smaller) output of an unpadded model
+        return center_crop_like(y_real, y_pred)
 
 
 def dice_overlap(y_pred, y_real):
@@ -82,4 +79,74 @@ def specificity(y_pred, y_real, epsilon=1e-6):
 
     specificity = TN / (TN + FP + epsilon)
 
-    return specificity.item()  
\ No newline at end of file
+    return specificity.item()  
+
+class ConfusionMatrixMeter:
+    """
+    Accumulates the pixel confusion matrix (TP, FP, TN, FN) of binary predictions and derives dice_overlap, IoU,
+    accuracy, sensitivity and specificity from it.
+
+    `update` counts the four values of every image of a batch in one pass on the device of the tensors and keeps
+    them there, so there is no device sync per batch; `compute` transfers the counts once at the end. Targets
+    that are neither 0 nor 1 (NaN for the unknown pixels of weak labels) are not counted.
+
+    Averaging:
+    - 'micro': the metrics of the summed confusion matrix over all pixels of all images.
+    - 'macro': the mean of the metrics of every image (what evaluate_model reported per image before).
+    """
+    names = ['dice_overlap', 'IoU', 'accuracy', 'sensitivity', 'specificity']
+
+    def __init__(self, epsilon=1e-6):
+        self.epsilon = epsilon
+        self.reset()
+
+    def reset(self):
+        self.counts = []
+
+    def update(self, y_pred, y_real):
+        """
+        Adds a batch of N x 1 x H x W predictions (0 or 1) and targets.
+        """
+        if y_pred.shape != y_real.shape:
+            y_real = reshape_input(y_pred, y_real)
+
+        pred = (y_pred == 1).flatten(1)
+        positive = (y_real == 1).flatten(1)
+        negative = (y_real == 0).flatten(1)
+
+        tp = (pred & positive).sum(dim=1)
+        fp = (pred & negative).sum(dim=1)
+        tn = (~pred & negative).sum(dim=1)
+        fn = (~pred & positive).sum(dim=1)
+        self.counts.append(torch.stack([tp, fp, tn, fn], dim=1))
+
+    def _metrics(self, counts):
+        tp, fp, tn, fn = counts.unbind(dim=-1)
+        return {
+            'dice_overlap': 2 * tp / (2 * tp + fp + fn),
+            'IoU': (tp + self.epsilon) / (tp + fp + fn + self.epsilon),
+            'accuracy': (tp + tn) / (tp + fp + tn + fn),
+            'sensitivity': tp / (tp + fn + self.epsilon),
+            'specificity': tn / (tn + fp + self.epsilon),
+        }
+
+    def confusion_matrix(self):
+        """
+        Returns the per image counts as an N x 4 float64 CPU tensor with the columns TP, FP, TN, FN.
+        """
+        if not self.counts:
+            return torch.zeros((0, 4), dtype=torch.float64)
+        return torch.cat(self.counts).cpu().double()
+
+    def compute(self, average='micro'):
+        """
+        Returns a dictionary with the five metrics as floats.
+        """
+        counts = self.confusion_matrix()
+        if average == 'micro':
+            metrics = self._metrics(counts.sum(dim=0))
+        elif average == 'macro':
+            metrics = {name: values.mean() for name, values in self._metrics(counts).items()}
+        else:
+            raise ValueError(f"Averaging '{average}' is not recognized, use 'micro' or 'macro'")
+        return {name: float(value) for name, value in metrics.items()}
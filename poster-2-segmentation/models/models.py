@@ -7,6 +7,7 @@ import torchvision.transforms.functional as tf
 class EncDec(nn.Module):
     def __init__(self, input_channels=3, output_channels=1, padding = 1):
         super().__init__()
+        self.padding = padding
 
         # Encoder
         self.enc_conv0 = nn.Sequential(
@@ -252,6 +253,7 @@ class UpSample(nn.Module):
 class UNet(nn.Module):
     def __init__(self, in_channels, num_classes, padding=0):
         super().__init__()
+        self.padding = padding
         self.down_convolution_1 = DownSample(in_channels, 64, padding)
         self.down_convolution_2 = DownSample(64, 128, padding)
         self.down_convolution_3 = DownSample(128, 256, padding)
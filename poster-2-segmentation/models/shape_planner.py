@@ -0,0 +1,186 @@
+from collections import namedtuple
+from functools import lru_cache
+
+import torch
+
+from models.models import EncDec, UNet
+
+# Number of pooling levels of EncDec and UNet
+DEPTH = 4
+
+# input_size/output_size: side length of the input and the output of the model
+# margin: pixels lost on every side, the output covers input[margin:margin + output_size]
+# centered: the output is exactly centered on the input (no pooling drops a row and every skip crop is symmetric)
+# center_crops: number of UpSample blocks that have to center_crop their skip connection
+ShapePlan = namedtuple('ShapePlan', ['input_size', 'output_size', 'margin', 'centered', 'center_crops'])
+
+
+def _double_conv(size, padding):
+    # Two 3x3 convolutions with the given padding
+    return size + 2 * (2 * padding - 2)
+
+
+@lru_cache(maxsize=None)
+def plan_shapes(architecture, input_size, padding, depth=DEPTH):
+    """
+    Computes the output size of UNet or EncDec for a square input without running the model.
+
+    Parameters:
+    -----------
+    architecture : str
+        'unet' or 'encdec'.
+
+    input_size : int
+        Side length of the input.
+
+    padding : int
+        The padding of the 3x3 convolutions (0 for the unpadded models).
+
+    depth : int
+        Number of pooling levels.
+
+    Returns:
+    --------
+    ShapePlan
+        The output size and the margin lost on every side, see `ShapePlan`.
+
+    Raises:
+    -------
+    ValueError
+        If the input is too small, i.e. a feature map of the encoder, the bottleneck or the decoder would be empty.
+    """
+    if architecture not in ('unet', 'encdec'):
+        raise ValueError(f"Architecture '{architecture}' is not recognized.")
+
+    size = input_size
+    skips = []
+    centered = True
+    for _ in range(depth):
+        size = _double_conv(size, padding)
+        if size < 2:
+            raise ValueError(f"An input of {input_size} pixels is too small for the {architecture} with padding {padding}")
+        skips.append(size)
+        # Max pooling drops the last row of an odd feature map, which shifts the output
+        centered &= size % 2 == 0
+        size //= 2
+
+    size = _double_conv(size, padding)
+    if size < 1:
+        raise ValueError(f"An input of {input_size} pixels is too small for the {architecture} with padding {padding}")
+
+    center_crops = 0
+    for skip in reversed(skips):
+        size *= 2
+        if architecture == 'unet' and skip != size:
+            if skip < size:
+                # center_crop would zero pad the skip connection instead of cropping it
+                raise ValueError(f"An input of {input_size} pixels is too small for the {architecture} with padding {padding}")
+            center_crops += 1
+            centered &= (skip - size) % 2 == 0
+        size = _double_conv(size, padding)
+        if size < 1:
+            raise ValueError(f"An input of {input_size} pixels is too small for the {architecture} with padding {padding}")
+
+    return ShapePlan(input_size, size, (input_size - size) // 2, centered, center_crops)
+
+
+def model_config(model):
+    """
+    Returns the (architecture, padding) of an EncDec or UNet, or None for any other model.
+    """
+    if isinstance(model, UNet):
+        return 'unet', model.padding
+    if isinstance(model, EncDec):
+        return 'encdec', model.padding
+    return None
+
+
+def model_shape_plan(model, input_size):
+    """
+    `plan_shapes` for a model instance. Returns None if the shapes of the model cannot be planned.
+    """
+    config = model_config(model)
+    if config is None:
+        return None
+    return plan_shapes(config[0], input_size, config[1])
+
+
+def recommend_input_size(architecture, padding, target_size, depth=DEPTH):
+    """
+    Returns the input size closest to target_size (the smaller one on a tie) for which the output is exactly
+    centered on the input. For the padded models these are the sizes where UpSample does not have to center_crop
+    at all (multiples of 2^depth); for the unpadded UNet the skip crops cannot be avoided, but they are
+    symmetric and no pooling drops a row.
+    """
+    for offset in range(2 ** (depth + 3)):
+        for size in (target_size - offset, target_size + offset):
+            try:
+                if size > 0 and plan_shapes(architecture, size, padding, depth).centered:
+                    return size
+            except ValueError:
+                continue
+    raise ValueError(f"No centered input size found close to {target_size}")
+
+
+def check_shape_plan(model, input_size, channels=3):
+    """
+    Runs the model on a zero input and checks that the output size matches `plan_shapes`. Input sizes the planner
+    rejects as too small are fine as long as the model does not produce an output of a planned size.
+
+    Returns:
+    --------
+    ShapePlan or None
+        The plan, or None if the planner rejects the input size.
+    """
+    try:
+        plan = model_shape_plan(model, input_size)
+    except ValueError:
+        plan = None
+
+    try:
+        with torch.no_grad():
+            output_size = model(torch.zeros(1, channels, input_size, input_size)).shape[-1]
+    except RuntimeError:
+        output_size = None
+
+    if plan is None:
+        return None
+    if output_size != plan.output_size:
+        raise AssertionError(f"Planned output {plan.output_size} for an input of {input_size}, the model gives {output_size}")
+    return plan
+
+
+def center_crop_like(y_real, y_pred):
+    """
+    Crops the center of an N x C x H x W target to the size of the model output. Returns y_real itself when the
+    sizes already match.
+    """
+    _, _, y_pred_height, y_pred_width = y_pred.shape
+    _, _, y_real_height, y_real_width = y_real.shape
+    if (y_pred_height, y_pred_width) == (y_real_height, y_real_width):
+        return y_real
+
+    top = (y_real_height - y_pred_height) // 2
+    left = (y_real_width - y_pred_width) // 2
+    return y_real[:, :, top:top + y_pred_height, left:left + y_pred_width]
+
+
+if __name__ == "__main__":
+    # Compare the plans with real forward passes, for valid and too small inputs
+    for padding in (0, 1):
+        models = {'unet': UNet(in_channels=3, num_classes=1, padding=padding),
+                  'encdec': EncDec(input_channels=3, output_channels=1, padding=padding)}
+        for architecture, model in models.items():
+            model.eval()
+            for input_size in (16, 64, 100, 140, 188, 252, 256):
+                plan = check_shape_plan(model, input_size)
+                print(f"{architecture} padding {padding}, input {input_size}: "
+                      f"{'too small' if plan is None else f'output {plan.output_size}, margin {plan.margin}'}")
+
+    for architecture, input_size in (('unet', 140), ('encdec', 100)):
+        try:
+            plan_shapes(architecture, input_size, 0)
+            raise AssertionError(f"An input of {input_size} must be too small for the unpadded {architecture}")
+        except ValueError:
+            pass
+    assert recommend_input_size('unet', 0, 100) >= 188
@@ -1,68 +1,199 @@
+import weakref
 import torch
 import torch.nn.functional as F
 
-def split_image_into_patches(input_image, patch_size, model, add_edge=False):
-
+from models.shape_planner import model_shape_plan
+from utils.precision import autocast, to_memory_format
+
+# Models the shape planner does not know are measured once per model and patch size with a forward pass
+_output_padding_cache = weakref.WeakKeyDictionary()
+
+
+def output_padding(model, patch_size, channels, device):
+    """
+    Returns how many pixels the model loses on every side of a patch_size x patch_size input
+    (0 for padded convolutions, > 0 for the unpadded UNet).
+    """
+    plan = model_shape_plan(model, patch_size)
+    if plan is not None:
+        return plan.margin
+
+    sizes = _output_padding_cache.setdefault(model, {})
+    key = (patch_size, channels)
+    if key not in sizes:
+        with torch.no_grad():
+            mask_height = model(torch.zeros(1, channels, patch_size, patch_size, device=device)).shape[-2]
+        sizes[key] = int((patch_size - mask_height) / 2)
+    return sizes[key]
+
+
+def tile_positions(length, patch_size, padding):
+    """
+    Tile positions along one axis with the bookkeeping of the original patch loop.
+
+    Returns a list of (i, start, save, delta): the tile is cut at `start`, and its output rows
+    save:save + delta are written to i + padding:i + padding + delta of the mask. The last tile is shifted back
+    to fit into the image, and `save` skips the rows the previous tile already wrote. Tiles that would not
+    write anything are left out.
+    """
+    step = patch_size - 2 * padding
+    positions = []
+    i = 0
+    while i < length:
+        if i + patch_size > length:
+            start = length - patch_size
+            save = i + patch_size - length
+            delta = length - i - 2 * padding
+        else:
+            start = i
+            save = 0
+            delta = patch_size - 2 * padding
+
+        if delta > 0:
+            positions.append((i, start, save, delta))
+        i += step
+    return positions
+
+
+def overlapping_tile_starts(length, patch_size, out_size, overlap):
+    """
+    Start positions of tiles whose outputs (out_size wide) overlap by `overlap` pixels. The last tile is shifted
+    back so that it ends at the end of the image.
+    """
+    step = out_size - overlap
+    assert step > 0, f"The overlap ({overlap}) must be smaller than the output size of a tile ({out_size})"
+    starts = list(range(0, max(length - patch_size, 0) + 1, step))
+    if starts[-1] != length - patch_size:
+        starts.append(length - patch_size)
+    return starts
+
+
+def blend_weights(height, width, blend, device):
+    """
+    Weight map for blending overlapping tile outputs. 'linear' decreases linearly towards the tile borders,
+    'gaussian' follows a Gaussian with sigma = 1/8 of the tile size, both centered on the tile.
+    """
+    def profile(n):
+        x = torch.arange(n, dtype=torch.float32, device=device)
+        if blend == 'linear':
+            return torch.minimum(x + 1, n - x)
+        elif blend == 'gaussian':
+            sigma = n / 8
+            return torch.exp(-0.5 * ((x - (n - 1) / 2) / sigma) ** 2)
+        raise ValueError(f"Blending '{blend}' is not recognized.")
+
+    weights = profile(height)[:, None] * profile(width)[None, :]
+    # Avoid zero weights at the corners, every output pixel must get some weight
+    return weights.clamp(min=weights.max() * 1e-3).unsqueeze(0)
+
+
+def sliding_window_logits(input_image, patch_size, model, add_edge=False, batch_size=8, blend='none', overlap=0,
+                          precision='fp32', channels_last=False):
+    """
+    Runs the model on all patch_size x patch_size tiles of an image in mini-batches and stitches the outputs.
+
+    Parameters:
+    -----------
+    input_image : torch.Tensor
+        A C x H x W image.
+
+    patch_size : int
+        Size of the tiles (the crop size the model was trained with).
+
+    model : nn.Module
+        The segmentation model.
+
+    add_edge : bool
+        Pad the image with zeros first, so the border is predicted by models without padding (padding=0).
+
+    batch_size : int
+        Number of tiles per forward pass.
+
+    blend : str
+        'none' writes every output pixel from the first tile that covers it, like the original patch loop.
+        'linear' and 'gaussian' average the outputs of overlapping tiles with a weight map that decreases
+        towards the tile borders.
+
+    overlap : int
+        Overlap in pixels between the outputs of neighbouring tiles. Only used for 'linear' and 'gaussian'.
+
+    precision : str
+        'fp32', or 'bf16' to run the model under bf16 autocast (the outputs are stitched in fp32).
+
+    channels_last : bool
+        Pass the tiles to the model in channels-last memory format.
+
+    Returns:
+    --------
+    torch.Tensor
+        A 1 x H x W tensor with the logits of the model.
+    """
     orig_shape = input_image.shape
     device = input_image.device  # Get the device of the input image
 
-    patch = input_image[:, 0:patch_size, 0:patch_size]
-    mask_pred = model(patch.unsqueeze(0)).squeeze(0)
-    _, mask_height, mask_width = mask_pred.shape
-    padding = int((patch_size - mask_height) / 2)
+    padding = output_padding(model, patch_size, orig_shape[0], device)
 
     if add_edge:
         input_image = F.pad(input_image, (padding, padding, padding, padding), "constant", 0)
 
-    
     image_dim, image_height, image_width = input_image.shape
-    mask = torch.zeros(1, image_height, image_width, device=device)  
-
-    i = 0
-
-    while i < image_height:
-        j = 0
-
-        while j < image_width:
-
-            if i + patch_size > image_height:
-                start_i = image_height - patch_size 
-                save_i = i + patch_size - image_height 
-                delta_i = image_height - i - 2*padding
+    out_size = patch_size - 2 * padding
+
+    if blend == 'none':
+        rows = tile_positions(image_height, patch_size, padding)
+        cols = tile_positions(image_width, patch_size, padding)
+        tiles = [(row, col) for row in rows for col in cols]
+        starts = [(row[1], col[1]) for row, col in tiles]
+    else:
+        rows = overlapping_tile_starts(image_height, patch_size, out_size, overlap)
+        cols = overlapping_tile_starts(image_width, patch_size, out_size, overlap)
+        starts = [(start_i, start_j) for start_i in rows for start_j in cols]
+        weights = blend_weights(out_size, out_size, blend, device)
+        weight_sum = torch.zeros(1, image_height, image_width, device=device)
+
+    mask = torch.zeros(1, image_height, image_width, device=device)
+
+    for first in range(0, len(starts), batch_size):
+        batch_starts = starts[first:first + batch_size]
+        patches = torch.stack([
+            input_image[:, start_i:start_i + patch_size, start_j:start_j + patch_size] for start_i, start_j in batch_starts
+        ])
+        with autocast(device, precision):
+            processed_patches = model(to_memory_format(patches, channels_last))
+        processed_patches = processed_patches.float()
+
+        for k, processed_patch in enumerate(processed_patches):
+            if blend == 'none':
+                (i, _, save_i, delta_i), (j, _, save_j, delta_j) = tiles[first + k]
+                mask[:, i + padding: i + padding + delta_i, j + padding: j + padding + delta_j] = \
+                    processed_patch[:, save_i: save_i + delta_i, save_j: save_j + delta_j]
             else:
-                start_i = i
-                save_i = 0
-                delta_i = patch_size - 2*padding
+                start_i, start_j = batch_starts[k]
+                region = (slice(None), slice(start_i + padding, start_i + padding + out_size),
+                          slice(start_j + padding, start_j + padding + out_size))
+                mask[region] += processed_patch * weights
+                weight_sum[region] += weights
 
-            end_i = start_i + patch_size
+    if blend != 'none':
+        mask = mask / weight_sum.clamp(min=1e-12)
 
-            if j + patch_size > image_width:
-                start_j = image_width - patch_size
-                save_j = j + patch_size - image_width 
-                delta_j = image_width - j - 2*padding
-            else:
-                start_j = j
-                save_j = 0
-                delta_j = patch_size - 2*padding
-
-            end_j = start_j + patch_size
-
-            patch = input_image[:, start_i:end_i, start_j:end_j]
-
-            processed_patch = model(patch.unsqueeze(0)).squeeze(0)
+    return mask[:, padding: image_height - padding, padding: image_width - padding]
 
-            mask[:, i + padding: i + padding + delta_i, j + padding : j + padding + delta_j] = processed_patch[:, save_i : patch_size - 2*padding, save_j : patch_size - 2*padding]
 
-            j += patch_size - 2* padding
-
-        i += patch_size - 2*padding
+def split_image_into_patches(input_image, patch_size, model, add_edge=False, batch_size=8, blend='none', overlap=0,
+                             precision='fp32', channels_last=False):
+    """
+    Predicts the binary mask of a whole image with tiled inference, see `sliding_window_logits`.
+    """
+    orig_shape = input_image.shape
 
-    mask = mask[:, padding : image_height - padding, padding : image_width - padding ]
+    mask = sliding_window_logits(input_image, patch_size, model, add_edge=add_edge, batch_size=batch_size,
+                                 blend=blend, overlap=overlap, precision=precision, channels_last=channels_last)
 
     preds = torch.sigmoid(mask)
-    predictions = (preds > 0.5).float()  
-    
+    predictions = (preds > 0.5).float()
+
     assert orig_shape[1] == predictions.shape[1], "Must be same"
     assert orig_shape[2] == predictions.shape[2], "Must be same"
 
-    return predictions
\ No newline at end of file
+    return predictions
@@ -1,23 +1,27 @@
 import torch
 from utils.logger import logger
-from models.metrics import dice_overlap, IoU, accuracy, sensitivity, specificity
+from models.metrics import ConfusionMatrixMeter
+from utils.precision import autocast, to_memory_format
 import wandb
 
-def train_model(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=10, device='cuda'):
+def train_model(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=10, device='cuda', precision='fp32', channels_last=False):
+    # precision='bf16' runs the forward passes under bf16 autocast, the losses are computed in fp32
 
-    model = model.to(device)
+    model = to_memory_format(model.to(device), channels_last)
     
     for epoch in range(num_epochs):
         model.train()
         running_loss = 0.0
         # Train loop 
         for images, masks in train_loader:
-            images = images.to(device)
+            images = to_memory_format(images.to(device), channels_last)
             masks = masks.to(device)
             
             optimizer.zero_grad()
             
-            outputs = model(images)
+            with autocast(device, precision):
+                outputs = model(images)
+            outputs = outputs.float()
             loss = loss_fn(outputs, masks)
 
             loss.backward()
@@ -29,41 +33,32 @@ def train_model(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=
         
         # Validation Loop
         model.eval()  
-        val_dice = 0.0
-        val_iou = 0.0
-        val_accuracy = 0.0
-        val_sensitivity = 0.0
-        val_specificity = 0.0
-        num_val_batches = 0
+        meter = ConfusionMatrixMeter()
         val_loss = 0.0
         with torch.no_grad():  
             for images, masks in val_loader:
-                images = images.to(device)
+                images = to_memory_format(images.to(device), channels_last)
                 masks = masks.to(device)
                 
-                outputs = model(images)
+                with autocast(device, precision):
+                    outputs = model(images)
+                outputs = outputs.float()
                 loss = loss_fn(outputs, masks)
                 
                 val_loss += loss.item()
 
-                num_val_batches += 1
-
-                # Compute metrics for this batch
+                # Count TP/FP/TN/FN for this batch, the metrics are computed over all validation pixels
                 preds = torch.sigmoid(outputs)
                 preds = (preds > 0.5).float()
-
-                val_dice += dice_overlap(preds, masks)
-                val_iou += IoU(preds, masks)
-                val_accuracy += accuracy(preds, masks)
-                val_sensitivity += sensitivity(preds, masks)
-                val_specificity += specificity(preds, masks)
+                meter.update(preds, masks)
         
         avg_val_loss = val_loss / len(val_loader)
-        avg_val_dice = val_dice / num_val_batches
-        avg_val_iou = val_iou / num_val_batches
-        avg_val_accuracy = val_accuracy / num_val_batches
-        avg_val_sensitivity = val_sensitivity / num_val_batches
-        avg_val_specificity = val_specificity / num_val_batches
+        val_metrics = meter.compute('micro')
+        avg_val_dice = val_metrics['dice_overlap']
+        avg_val_iou = val_metrics['IoU']
+        avg_val_accuracy = val_metrics['accuracy']
+        avg_val_sensitivity = val_metrics['sensitivity']
+        avg_val_specificity = val_metrics['specificity']
 
         preds = torch.sigmoid(outputs)
         preds = (preds > 0.5).float()  # Threshold predictions to 0 or 1
@@ -84,21 +79,24 @@ def train_model(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=
 
     logger.success("Training completed.")
 
-def train_model_weak(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=10, device='cuda'):
-    model = model.to(device)
+def train_model_weak(model, train_loader, val_loader, loss_fn, optimizer, num_epochs=10, device='cuda', precision='fp32', channels_last=False):
+    # precision='bf16' runs the forward passes under bf16 autocast, the losses are computed in fp32
+    model = to_memory_format(model.to(device), channels_last)
     
     for epoch in range(num_epochs):
         model.train()
         running_loss = 0.0
         # Train loop 
         for images, masks in train_loader:
-            images = images.to(device)
+            images = to_memory_format(images.to(device), channels_last)
             masks = masks.to(device)
             #print('Unique values in masks:', torch.unique(masks))
             
             optimizer.zero_grad()
             
-            outputs = model(images)
+            with autocast(device, precision):
+                outputs = model(images)
+            outputs = outputs.float()
             #print('outputs shape:', outputs.shape)
             #print(outputs)
 
@@ -124,10 +122,12 @@ def train_model_weak(model, train_loader, val_loader, loss_fn, optimizer, num_ep
         val_loss = 0.0
         with torch.no_grad():  
             for images, masks in val_loader:
-                images = images.to(device)
+                images = to_memory_format(images.to(device), channels_last)
                 masks = masks.to(device)
                 
-                outputs = model(images)
+                with autocast(device, precision):
+                    outputs = model(images)
+                outputs = outputs.float()
                 loss = loss_fn(outputs, masks)
                 
                 val_loss += loss.item()
@@ -0,0 +1,285 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from torch.utils.data import Dataset
+
+
+class ToUint8Tensors:
+    """
+    Joint dataset transform for the batch augmentation: only converts the image to a 3 x H x W and the mask to a
+    1 x H x W uint8 tensor. Cropping, resizing, flips, rotations and normalization are done for the whole batch
+    by `BatchJointTransform`. Accepts PIL images or the uint8 arrays of the decoded image cache.
+    """
+    def __call__(self, image, mask):
+        image = torch.from_numpy(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
+        mask = torch.from_numpy(np.array(mask, dtype=np.uint8))
+        if mask.dim() == 2:
+            mask = mask.unsqueeze(0)
+        return image, mask
+
+
+def pad_collate(batch, mask_fill=0.0):
+    """
+    Collates (image, mask) samples of different sizes by padding them to the largest height and width: the
+    images with zeros, the masks with mask_fill. Use NaN for weak labels, so the padding is left out of the
+    masked loss like the other unknown pixels (bind it with `functools.partial`).
+
+    Returns:
+    - images: N x 3 x H x W uint8 tensor.
+    - masks: N x 1 x H x W float tensor (NaN for the unknown pixels of weak labels stays NaN).
+    - sizes: N x 2 tensor with the (height, width) of every sample before padding.
+    """
+    height = max(sample[0].shape[-2] for sample in batch)
+    width = max(sample[0].shape[-1] for sample in batch)
+
+    images = torch.zeros((len(batch), batch[0][0].shape[0], height, width), dtype=torch.uint8)
+    masks = torch.full((len(batch), 1, height, width), mask_fill, dtype=torch.float32)
+    sizes = torch.zeros((len(batch), 2), dtype=torch.int64)
+    for n, (image, mask, *_) in enumerate(batch):
+        h, w = image.shape[-2:]
+        images[n, :, :h, :w] = image
+        masks[n, :, :h, :w] = mask
+        sizes[n, 0], sizes[n, 1] = h, w
+
+    return images, masks, sizes
+
+
+class BatchJointTransform:
+    """
+    Joint augmentation of a whole batch of uint8 images and their masks, on the device the batch is on.
+
+    The steps are, in this order: resize, random crop (crops_per_image crops of every image), conversion to
+    [0, 1], horizontal and vertical flips, rotation and normalization, so the crops have crop_size like with
+    `JointTransform`. The image and its mask always get the same
+    geometric operations; masks are only resampled with nearest neighbour interpolation, so labels (and NaN for
+    unknown pixels) are never blended. Pixels rotated in from outside the image get mask_fill in the mask.
+
+    Parameters:
+    - crop_size: (height, width) of the random crops, None to keep the whole (padded) images.
+    - resize: (height, width) to resize every image to before cropping, None for no resizing.
+    - hflip, vflip: Probability of a horizontal / vertical flip.
+    - rotation: Maximum rotation angle in degrees, the angle is uniform in [-rotation, rotation].
+    - mean, std: Normalization of the images.
+    - crops_per_image: Number of random crops taken from every image of the batch.
+    - foreground_bias: Probability that a crop is centered on a random foreground pixel (mask == 1) instead of
+      placed uniformly, for images with foreground.
+    - mask_fill: Mask value outside the rotated image (use NaN for weak labels).
+    """
+    def __init__(self, crop_size=None, resize=None, hflip=0.0, vflip=0.0, rotation=0.0, mean=None, std=None,
+                 crops_per_image=1, foreground_bias=0.0, mask_fill=0.0):
+        self.crop_size = crop_size
+        self.resize = resize
+        self.hflip = hflip
+        self.vflip = vflip
+        self.rotation = rotation
+        self.mean = None if mean is None else torch.as_tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = None if std is None else torch.as_tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.crops_per_image = crops_per_image
+        self.foreground_bias = foreground_bias
+        self.mask_fill = mask_fill
+
+    @staticmethod
+    def resize_images(images, masks, size, sizes=None):
+        """
+        Resizes every image (without its padding) and its mask to size. Batches without padding are resized in
+        one call.
+        """
+        if sizes is None or (sizes == torch.tensor(images.shape[-2:])).all():
+            images = F.interpolate(images, size=size, mode='bilinear', align_corners=False, antialias=True)
+            masks = F.interpolate(masks, size=size, mode='nearest')
+            return images, masks
+
+        resized_images, resized_masks = [], []
+        for n, (height, width) in enumerate(sizes.tolist()):
+            resized_images.append(F.interpolate(images[n:n + 1, :, :height, :width], size=size, mode='bilinear',
+                                                align_corners=False, antialias=True))
+            resized_masks.append(F.interpolate(masks[n:n + 1, :, :height, :width], size=size, mode='nearest'))
+        return torch.cat(resized_images), torch.cat(resized_masks)
+
+    def random_crop(self, images, masks, sizes):
+        """
+        Takes crops_per_image random crops from every image with one gather. The crops stay inside the size of
+        every image before padding.
+        """
+        num_images = len(images)
+        crop_height, crop_width = self.crop_size
+        device = images.device
+        if sizes is None:
+            sizes = torch.tensor(images.shape[-2:], device=device).expand(num_images, 2)
+        sizes = sizes.to(device)
+
+        if (sizes[:, 0] < crop_height).any() or (sizes[:, 1] < crop_width).any():
+            raise ValueError(f"Required crop size {self.crop_size} is larger than an input image {sizes.tolist()}")
+
+        # Index of the source image of every crop and a random top left corner
+        source = torch.arange(num_images, device=device).repeat_interleave(self.crops_per_image)
+        top = (torch.rand(len(source), device=device) * (sizes[source, 0] - crop_height + 1)).long()
+        left = (torch.rand(len(source), device=device) * (sizes[source, 1] - crop_width + 1)).long()
+
+        if self.foreground_bias > 0:
+            top, left = self.foreground_corners(masks, sizes, source, top, left)
+
+        rows = (top[:, None] + torch.arange(crop_height, device=device))[:, :, None]
+        cols = (left[:, None] + torch.arange(crop_width, device=device))[:, None, :]
+        source = source[:, None, None]
+
+        # Advanced indices around a slice put the indexed dimensions first: crops x h x w x C
+        images = images[source, :, rows, cols].permute(0, 3, 1, 2)
+        masks = masks[source, :, rows, cols].permute(0, 3, 1, 2)
+        return images, masks
+
+    def foreground_corners(self, masks, sizes, source, top, left):
+        """
+        Moves a foreground_bias fraction of the crops so that they are centered on a random foreground pixel of
+        their image (clamped to the image).
+        """
+        crop_height, crop_width = self.crop_size
+        width = masks.shape[-1]
+
+        foreground = (masks[:, 0] == 1).flatten(1).float()
+        has_foreground = foreground.sum(dim=1) > 0
+        biased = (torch.rand(len(source), device=masks.device) < self.foreground_bias) & has_foreground[source]
+        if not biased.any():
+            return top, left
+
+        # One foreground pixel per crop of every image, sampled with the mask as weights (padding is background)
+        pixels = torch.zeros((len(masks), self.crops_per_image), dtype=torch.int64, device=masks.device)
+        pixels[has_foreground] = torch.multinomial(foreground[has_foreground], self.crops_per_image, replacement=True)
+        pixels = pixels.flatten()
+
+        center_top = torch.minimum((pixels // width - crop_height // 2).clamp(min=0), sizes[source, 0] - crop_height)
+        center_left = torch.minimum((pixels % width - crop_width // 2).clamp(min=0), sizes[source, 1] - crop_width)
+        return torch.where(biased, center_top, top), torch.where(biased, center_left, left)
+
+    @staticmethod
+    def random_flip(tensors, p, dim):
+        flip = torch.rand(len(tensors[0]), device=tensors[0].device) < p
+        flip = flip.view(-1, 1, 1, 1)
+        return [torch.where(flip, tensor.flip(dim), tensor) for tensor in tensors]
+
+    def random_rotation(self, images, masks):
+        num, _, height, width = images.shape
+        angles = (torch.rand(num, device=images.device) * 2 - 1) * math.radians(self.rotation)
+        cos, sin = torch.cos(angles), torch.sin(angles)
+
+        # Rotation in normalized coordinates, corrected for the aspect ratio of the image
+        zeros = torch.zeros_like(angles)
+        theta = torch.stack([
+            torch.stack([cos, -sin * height / width, zeros], dim=1),
+            torch.stack([sin * width / height, cos, zeros], dim=1),
+        ], dim=1)
+        grid = F.affine_grid(theta, (num, 1, height, width), align_corners=False)
+
+        images = F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        masks = F.grid_sample(masks, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+        # Pixels that come from outside the image
+        outside = (grid.abs() > 1).any(dim=-1, keepdim=True).permute(0, 3, 1, 2)
+        masks = masks.masked_fill(outside, self.mask_fill)
+        return images, masks
+
+    def __call__(self, images, masks, sizes=None):
+        """
+        Parameters:
+        - images: N x C x H x W uint8 tensor.
+        - masks: N x 1 x H x W float tensor.
+        - sizes: N x 2 (height, width) of the images before padding (see `pad_collate`), None if not padded.
+
+        Returns:
+        - images: (N * crops_per_image) x C x h x w float tensor, normalized.
+        - masks: (N * crops_per_image) x 1 x h x w float tensor.
+        """
+        masks = masks.float()
+        if self.resize is not None:
+            # Resize first and crop from the resized images, like JointTransform
+            images, masks = self.resize_images(images.float() / 255, masks, self.resize, sizes)
+            sizes = None
+
+        if self.crop_size is not None:
+            images, masks = self.random_crop(images, masks, sizes)
+        elif self.crops_per_image > 1:
+            images = images.repeat_interleave(self.crops_per_image, dim=0)
+            masks = masks.repeat_interleave(self.crops_per_image, dim=0)
+
+        if images.dtype == torch.uint8:
+            images = images.float() / 255
+
+        if self.hflip > 0:
+            images, masks = self.random_flip([images, masks], self.hflip, dim=-1)
+        if self.vflip > 0:
+            images, masks = self.random_flip([images, masks], self.vflip, dim=-2)
+        if self.rotation > 0:
+            images, masks = self.random_rotation(images, masks)
+
+        if self.mean is not None and self.std is not None:
+            images = (images - self.mean.to(images.device)) / self.std.to(images.device)
+
+        return images, masks
+
+
+class MultiCropDataset(Dataset):
+    """
+    Returns crops_per_image crops of every decoded image instead of one, so one decode feeds several training
+    samples. The wrapped dataset must return the whole image as uint8 (`ToUint8Tensors`); the crops are cut and
+    augmented in the worker by a `BatchJointTransform` with crops_per_image set. Use `concat_collate`, so a batch
+    of B items holds B * crops_per_image crops.
+    """
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, mask = self.dataset[idx][:2]
+        return self.transform(image.unsqueeze(0), mask.unsqueeze(0).float())
+
+
+class AugmentedSamples(Dataset):
+    """
+    Returns one sample of every image as the model sees it with the batch augmentation: the first crop of a
+    `BatchJointTransform` applied to the uint8 sample, normalized like the output of `JointTransform`. Used to
+    display training samples when the dataset itself only returns uint8 tensors.
+    """
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, mask = self.dataset[idx][:2]
+        images, masks = self.transform(image.unsqueeze(0), mask.unsqueeze(0).float())
+        return images[0], masks[0]
+
+
+def concat_collate(batch):
+    """
+    Concatenates the K x C x h x w crops of the items of a `MultiCropDataset` into one batch.
+    """
+    images, masks = zip(*batch)
+    return torch.cat(images), torch.cat(masks)
+
+
+class AugmentedLoader:
+    """
+    Wraps a DataLoader with `pad_collate` batches: moves every batch to the device and applies a
+    `BatchJointTransform` there, yielding (images, masks) like a normal segmentation loader.
+    """
+    def __init__(self, data_loader, batch_transform, device):
+        self.data_loader = data_loader
+        self.batch_transform = batch_transform
+        self.device = device
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        for images, masks, sizes in self.data_loader:
+            images = images.to(self.device, non_blocking=True)
+            masks = masks.to(self.device, non_blocking=True)
+            yield self.batch_transform(images, masks, sizes)
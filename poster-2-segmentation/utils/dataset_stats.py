@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from utils.logger import logger
+
+# Bump when the computed statistics change
+DATASET_STATS_VERSION = 1
+
+
+def image_statistics(image_path, mask_path):
+    """
+    Sums needed for the statistics of one image and its mask, decoded like the datasets do ('RGB' and
+    'L' > 0).
+    """
+    with Image.open(image_path) as image:
+        pixels = np.asarray(image.convert('RGB'), dtype=np.float64).reshape(-1, 3) / 255
+    with Image.open(mask_path) as mask:
+        foreground = np.asarray(mask.convert('L')) > 0
+
+    return {
+        'sum': pixels.sum(axis=0),
+        'sum_sq': np.square(pixels).sum(axis=0),
+        'pixels': len(pixels),
+        'positive': int(foreground.sum()),
+        'mask_pixels': int(foreground.size),
+    }
+
+
+def compute_dataset_stats(image_paths, mask_paths, num_workers=4):
+    """
+    Computes the statistics of a dataset in one pass over the full images and masks, decoding the files in
+    parallel threads.
+
+    Returns:
+    - dict with 'mean' and 'std' (per channel, for [0, 1] images), 'positive_fraction', 'pos_weight'
+      (negative / positive pixels, for weighted BCE), 'coverage' (mean, min and max foreground fraction per image)
+      and 'num_images'.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        per_image = list(executor.map(image_statistics, image_paths, mask_paths))
+
+    pixels = sum(s['pixels'] for s in per_image)
+    mean = sum(s['sum'] for s in per_image) / pixels
+    std = np.sqrt(np.maximum(sum(s['sum_sq'] for s in per_image) / pixels - mean ** 2, 0))
+
+    positive = sum(s['positive'] for s in per_image)
+    mask_pixels = sum(s['mask_pixels'] for s in per_image)
+    coverage = np.asarray([s['positive'] / s['mask_pixels'] for s in per_image])
+
+    return {
+        'num_images': len(per_image),
+        'mean': mean.tolist(),
+        'std': std.tolist(),
+        'positive_fraction': positive / mask_pixels,
+        # Same definition as compute_pos_weight, with the same protection against empty classes
+        'pos_weight': (mask_pixels - positive + 1e-6) / (positive + 1e-6),
+        'coverage': {'mean': float(coverage.mean()), 'min': float(coverage.min()), 'max': float(coverage.max())},
+    }
+
+
+def dataset_stats(dataset, name, split, cache_dir='dataset_stats', num_workers=4):
+    """
+    Returns the statistics of a dataset with image_paths and mask_paths (PH2Dataset, DRIVEDataset,
+    PH2DatasetWeakSupervision), see `compute_dataset_stats`.
+
+    The result is cached as JSON in cache_dir, keyed by the dataset name, the split and a hash of the files
+    (paths, sizes and modification times), so it is only computed again when the data changes.
+    """
+    sha = hashlib.sha1(f'{DATASET_STATS_VERSION}'.encode('utf-8'))
+    for path in list(dataset.image_paths) + list(dataset.mask_paths):
+        stat = os.stat(path)
+        sha.update(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    cache_path = os.path.join(cache_dir, f'{name}_{split}_{sha.hexdigest()[:16]}.json') if cache_dir else None
+
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+
+    stats = compute_dataset_stats(dataset.image_paths, dataset.mask_paths, num_workers=num_workers)
+    logger.info(f"Computed statistics of {name} {split} ({stats['num_images']} images): mean {np.round(stats['mean'], 4).tolist()}, "
+                f"std {np.round(stats['std'], 4).tolist()}, pos_weight {stats['pos_weight']:.3f}")
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump(stats, f, indent=2)
+        os.replace(tmp_path, cache_path)
+
+    return stats
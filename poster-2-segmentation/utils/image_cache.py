@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from PIL import Image
+
+# Bump when the stored layout changes
+IMAGE_CACHE_VERSION = 1
+
+CHANNELS = {'RGB': 3, 'L': 1}
+
+
+def to_pil(array):
+    """
+    Converts a cached H x W x 3 or H x W uint8 array back to a PIL image ('RGB' or 'L').
+    """
+    return Image.fromarray(np.ascontiguousarray(array))
+
+
+def image_cache_key(paths, mode):
+    """
+    Short hash of the files (path, size, modification time) and the PIL mode they are converted to.
+    """
+    sha = hashlib.sha1(f'{IMAGE_CACHE_VERSION}-{mode}'.encode('utf-8'))
+    for path in paths:
+        stat = os.stat(path)
+        sha.update(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    return sha.hexdigest()[:16]
+
+
+class DecodedImageCache:
+    """
+    The images of a dataset decoded once (PIL `.convert(mode)`) and stored back to back in one uint8 memmap.
+
+    The cache is built on first use in `cache_dir` and reused by later runs with the same files. Indexing
+    returns an H x W x 3 ('RGB') or H x W ('L') view into the memmap, so DataLoader workers read the pages
+    of the file directly and a crop is just a slice, nothing is decoded or copied.
+    """
+    def __init__(self, cache_dir, paths, mode):
+        if mode not in CHANNELS:
+            raise ValueError(f"Mode '{mode}' is not supported, use one of {list(CHANNELS)}")
+
+        key = image_cache_key(paths, mode)
+        index_path = os.path.join(cache_dir, f'decoded_{key}.json')
+        if not os.path.exists(index_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            build_image_cache(index_path, paths, mode)
+
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+
+        self.mode = mode
+        self.shapes = [tuple(shape) for shape in index['shapes']]
+        self.offsets = index['offsets']
+        # mode='c': copy-on-write, torch does not warn about read-only arrays and the file is never changed
+        self.data = np.memmap(os.path.join(cache_dir, index['file']), dtype=np.uint8, mode='c',
+                              shape=(max(index['size'], 1),))
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, idx):
+        start = self.offsets[idx]
+        shape = self.shapes[idx]
+        return self.data[start:start + int(np.prod(shape))].reshape(shape)
+
+
+def build_image_cache(index_path, paths, mode):
+    """
+    Decodes every file once and writes the uint8 arrays and a JSON index with their shapes and offsets.
+    """
+    # The sizes are read from the file headers, so the memmap can be allocated before decoding
+    shapes = []
+    for path in paths:
+        with Image.open(path) as image:
+            width, height = image.size
+        shapes.append((height, width, 3) if CHANNELS[mode] == 3 else (height, width))
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64).tolist() if sizes else []
+
+    data_path = index_path[:-len('.json')] + '.u8'
+    tmp_path = f"{data_path}.tmp-{os.getpid()}"
+    data = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=(max(sum(sizes), 1),))
+    for path, offset, size, shape in zip(paths, offsets, sizes, shapes):
+        with Image.open(path) as image:
+            array = np.asarray(image.convert(mode), dtype=np.uint8)
+        assert array.shape == shape, f"{path} decoded to {array.shape}, expected {shape}"
+        data[offset:offset + size] = array.ravel()
+    data.flush()
+    del data
+    os.replace(tmp_path, data_path)
+
+    index = {
+        'file': os.path.basename(data_path),
+        'mode': mode,
+        'paths': list(paths),
+        'shapes': [list(shape) for shape in shapes],
+        'offsets': offsets,
+        'size': int(sum(sizes)),
+    }
+    tmp_path = f"{index_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
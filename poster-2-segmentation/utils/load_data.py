@@ -3,13 +3,17 @@ import torch
 import os
 import random
 
+from functools import lru_cache
 from torch.utils.data import Dataset
 from PIL import Image
 from torchvision import transforms
 import numpy as np
 
+from utils.weak_label_cache import WeakLabelCache
+from utils.image_cache import DecodedImageCache, to_pil
+
 class PH2Dataset(Dataset):
-    def __init__(self, split='train', transform=None, crop = False, data_path='/dtu/datasets1/02516/PH2_Dataset_images'):
+    def __init__(self, split='train', transform=None, crop = False, data_path='/dtu/datasets1/02516/PH2_Dataset_images', image_cache_dir=None):
         self.transform = transform
         self.image_paths = []
         self.data_path = data_path
@@ -46,12 +50,24 @@ class PH2Dataset(Dataset):
             else:
                 print(f"No image or mask for {sample_dir}")
 
+        # Optionally decode every image and mask once into a memory-mapped cache
+        self.images, self.masks = None, None
+        if image_cache_dir is not None:
+            self.images = DecodedImageCache(image_cache_dir, self.image_paths, 'RGB')
+            self.masks = DecodedImageCache(image_cache_dir, self.mask_paths, 'L')
+
     def __len__(self):
         return len(self.image_paths)
 
     def __getitem__(self, idx):
-        image = Image.open(self.image_paths[idx]).convert('RGB')
-        mask = Image.open(self.mask_paths[idx]).convert('L')  # Convert mask to grayscale
+        if self.images is not None:
+            # Decoded arrays, a cropping transform slices them directly
+            image, mask = self.images[idx], self.masks[idx]
+            if not (self.transform and self.crop):
+                image, mask = to_pil(image), to_pil(mask)
+        else:
+            image = Image.open(self.image_paths[idx]).convert('RGB')
+            mask = Image.open(self.mask_paths[idx]).convert('L')  # Convert mask to grayscale
 
         if self.transform:
             if self.crop:
@@ -71,7 +87,7 @@ class PH2Dataset(Dataset):
         return image, mask
 
 class DRIVEDataset(Dataset):
-    def __init__(self, split='train', transform=None, crop = False, data_path='/dtu/datasets1/02516/DRIVE'):
+    def __init__(self, split='train', transform=None, crop = False, data_path='/dtu/datasets1/02516/DRIVE', image_cache_dir=None):
         self.transform = transform
         self.data_path = data_path
         self.crop = crop
@@ -107,12 +123,24 @@ class DRIVEDataset(Dataset):
         else:
             raise ValueError("split parameter should be 'train', 'val', or 'test'")
 
+        # Optionally decode every image and mask once into a memory-mapped cache
+        self.images, self.masks = None, None
+        if image_cache_dir is not None:
+            self.images = DecodedImageCache(image_cache_dir, self.image_paths, 'RGB')
+            self.masks = DecodedImageCache(image_cache_dir, self.mask_paths, 'L')
+
     def __len__(self):
         return len(self.image_paths)
 
     def __getitem__(self, idx):
-        image = Image.open(self.image_paths[idx]).convert('RGB')
-        mask = Image.open(self.mask_paths[idx]).convert('L')  # Convert mask to grayscale
+        if self.images is not None:
+            # Decoded arrays, a cropping transform slices them directly
+            image, mask = self.images[idx], self.masks[idx]
+            if not (self.transform and self.crop):
+                image, mask = to_pil(image), to_pil(mask)
+        else:
+            image = Image.open(self.image_paths[idx]).convert('RGB')
+            mask = Image.open(self.mask_paths[idx]).convert('L')  # Convert mask to grayscale
 
         if self.transform:
             if self.crop:
@@ -238,19 +266,19 @@ class PH2DatasetWeakSupervision(Dataset):
         else:
             return image, new_mask
 
-def load_data(data_name, split='train', transform=None, crop = False, data_path='/dtu/datasets1/02516', num_clicks=50, radius=20, seed=42, return_ground_truth=False, sampling='random'):
+def load_data(data_name, split='train', transform=None, crop = False, data_path='/dtu/datasets1/02516', num_clicks=50, radius=20, seed=42, return_ground_truth=False, sampling='random', cache_dir=None, image_cache_dir=None):
     if data_name.lower() == 'ph2':
-        dataset = PH2Dataset(split=split, transform=transform, crop = crop, data_path=os.path.join(data_path, 'PH2_Dataset_images'))
+        dataset = PH2Dataset(split=split, transform=transform, crop = crop, data_path=os.path.join(data_path, 'PH2_Dataset_images'), image_cache_dir=image_cache_dir)
     elif data_name.lower() == 'drive':
-        dataset = DRIVEDataset(split=split, transform=transform, crop = crop, data_path=os.path.join(data_path, 'DRIVE'))
+        dataset = DRIVEDataset(split=split, transform=transform, crop = crop, data_path=os.path.join(data_path, 'DRIVE'), image_cache_dir=image_cache_dir)
     elif data_name.lower() == 'ph2_weak_supervision':
-        dataset = PH2DatasetWeakSupervision(split=split, transform=transform, crop = crop, data_path=os.path.join(data_path, 'PH2_Dataset_images'), num_clicks=num_clicks, radius=radius, seed=seed, return_ground_truth=False, sampling=sampling)
+        dataset = PH2DatasetWeakSupervision(split=split, transform=transform, crop = crop, data_path=os.path.join(data_path, 'PH2_Dataset_images'), num_clicks=num_clicks, radius=radius, seed=seed, return_ground_truth=False, sampling=sampling, cache_dir=cache_dir, image_cache_dir=image_cache_dir)
     else:
         raise ValueError(f"Dataset {data_name} not recognized.")
     return dataset
 
 class PH2DatasetWeakSupervision(Dataset):
-    def __init__(self, split='train', transform=None, crop=False, data_path='/dtu/datasets1/02516/PH2_Dataset_images', num_clicks=50, radius=10, seed=42, return_ground_truth=False, sampling='random'):
+    def __init__(self, split='train', transform=None, crop=False, data_path='/dtu/datasets1/02516/PH2_Dataset_images', num_clicks=50, radius=10, seed=42, return_ground_truth=False, sampling='random', cache_dir=None, image_cache_dir=None):
         self.transform = transform
         self.image_paths = []
         self.data_path = data_path
@@ -293,32 +321,46 @@ class PH2DatasetWeakSupervision(Dataset):
             else:
                 print(f"No image or mask for {sample_dir}")
 
-    def __len__(self):
-        return len(self.image_paths)
+        # The samplers always reseed, so the weak mask of an image never changes: generate every mask once
+        # (or read it from cache_dir) and keep it bit-packed, the workers of a DataLoader share them
+        self.weak_labels = WeakLabelCache(sampling, num_clicks, radius, self.generate_weak_mask, cache_dir=cache_dir)
+        for mask_path in self.mask_paths:
+            self.weak_labels.add(mask_path, lambda mask_path=mask_path: load_binary_mask(mask_path))
 
-    def __getitem__(self, idx):
-        # Load the image and mask
-        image = Image.open(self.image_paths[idx]).convert('RGB')
-        mask = Image.open(self.mask_paths[idx]).convert('L')  # Convert mask to grayscale
-        mask_np = (np.array(mask) > 0).astype(np.uint8)
+        # Optionally decode every image once into a memory-mapped cache
+        self.images = DecodedImageCache(image_cache_dir, self.image_paths, 'RGB') if image_cache_dir is not None else None
 
+    def generate_weak_mask(self, mask_np):
         # generate the weak supervision mask based on the original mask
         if self.sampling == 'grid':
-            new_mask_np = grid_sampling(mask_np, num_clicks_per_side=self.num_clicks, radius=self.radius)
+            return grid_sampling(mask_np, num_clicks_per_side=self.num_clicks, radius=self.radius)
         elif self.sampling == 'stratified':
-            new_mask_np = stratified_sampling(mask_np, num_clicks_per_side=self.num_clicks, radius=self.radius)
+            return stratified_sampling(mask_np, num_clicks_per_side=self.num_clicks, radius=self.radius)
         elif self.sampling == 'random':
-            new_mask_np = add_points_randomMads(mask_np, num_clicks_per_side=self.num_clicks, radius=self.radius)
+            return add_points_randomMads(mask_np, num_clicks_per_side=self.num_clicks, radius=self.radius)
         else:
             raise ValueError(f"Sampling method '{self.sampling}' is not recognized.")
 
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        # Load the image and the precomputed weak supervision mask
+        if self.images is not None:
+            image = self.images[idx]
+            if not (self.transform and self.crop):
+                image = to_pil(image)
+        else:
+            image = Image.open(self.image_paths[idx]).convert('RGB')
+        new_mask_np = self.weak_labels.get(self.mask_paths[idx])
+
         #print(f'Unique values in new_mask_np: {np.unique(new_mask_np[~np.isnan(new_mask_np)])}')
         
 
         if self.transform:
             if self.crop:
-                # Transform both image and new_mask together
-                new_mask_pil = Image.fromarray(new_mask_np.astype(np.uint8))
+                # Transform both image and new_mask together (cached images are cropped as arrays)
+                new_mask_pil = new_mask_np if isinstance(image, np.ndarray) else Image.fromarray(new_mask_np.astype(np.uint8))
                 image, new_mask_pil = self.transform(image, new_mask_pil)
                 new_mask_np = np.array(new_mask_pil, dtype=np.float32)
             else:
@@ -335,6 +377,7 @@ class PH2DatasetWeakSupervision(Dataset):
 
         if self.return_ground_truth:
             # Load and process the full ground truth mask
+            mask_np = load_binary_mask(self.mask_paths[idx])
             ground_truth_mask = torch.from_numpy(mask_np.astype(np.float32))
             if ground_truth_mask.dim() == 2:
                 ground_truth_mask = ground_truth_mask.unsqueeze(0)
@@ -346,26 +389,47 @@ class PH2DatasetWeakSupervision(Dataset):
             return image, new_mask
         
 
+def load_binary_mask(mask_path):
+    mask = Image.open(mask_path).convert('L')  # Convert mask to grayscale
+    return (np.array(mask) > 0).astype(np.uint8)
+
+
 def add_points_randomMads(mask_array, num_clicks_per_side, radius):
-    height, width = mask_array.shape
-    new_mask = np.full((height, width), 2, dtype=np.uint8)  # 2 represents unknown
     np.random.seed(42)
-    
+
+    # The pixels of each class only have to be found once, the mask does not change between clicks
+    zero_indices = np.flatnonzero(mask_array == 0)
+    one_indices = np.flatnonzero(mask_array == 1)
+
+    # Same draws in the same order as one click at a time: a background click and then a foreground click
+    centers, values = [], []
     for _ in range(num_clicks_per_side):
-        zero_indices = np.argwhere(mask_array == 0)
-        one_indices = np.argwhere(mask_array == 1)
-    
         if len(zero_indices) > 0:
-            random_index = np.random.randint(len(zero_indices))
-            selected_zero = zero_indices[random_index]
-            new_mask = draw_circle(new_mask, selected_zero, radius, value=0)
-    
+            centers.append(zero_indices[np.random.randint(len(zero_indices))])
+            values.append(0)
+
         if len(one_indices) > 0:
-            random_index = np.random.randint(len(one_indices))
-            selected_one = one_indices[random_index]
-            new_mask = draw_circle(new_mask, selected_one, radius, value=1)
-    
-    return new_mask  # [height, width]
+            centers.append(one_indices[np.random.randint(len(one_indices))])
+            values.append(1)
+
+    centers = np.column_stack(np.unravel_index(np.asarray(centers, dtype=np.int64), mask_array.shape))
+    return rasterize_clicks(mask_array.shape, centers, values, radius)  # [height, width]
+
+
+def grid_centers(height, width, num_clicks_per_side):
+    """
+    Returns the (y, x) centers of the cells of a num_clicks_per_side x num_clicks_per_side grid, row by row.
+    """
+    # Calculate the size of each grid cell
+    cell_height = height // num_clicks_per_side
+    cell_width = width // num_clicks_per_side
+
+    center_y = np.arange(num_clicks_per_side) * cell_height + cell_height // 2
+    center_x = np.arange(num_clicks_per_side) * cell_width + cell_width // 2
+    centers = np.stack(np.meshgrid(center_y, center_x, indexing='ij'), axis=-1).reshape(-1, 2)
+
+    # Ensure the center point is within the bounds of the mask
+    return centers[(centers[:, 0] < height) & (centers[:, 1] < width)]
 
 
 def grid_sampling(mask_array, num_clicks_per_side, radius):
@@ -380,28 +444,12 @@ def grid_sampling(mask_array, num_clicks_per_side, radius):
     Returns:
     - new_mask: 2D numpy array with added annotations (0 for background, 1 for foreground, 2 for unknown).
     """
-    height, width = mask_array.shape
-    new_mask = np.full((height, width), 2, dtype=np.uint8)  # 2 represents unknown
-
-    # Calculate the size of each grid cell
-    cell_height = height // num_clicks_per_side
-    cell_width = width // num_clicks_per_side
-
-    for i in range(num_clicks_per_side):
-        for j in range(num_clicks_per_side):
-            # Calculate the center of the current cell
-            center_y = i * cell_height + cell_height // 2
-            center_x = j * cell_width + cell_width // 2
+    centers = grid_centers(*mask_array.shape, num_clicks_per_side)
 
-            # Ensure the center point is within the bounds of the mask
-            if center_y < height and center_x < width:
-                # Check the original mask value at this center point
-                if mask_array[center_y, center_x] == 1:
-                    new_mask = draw_circle(new_mask, (center_y, center_x), radius, value=1)
-                else:
-                    new_mask = draw_circle(new_mask, (center_y, center_x), radius, value=0)
+    # The label of every click is the original mask value at its center
+    values = (mask_array[centers[:, 0], centers[:, 1]] == 1).astype(np.uint8)
 
-    return new_mask
+    return rasterize_clicks(mask_array.shape, centers, values, radius)
 
 def stratified_sampling(mask_array, num_clicks_per_side, radius):
     """
@@ -415,36 +463,84 @@ def stratified_sampling(mask_array, num_clicks_per_side, radius):
     Returns:
     - new_mask: 2D numpy array with added annotations (0 for background, 1 for foreground, 2 for unknown).
     """
-    height, width = mask_array.shape
-    new_mask = np.full((height, width), 2, dtype=np.uint8)  # 2 represents unknown
     np.random.seed(42)
 
+    # Get indices of each class
+    zero_indices = np.flatnonzero(mask_array == 0)
+    one_indices = np.flatnonzero(mask_array == 1)
+
     # Calculate the number of pixels in each class
-    num_zero = np.sum(mask_array == 0)
-    num_one = np.sum(mask_array == 1)
+    num_zero = len(zero_indices)
+    num_one = len(one_indices)
     total_pixels = num_zero + num_one
 
     # Calculate the number of clicks for each class proportionally
     num_clicks_zero = int((num_zero / total_pixels) * num_clicks_per_side)
     num_clicks_one = num_clicks_per_side - num_clicks_zero  # Remaining clicks
 
-    # Get indices of each class
-    zero_indices = np.argwhere(mask_array == 0)
-    one_indices = np.argwhere(mask_array == 1)
+    centers, values = [], []
 
     # Sample points for background
     if len(zero_indices) > 0 and num_clicks_zero > 0:
-        sampled_zero_indices = zero_indices[np.random.choice(len(zero_indices), num_clicks_zero, replace=False)]
-        for idx in sampled_zero_indices:
-            new_mask = draw_circle(new_mask, idx, radius, value=0)
+        centers.append(zero_indices[np.random.choice(len(zero_indices), num_clicks_zero, replace=False)])
+        values.append(np.zeros(num_clicks_zero, dtype=np.uint8))
 
     # Sample points for foreground
     if len(one_indices) > 0 and num_clicks_one > 0:
-        sampled_one_indices = one_indices[np.random.choice(len(one_indices), num_clicks_one, replace=False)]
-        for idx in sampled_one_indices:
-            new_mask = draw_circle(new_mask, idx, radius, value=1)
+        centers.append(one_indices[np.random.choice(len(one_indices), num_clicks_one, replace=False)])
+        values.append(np.ones(num_clicks_one, dtype=np.uint8))
+
+    centers = np.concatenate(centers) if centers else np.zeros(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.zeros(0, dtype=np.uint8)
+    centers = np.column_stack(np.unravel_index(centers, mask_array.shape))
+
+    return rasterize_clicks(mask_array.shape, centers, values, radius)  # [height, width]
+
+@lru_cache(maxsize=None)
+def disk_offsets(radius):
+    """
+    Returns the (dy, dx) offsets of all pixels of a filled circle with the given radius around (0, 0).
+    """
+    r = int(np.floor(radius))
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    inside = dy ** 2 + dx ** 2 <= radius ** 2
+    return dy[inside], dx[inside]
+
+def rasterize_clicks(shape, centers, values, radius, unknown=2):
+    """
+    Paints a filled circle for every click at once, instead of one full image distance map per click
+    (`draw_circle`). The circles are stamped from a precomputed disk and where they overlap the later click
+    wins, exactly as when they are drawn one after another.
+
+    Parameters:
+    - shape: (height, width) of the mask.
+    - centers: K x 2 array of (y, x) click coordinates, in drawing order.
+    - values: K labels of the clicks (0 for background, 1 for foreground).
+    - radius: Radius of the circles.
+    - unknown: Value of the pixels without a click.
+
+    Returns:
+    - new_mask: 2D uint8 numpy array with the annotations.
+    """
+    height, width = shape
+    new_mask = np.full((height, width), unknown, dtype=np.uint8)
+
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+    if len(centers) == 0:
+        return new_mask
+
+    dy, dx = disk_offsets(radius)
+    ys = centers[:, :1] + dy[None, :]
+    xs = centers[:, 1:] + dx[None, :]
+    inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
 
-    return new_mask  # [height, width]
+    pixels = (ys * width + xs)[inside]
+    labels = np.broadcast_to(np.asarray(values, dtype=np.uint8)[:, None], ys.shape)[inside]
+
+    # Keep the last click of every pixel: the first occurrence in the reversed order
+    pixels, first = np.unique(pixels[::-1], return_index=True)
+    new_mask.flat[pixels] = labels[::-1][first]
+    return new_mask
 
 def draw_circle(array, center, radius, value):
     """
@@ -471,28 +567,7 @@ def add_points_MADS(mask_array, num_clicks_per_side, radius):
     """
 
     """
-    height, width = mask_array.shape
-    new_mask = np.full((height, width), 2, dtype=np.uint8)  # 2 represents unknown
-
-    # Calculate the size of each grid cell
-    cell_height = height // num_clicks_per_side
-    cell_width = width // num_clicks_per_side
-
-    for i in range(num_clicks_per_side):
-        for j in range(num_clicks_per_side):
-            # Calculate the center of the current cell
-            center_y = i * cell_height + cell_height // 2
-            center_x = j * cell_width + cell_width // 2
-
-            # Ensure the center point is within the bounds of the mask
-            if center_y < height and center_x < width:
-                # Check the original mask value at this center point
-                if mask_array[center_y, center_x] == 1:
-                    new_mask = draw_circle(new_mask, (center_y, center_x), radius, value=1)
-                else:
-                    new_mask = draw_circle(new_mask, (center_y, center_x), radius, value=0)
-
-    return new_mask
+    return grid_sampling(mask_array, num_clicks_per_side, radius)
 
 if __name__ == "__main__":
     transform = transforms.Compose([
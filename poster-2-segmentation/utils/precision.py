@@ -0,0 +1,24 @@
+import torch
+
+PRECISIONS = ['fp32', 'bf16']
+
+
+def autocast(device, precision='fp32'):
+    """
+    Returns the autocast context for the precision: bf16 autocast on the device type of `device` (works on
+    CPU and CUDA), or a disabled context for fp32.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Precision '{precision}' is not recognized, use one of {PRECISIONS}")
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def to_memory_format(x, channels_last=False):
+    """
+    Converts a model or an N x C x H x W batch to channels-last (NHWC) memory if channels_last is set.
+    """
+    if not channels_last:
+        return x
+    if isinstance(x, torch.nn.Module):
+        return x.to(memory_format=torch.channels_last)
+    return x.contiguous(memory_format=torch.channels_last)
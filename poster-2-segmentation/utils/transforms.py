@@ -4,6 +4,16 @@ import torch
 import numpy as np
 from PIL import Image
 
+from utils.image_cache import to_pil
+
+def random_crop_arrays(image, mask, crop_size):
+    """
+    Random crop of an H x W x C image array and its H x W mask by slicing, with the same random draw as
+    T.RandomCrop.get_params on the PIL images.
+    """
+    i, j, h, w = T.RandomCrop.get_params(torch.from_numpy(mask), output_size=crop_size)
+    return image[i:i + h, j:j + w], mask[i:i + h, j:j + w]
+
 class JointTransform:
     def __init__(self, crop_size=None, resize=None, mean = None, std = None):
         self.crop_size = crop_size
@@ -17,14 +27,23 @@ class JointTransform:
             self.normalize = None
 
     def __call__(self, image, mask):
+        crop_size = self.crop_size
+
+        # Cached uint8 arrays are cropped by slicing (when there is no resize first) and then converted to PIL
+        if isinstance(image, np.ndarray):
+            if self.resize is None and crop_size is not None:
+                image, mask = random_crop_arrays(image, mask, crop_size)
+                crop_size = None
+            image, mask = to_pil(image), to_pil(mask)
+
         # Resize
         if self.resize is not None:
             image = TF.resize(image, self.resize)
             mask = TF.resize(mask, self.resize)
 
         # Random Crop
-        if self.crop_size is not None:
-            i, j, h, w = T.RandomCrop.get_params(image, output_size=self.crop_size)
+        if crop_size is not None:
+            i, j, h, w = T.RandomCrop.get_params(image, output_size=crop_size)
             image = TF.crop(image, i, j, h, w)
             mask = TF.crop(mask, i, j, h, w)
 
@@ -53,8 +72,14 @@ class JointTransform_weak:
             self.normalize = None
 
     def __call__(self, image, mask):
+        # Cached uint8 arrays are cropped by slicing and then converted to PIL
+        if isinstance(image, np.ndarray):
+            if self.crop_size is not None:
+                image, mask = random_crop_arrays(image, mask, self.crop_size)
+            image, mask = to_pil(image), to_pil(mask)
+
         # Random crop
-        if self.crop_size is not None:
+        elif self.crop_size is not None:
             i, j, h, w = T.RandomCrop.get_params(image, output_size=self.crop_size)
             image = TF.crop(image, i, j, h, w)
             mask = TF.crop(mask, i, j, h, w)
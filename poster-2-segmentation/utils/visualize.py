@@ -3,7 +3,11 @@ import random
 import torch
 import numpy as np
 
-def display_random_images_and_masks(dataset, figname, num_images=3):
+def display_random_images_and_masks(dataset, figname, num_images=3, mean=None, std=None):
+    """
+    Saves num_images random (image, mask) samples of the dataset. Pass the mean and std of the normalization to
+    show normalized images, without them the images are expected in [0, 1].
+    """
     random.seed(42)
     random_indices = random.sample(range(len(dataset)), num_images)
     plt.figure(figsize=(10, num_images * 5))
@@ -13,6 +17,9 @@ def display_random_images_and_masks(dataset, figname, num_images=3):
 
         image_np = image.permute(1, 2, 0).numpy()  # Change from CxHxW to HxWxC for plotting
         mask_np = mask.squeeze().numpy()  
+        if mean is not None and std is not None:
+            image_np = image_np * np.asarray(std) + np.asarray(mean)
+        image_np = np.clip(image_np, 0, 1)
 
         # Display image
         plt.subplot(num_images, 2, 2 * i + 1)
@@ -194,7 +201,12 @@ def visualize_weak_supervision_predictions(model,
     plt.show()
 
 
-def display_random_images_and_weak_supervision_masks(dataset, figname, num_images=3):
+def display_random_images_and_weak_supervision_masks(dataset, figname, num_images=3,
+                                                     mean=(0.7475, 0.5721, 0.4836), std=(0.2004, 0.1972, 0.2023)):
+    """
+    Saves num_images random samples of the dataset with their weak labels (NaN pixels in gray). The images are
+    de-normalized with mean and std.
+    """
     random.seed(42)
     random_indices = random.sample(range(len(dataset)), num_images)
     plt.figure(figsize=(15, num_images * 5))
@@ -219,9 +231,7 @@ def display_random_images_and_weak_supervision_masks(dataset, figname, num_image
         print(f"Mask shape: {mask_np.shape}")
         
         # Denormalize the image
-        mean = np.array([0.7475, 0.5721, 0.4836])
-        std = np.array([0.2004, 0.1972, 0.2023])
-        image_np = (image_np * std + mean) * 255  # Rescale back to [0, 255]
+        image_np = (image_np * np.asarray(std) + np.asarray(mean)) * 255  # Rescale back to [0, 255]
         image_np = np.clip(image_np, 0, 255).astype(np.uint8)  # Ensure valid range and convert to uint8
 
         # Configure weak supervision mask and handle NaNs
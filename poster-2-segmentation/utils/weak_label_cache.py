@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# Bump when a sampler changes, so old cached masks are not reused
+WEAK_LABEL_VERSION = 1
+
+# The samplers in load_data.py always reseed with this value
+SAMPLER_SEED = 42
+
+UNKNOWN = 2
+
+
+def pack_weak_mask(new_mask):
+    """
+    Packs a weak supervision mask (0 background, 1 foreground, 2 unknown) into two bit planes:
+    which pixels are annotated and which of them are foreground. Uses 2 bits per pixel instead of 8.
+    """
+    new_mask = np.asarray(new_mask)
+    return {
+        'shape': np.asarray(new_mask.shape, dtype=np.int64),
+        'known': np.packbits((new_mask != UNKNOWN).ravel()),
+        'labels': np.packbits((new_mask == 1).ravel()),
+    }
+
+
+def unpack_weak_mask(packed):
+    """
+    Inverse of `pack_weak_mask`, returns a uint8 mask with 0, 1 and 2 for unknown.
+    """
+    shape = tuple(int(s) for s in packed['shape'])
+    count = int(np.prod(shape))
+    known = np.unpackbits(packed['known'], count=count).astype(bool)
+    labels = np.unpackbits(packed['labels'], count=count)
+
+    new_mask = np.full(count, UNKNOWN, dtype=np.uint8)
+    new_mask[known] = labels[known]
+    return new_mask.reshape(shape)
+
+
+def weak_label_key(sampling, num_clicks, radius):
+    """
+    Short hash of every parameter that changes the generated masks.
+    """
+    config = {
+        'sampling': sampling,
+        'num_clicks': int(num_clicks),
+        'radius': float(radius),
+        'seed': SAMPLER_SEED,
+        'version': WEAK_LABEL_VERSION,
+    }
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class WeakLabelCache:
+    """
+    Generates the weak supervision mask of every ground truth mask once per configuration (sampling strategy,
+    number of clicks, radius) and keeps it bit-packed in memory.
+
+    With a cache_dir the packed masks are also saved to `<cache_dir>/weak_labels_<key>/`, so later runs with the
+    same configuration only read them. A saved mask is regenerated when the size or modification time of its
+    ground truth file changed.
+    """
+    def __init__(self, sampling, num_clicks, radius, generate, cache_dir=None):
+        """
+        Parameters:
+        - sampling, num_clicks, radius: The configuration of the masks, part of the cache key.
+        - generate: Function mask_np -> weak mask (values 0, 1 and 2 for unknown).
+        - cache_dir: Directory for the saved masks, None to keep them in memory only.
+        """
+        self.key = weak_label_key(sampling, num_clicks, radius)
+        self.generate = generate
+        self.cache_dir = os.path.join(cache_dir, f'weak_labels_{self.key}') if cache_dir else None
+        self.packed = {}
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_path(self, mask_path):
+        name = os.path.splitext(os.path.basename(mask_path))[0]
+        return os.path.join(self.cache_dir, f'{name}.npz')
+
+    def _load(self, mask_path, source):
+        path = self._cache_path(mask_path)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as cached:
+            if not np.array_equal(cached['source'], source):
+                return None
+            return {name: cached[name] for name in ('shape', 'known', 'labels')}
+
+    def _save(self, mask_path, source, packed):
+        path = self._cache_path(mask_path)
+        tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+        np.savez(tmp_path, source=source, **packed)
+        os.replace(tmp_path, path)
+
+    def add(self, mask_path, load_mask):
+        """
+        Makes the weak mask of a ground truth mask available, generating it if it is not cached yet.
+        load_mask() returns the binary ground truth and is only called when the mask has to be generated.
+        """
+        if mask_path in self.packed:
+            return
+
+        stat = os.stat(mask_path)
+        source = np.asarray([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        packed = self._load(mask_path, source) if self.cache_dir else None
+        if packed is None:
+            packed = pack_weak_mask(self.generate(load_mask()))
+            if self.cache_dir:
+                self._save(mask_path, source, packed)
+
+        self.packed[mask_path] = packed
+
+    def get(self, mask_path):
+        """
+        Returns the weak mask of a ground truth mask added before, as uint8 with 2 for unknown.
+        """
+        return unpack_weak_mask(self.packed[mask_path])
+
+    def __len__(self):
+        return len(self.packed)
@@ -0,0 +1,120 @@
+import os
+import time
+import argparse
+import numpy as np
+import torch
+
+from torchvision import transforms
+from torchvision.transforms import functional as TF
+from models.models import ResNetTwoHeads
+from utils.load_data import ValAndTestDataset
+from utils.logger import logger
+
+
+def crop_inference(model, original_image, boxes, transform, device):
+    """
+    The original inference path: crop every proposal with PIL, resize it and run the full network on the crops.
+    """
+    crops = [transform(original_image.crop((x_min, y_min, x_max, y_max)))
+             for x_min, y_min, x_max, y_max in boxes.to(torch.int64).tolist()]
+    _, _, cls_probs = model.predict(torch.stack(crops).to(device))
+    return cls_probs[:, 1]
+
+
+def roi_inference(model, original_image, boxes, device):
+    """
+    The shared-backbone path: run the backbone once on the image and pool every proposal with RoIAlign.
+    """
+    image = TF.to_tensor(original_image).unsqueeze(0).to(device)
+    _, _, cls_probs = model.predict_rois(image, [boxes.to(device)])
+    return cls_probs[:, 1]
+
+
+def timed(fn, device, *args):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = fn(*args)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return result.cpu(), time.perf_counter() - start
+
+
+def main(args):
+    device = torch.device(args.device if args.device else ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    blackhole_path = os.getenv('BLACKHOLE')
+    if not blackhole_path:
+        raise EnvironmentError("The $BLACKHOLE environment variable is not set or is empty.")
+
+    model = ResNetTwoHeads()
+    if args.model_path:
+        model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model = model.to(device).eval()
+
+    transform = transforms.Compose([
+        transforms.Resize((256, 256)),
+        transforms.ToTensor(),
+    ])
+
+    # The benchmark crops the proposals itself, so the time of the crop path includes cropping and resizing
+    dataset = ValAndTestDataset(
+        base_dir=os.path.join(blackhole_path, 'DLCV'),
+        split=args.split,
+        orig_data_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Potholes'),
+        crop_proposals=False
+    )
+    num_images = min(args.num_images, len(dataset))
+    logger.info(f"Comparing crop and RoI inference on {num_images} {args.split} images ({device})")
+
+    crop_times, roi_times = [], []
+    crop_scores, roi_scores = [], []
+    top_agreement = []
+
+    with torch.no_grad():
+        # Warm up both paths (cuDNN autotuning, lazy allocations) so the first image does not dominate
+        original_image, _, boxes, _, _ = dataset[0]
+        crop_inference(model, original_image, boxes[:4], transform, device)
+        roi_inference(model, original_image, boxes[:4], device)
+
+        for i in range(num_images):
+            original_image, _, boxes, image_id, _ = dataset[i]
+
+            crop_probs, crop_time = timed(crop_inference, device, model, original_image, boxes, transform, device)
+            roi_probs, roi_time = timed(roi_inference, device, model, original_image, boxes, device)
+
+            crop_times.append(crop_time)
+            roi_times.append(roi_time)
+            crop_scores.append(crop_probs.numpy())
+            roi_scores.append(roi_probs.numpy())
+            top_agreement.append(int(crop_probs.argmax()) == int(roi_probs.argmax()))
+
+            print(f"[{i + 1}/{num_images}] {image_id}: {len(boxes)} proposals - "
+                  f"crops {1000 * crop_time:.1f} ms, RoI {1000 * roi_time:.1f} ms")
+
+    crop_scores = np.concatenate(crop_scores)
+    roi_scores = np.concatenate(roi_scores)
+    threshold_agreement = np.mean((crop_scores >= args.confidence_threshold) == (roi_scores >= args.confidence_threshold))
+    correlation = np.corrcoef(crop_scores, roi_scores)[0, 1] if len(crop_scores) > 1 else float('nan')
+
+    logger.info(
+        f"Latency per image - crops: {1000 * np.mean(crop_times):.1f} ms, RoI: {1000 * np.mean(roi_times):.1f} ms "
+        f"({np.mean(crop_times) / np.mean(roi_times):.1f}x faster)"
+    )
+    logger.info(
+        f"Parity over {len(crop_scores)} proposals - mean |p_crop - p_roi|: {np.mean(np.abs(crop_scores - roi_scores)):.4f}, "
+        f"correlation: {correlation:.4f}, same decision at {args.confidence_threshold}: {100 * threshold_agreement:.1f}%, "
+        f"same top proposal: {100 * np.mean(top_agreement):.1f}% of images"
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the crop based and the shared-backbone RoI inference of ResNetTwoHeads.")
+    parser.add_argument('--model_path', type=str, default=None, help='state_dict saved by main.py (random heads if not given)')
+    parser.add_argument('--split', type=str, default='val', choices=['val', 'test'])
+    parser.add_argument('--num_images', type=int, default=20, help='Number of images to benchmark')
+    parser.add_argument('--confidence_threshold', type=float, default=0.5, help='Threshold for the decision agreement')
+    parser.add_argument('--device', type=str, default=None, help='cuda or cpu (defaults to cuda when available)')
+    args = parser.parse_args()
+
+    main(args)
@@ -15,4 +15,4 @@ source ~/venv/project2_venv/bin/activate
 
 
 # Run the Python script
-python /zhome/26/8/209207/02516-intro-to-dl-in-cv/poster-3-object-detection/preprocessing.py
+python /zhome/26/8/209207/02516-intro-to-dl-in-cv/poster-3-object-detection/preprocessing.py --num_workers $LSB_DJOB_NUMPROC
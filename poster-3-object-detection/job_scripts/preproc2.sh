@@ -14,4 +14,4 @@ source /dtu/blackhole/0a/203690/miniconda3/bin/activate
 conda activate project-3
 
 # Run the Python script
-python preprocessing.py
+python preprocessing.py --num_workers $LSB_DJOB_NUMPROC
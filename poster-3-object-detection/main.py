@@ -7,7 +7,9 @@ from torch.utils.data import DataLoader
 from torchvision import transforms
 from models.models import ResNetTwoHeads
 from models.train import train_model, evaluate_model
-from utils.load_data import Trainingset, ValAndTestDataset, collate_fn, val_test_collate_fn_cropped
+from utils.load_data import Trainingset, ValAndTestDataset, EvalPrefetcher, collate_fn, val_test_collate_fn_cropped
+from utils.feature_cache import build_feature_cache, CachedFeatureset
+from utils.proposal_sampler import ProposalBatchSampler, ProposalBatchset
 from utils.logger import logger
 from utils.visualize import visualize_predictions, visualize_pred_training_data
 import torch
@@ -36,10 +38,10 @@ def main(args):
 
     # Load Training Data
     logger.working_on("Loading Train data")
+    # The training crops are already resized, they are converted to float per batch in train_model
     train_dataset = Trainingset(
-        image_dir=os.path.join(blackhole_path, 'DLCV/training_data/images'), 
-        target_dir=os.path.join(blackhole_path, 'DLCV/training_data/targets'), 
-        transform=transform
+        crop_store_path=os.path.join(blackhole_path, 'DLCV/train_crops.index.json'), 
+        store_path=os.path.join(blackhole_path, 'DLCV/train_proposals.store')
     )
 
     # Load Validation Data
@@ -48,7 +50,10 @@ def main(args):
         base_dir=os.path.join(blackhole_path,'DLCV'),
         split='val', 
         transform=transform,
-        orig_data_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Potholes')
+        orig_data_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Potholes'),
+        # The crops of all proposals are cut and resized from the decoded image in one roi_align call on the GPU
+        crop_size=(256, 256),
+        as_tensors=True
     )
 
     logger.working_on("Loading Test data")
@@ -56,7 +61,11 @@ def main(args):
         base_dir=os.path.join(blackhole_path,'DLCV'),
         split='test', 
         transform=transform,
-        orig_data_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Potholes')
+        orig_data_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Potholes'),
+        crop_size=(256, 256),
+        as_tensors=True,
+        # Only the test split skips the crops, the validation loss during training still needs the validation crops
+        crop_proposals=not args.roi_inference
     )
     assert len(train_dataset) != 0, "Training data not loaded correctly"
     assert len(val_dataset) != 0, "Validation data not loaded correctly"
@@ -104,28 +113,63 @@ def main(args):
         test_subset = test_dataset
         logger.info("Using the entire dataset for training and validation.")
 
+    # Optionally train on cached features of the frozen backbone instead of the crops
+    if args.feature_cache:
+        logger.working_on("Building the backbone feature cache")
+        feature_cache_path = build_feature_cache(
+            model, os.path.join(blackhole_path, 'DLCV/train_crops.index.json'),
+            os.path.join(blackhole_path, 'DLCV/feature_cache')
+        )
+        feature_dataset = CachedFeatureset(feature_cache_path, os.path.join(blackhole_path, 'DLCV/train_proposals.store'))
+        train_features = Subset(feature_dataset, train_subset.indices) if isinstance(train_subset, Subset) else feature_dataset
+
     # Create DataLoaders
+    # The store keeps every labeled proposal, the sampler balances them online: fixed-size batches of proposals
+    # drawn across the images, or one balanced batch per image. The workers prefetch whole batches
+    train_source = train_features if args.feature_cache else train_subset
+    proposal_dataset = train_source.dataset if isinstance(train_source, Subset) else train_source
+    proposal_sampler = ProposalBatchSampler(
+        proposal_dataset.store.labels,
+        offsets=proposal_dataset.store.offsets,
+        image_indices=train_source.indices if isinstance(train_source, Subset) else None,
+        batch_size=args.proposal_batch_size,
+        positive_fraction=args.positive_fraction,
+        per_image=not args.proposal_batch_size,
+        hard_negative_fraction=args.hard_negative_fraction,
+        seed=RANDOM_SEED
+    )
+    logger.info(f"Sampling {len(proposal_sampler)} {'batches of ' + str(args.proposal_batch_size) + ' proposals' if args.proposal_batch_size else 'balanced images'} "
+                f"per epoch ({len(proposal_sampler.positives)} positives, {len(proposal_sampler.negatives)} negatives)")
     train_loader = DataLoader(
-        train_subset, 
-        batch_size=1, 
-        shuffle=True, 
-        num_workers=4, 
-        collate_fn=collate_fn
+        ProposalBatchset(proposal_dataset),
+        sampler=proposal_sampler,
+        batch_size=None,
+        num_workers=4,
+        pin_memory=True,
+        persistent_workers=True
     )
 
-    val_loader = DataLoader(
+    # Workers decode the next images while the model runs, the prefetcher copies them to the GPU ahead of time
+    eval_device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    val_loader = EvalPrefetcher(DataLoader(
         val_subset, 
         batch_size=1, 
         shuffle=False, 
+        num_workers=args.eval_workers,
+        pin_memory=True,
+        persistent_workers=args.eval_workers > 0,
         collate_fn=val_test_collate_fn_cropped
-    )
+    ), eval_device, name='val')
 
-    test_loader = DataLoader(
+    test_loader = EvalPrefetcher(DataLoader(
         test_subset, 
         batch_size=1, 
         shuffle=False, 
+        num_workers=args.eval_workers,
+        pin_memory=True,
+        persistent_workers=args.eval_workers > 0,
         collate_fn=val_test_collate_fn_cropped
-    )
+    ), eval_device, name='test')
 
     # Loss and Optimizer
     criterion_cls = nn.CrossEntropyLoss()
@@ -140,7 +184,11 @@ def main(args):
         iou_threshold=args.confidence_threshold, 
         cls_weight=args.cls_weight, 
         reg_weight=args.reg_weight, 
-        experiment_name=args.experiment_name
+        experiment_name=args.experiment_name,
+        cached_features=args.feature_cache,
+        confidence_threshold=args.confidence_threshold,
+        nms_iou_threshold=args.iou_threshold,
+        proposal_sampler=proposal_sampler if args.hard_negative_fraction > 0 else None
     )
 
     # Visualize Predictions
@@ -151,10 +199,13 @@ def main(args):
         use_nms=True,  # Set to False to display all proposals
         iou_threshold=args.iou_threshold,  # For NMS, overlapping boxes with 0.3 IoU will get filtered (the better one will stay)
         num_images=args.num_images,
-        experiment_name=args.experiment_name
+        experiment_name=args.experiment_name,
+        roi_inference=args.roi_inference
     )
+    # The visualization needs the crops of one image per batch, also when training on cached features
+    train_crop_loader = DataLoader(train_subset, batch_size=1, shuffle=True, collate_fn=collate_fn)
     visualize_pred_training_data(
-        model, train_loader, use_nms=True, iou_threshold=args.iou_threshold, 
+        model, train_crop_loader, use_nms=True, iou_threshold=args.iou_threshold, 
         num_images=5, experiment_name=args.experiment_name
     )
 
@@ -181,7 +232,8 @@ def main(args):
         split='val',
         experiment_name=args.experiment_name, 
         iou_threshold=args.iou_threshold, 
-        confidence_threshold=args.confidence_threshold
+        confidence_threshold=args.confidence_threshold,
+        roi_inference=args.roi_inference
     )
 
     print(f"precision: {precision}")
@@ -196,7 +248,8 @@ def main(args):
         split='test',
         experiment_name=args.experiment_name, 
         iou_threshold=args.iou_threshold, 
-        confidence_threshold=args.confidence_threshold
+        confidence_threshold=args.confidence_threshold,
+        roi_inference=args.roi_inference
     )
 
     print(f"precision: {precision}")
@@ -219,6 +272,16 @@ if __name__ == "__main__":
     parser.add_argument('--weight_decay', type=float, default=1e-5, help='Weight decay for the optimizer')
     parser.add_argument('--cls_weight', type=float, default=1.0, help='Weight for classification loss')
     parser.add_argument('--reg_weight', type=float, default=1.0, help='Weight for regression loss')
+    parser.add_argument('--feature_cache', action='store_true',
+                        help='Compute the features of the frozen backbone once and train only the shared layer and the heads on them')
+    parser.add_argument('--roi_inference', action='store_true',
+                        help='Run the backbone once per image and pool the proposals from its feature map (RoIAlign) for evaluation and visualization')
+    parser.add_argument('--eval_workers', type=int, default=4, help='DataLoader workers for the validation and test images')
+    parser.add_argument('--proposal_batch_size', type=int, default=0,
+                        help='Train on fixed-size batches of this many proposals drawn across the images (e.g. 128), 0 for one balanced image per batch')
+    parser.add_argument('--positive_fraction', type=float, default=0.25, help='Fraction of positive proposals in every batch')
+    parser.add_argument('--hard_negative_fraction', type=float, default=0.0,
+                        help='Fraction of the negatives of every batch picked by the highest pothole probability of the classifier')
 
     # New mutually exclusive arguments for subset selection
     group = parser.add_mutually_exclusive_group()
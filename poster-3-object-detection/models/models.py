@@ -1,6 +1,7 @@
 import torch.nn as nn
 import torch
 from torchvision import models
+from torchvision.ops import roi_align
 
 
 
@@ -88,6 +89,12 @@ class ResNetTwoHeads(nn.Module):
         # Backbone features
         features = self.backbone(x)
 
+        return self.heads(features)
+
+    def heads(self, features):
+        """
+        Runs the shared fully connected layer and the two heads on N x 512 backbone features.
+        """
         # Shared fully connected layer
         shared_features = self.shared_fc(features)
 
@@ -100,4 +107,57 @@ class ResNetTwoHeads(nn.Module):
     def predict(self, x):
         cls, bbox_transforms = self.forward(x)
         cls_probs = torch.softmax(cls, dim=1)  # Convert logits to probabilities
-        return cls, bbox_transforms, cls_probs
\ No newline at end of file
+        return cls, bbox_transforms, cls_probs
+
+    def feature_map(self, images):
+        """
+        Runs the backbone up to the last convolutional stage, i.e. without the global average pooling.
+        Returns a B x 512 x H/32 x W/32 feature map.
+        """
+        b = self.backbone
+        x = b.maxpool(b.relu(b.bn1(b.conv1(images))))
+        return b.layer4(b.layer3(b.layer2(b.layer1(x))))
+
+    def forward_rois(self, images, boxes, roi_size=8):
+        """
+        Shared-backbone inference: the backbone runs once per image and the features of every proposal are
+        pooled from the shared feature map with RoIAlign, instead of running the backbone on every resized crop.
+
+        The pooled roi_size x roi_size features are averaged like the global pooling of the crop path (a
+        256 x 256 crop gives an 8 x 8 map), so the heads see features of the same shape. The values are not
+        identical to `forward` on the crops, see benchmark_roi_inference.py for the comparison.
+
+        Parameters:
+        -----------
+        images : torch.Tensor
+            A B x 3 x H x W batch of full images, preprocessed like the crops (e.g. `transforms.ToTensor`).
+
+        boxes : list of torch.Tensor or torch.Tensor
+            One K_i x 4 tensor of (xmin, ymin, xmax, ymax) boxes per image in pixel coordinates of `images`,
+            or a K x 5 tensor where the first column is the index of the image in the batch.
+
+        roi_size : int
+            Size of the pooled feature map of every proposal.
+
+        Returns:
+        --------
+        tuple
+            - cls : K x num_classes logits, in the order of the boxes.
+            - bbox_transforms : K x 4 predicted (tx, ty, tw, th).
+        """
+        feature_map = self.feature_map(images)
+        if isinstance(boxes, (list, tuple)):
+            boxes = [b.to(device=feature_map.device, dtype=feature_map.dtype) for b in boxes]
+        else:
+            boxes = boxes.to(device=feature_map.device, dtype=feature_map.dtype)
+
+        # The ResNet downsamples by 32, sampling_ratio=2 matches what the 8 x 8 map of a 256 x 256 crop sees
+        pooled = roi_align(feature_map, boxes, output_size=roi_size, spatial_scale=1.0 / 32, sampling_ratio=2, aligned=True)
+        features = torch.flatten(self.backbone.avgpool(pooled), 1)
+
+        return self.heads(features)
+
+    def predict_rois(self, images, boxes, roi_size=8):
+        cls, bbox_transforms = self.forward_rois(images, boxes, roi_size)
+        cls_probs = torch.softmax(cls, dim=1)  # Convert logits to probabilities
+        return cls, bbox_transforms, cls_probs
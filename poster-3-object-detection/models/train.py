@@ -2,11 +2,14 @@ import datetime
 import numpy as np
 import torch
 from utils.logger import logger
-from torchvision.ops import box_iou
+from utils.box_ops import box_iou
+from utils.crop_store import prepare_crops
+from utils.box_coder import BoxCoder
+from utils.load_data import image_size, image_to_tensor
 import matplotlib.pyplot as plt
 import os
-from utils.metrics import non_max_suppression
-from utils.metrics import calculate_precision_recall, calculate_mAP, non_max_suppression
+from utils.detection_eval import DetectionEvaluator, IOU_THRESHOLDS
+from utils.nms import nms
 from torchvision.transforms import ToTensor
 import wandb
 
@@ -18,8 +21,22 @@ def starts(n):
 def train_model(
     model, train_loader, val_loader, criterion_cls, criterion_bbox,
     optimizer, num_epochs=1, iou_threshold=0.5, cls_weight=1, reg_weight=1, 
-    experiment_name="experiment", patience=10, min_delta=1e-4
+    experiment_name="experiment", patience=10, min_delta=1e-4, cached_features=False,
+    confidence_threshold=0.5, nms_iou_threshold=0.5, proposal_sampler=None
 ):
+    """
+    Trains the model and reports the validation loss after every epoch.
+
+    The validation pass also feeds the detections (confidence_threshold, bbox refinement and NMS with
+    nms_iou_threshold, as in `evaluate_model`) into a `DetectionEvaluator`, so the AP of every epoch is logged
+    without a second pass over the validation set.
+
+    With cached_features=True the train_loader yields precomputed backbone features (see
+    utils/feature_cache.py) instead of crops, and only the shared layer and the heads of the model are run.
+
+    With a `ProposalBatchSampler` as proposal_sampler (and a `ProposalBatchset` train_loader), the pothole
+    probabilities of every training batch are passed back to the sampler for hard negative mining.
+    """
     
     wandb.init(
         project="object_detection",  # Set your W&B project name
@@ -29,10 +46,14 @@ def train_model(
             "iou_threshold": iou_threshold,
             "cls_weight": cls_weight,
             "reg_weight": reg_weight,
-            "learning_rate": optimizer.param_groups[0]['lr']
+            "learning_rate": optimizer.param_groups[0]['lr'],
+            "cached_features": cached_features
         }
     )    
 
+    box_coder = BoxCoder()
+    evaluator = DetectionEvaluator()
+
     train_losses = []
     val_losses = []
 
@@ -51,35 +72,35 @@ def train_model(
         bbox_running_loss = 0.0
 
         for images, targets, idx in train_loader:
-            images = images.cuda()
-            targets_cls = torch.tensor([t['label'] for t in targets]).cuda()
+            if cached_features:
+                features = images.cuda(non_blocking=True).float()
+            else:
+                images = prepare_crops(images, device='cuda')
+            targets_cls = targets['labels'].cuda()
 
             # Find positive proposals
-            fg_indices = [i for i, t in enumerate(targets) if t['label'] == 1]
+            fg_indices = torch.nonzero(targets['labels'] == 1).squeeze(1)
 
             # Compute bounding box transforms for positive proposals
-            fg_bbox_transforms = []
-            for i in fg_indices:
-                t = targets[i]
-                tx = (t['gt_bbox_xmin'] - t['image_xmin']) / (t['image_xmax'] - t['image_xmin'])
-                ty = (t['gt_bbox_ymin'] - t['image_ymin']) / (t['image_ymax'] - t['image_ymin'])
-                tw = torch.log((t['gt_bbox_xmax'] - t['gt_bbox_xmin']) / (t['image_xmax'] - t['image_xmin']))
-                th = torch.log((t['gt_bbox_ymax'] - t['gt_bbox_ymin']) / (t['image_ymax'] - t['image_ymin']))
-                fg_bbox_transforms.append(torch.tensor([tx, ty, tw, th]))
-
-            fg_bbox_transforms = torch.stack(fg_bbox_transforms).cuda() if fg_bbox_transforms else torch.empty((0, 4)).cuda()
+            fg_bbox_transforms = box_coder.encode(targets['boxes'][fg_indices], targets['gt_boxes'][fg_indices]).cuda()
 
 
             # Forward pass
             optimizer.zero_grad()
-            outputs_cls, outputs_bbox_transforms = model(images)
+            if cached_features:
+                outputs_cls, outputs_bbox_transforms = model.heads(features)
+            else:
+                outputs_cls, outputs_bbox_transforms = model(images)
+
+            if proposal_sampler is not None:
+                proposal_sampler.update_scores(targets['rows'].numpy(), outputs_cls.detach().softmax(dim=1)[:, 1].float().cpu().numpy())
 
             # Classification Loss
             loss_cls = criterion_cls(outputs_cls, targets_cls)
             cls_running_loss += cls_weight * loss_cls.item()
 
             # Regression Loss
-            if fg_indices:
+            if len(fg_indices) > 0:
                 outputs_bbox_fg = outputs_bbox_transforms[fg_indices]
                 loss_bbox = criterion_bbox(outputs_bbox_fg, fg_bbox_transforms)
             else:
@@ -118,56 +139,55 @@ def train_model(
         val_bbox_loss = 0.0
         total_proposals = 0
         total_positive_proposals = 0
+        evaluator.reset()
 
         with torch.no_grad():
             for images, proposal_images_list, coords, image_ids, ground_truths in val_loader:
                 proposals = coords[0]
 
-                gt_boxes = torch.stack([torch.tensor([gt['xmin'], gt['ymin'], gt['xmax'], gt['ymax']]) for gt in ground_truths[0]]).cuda()
-                proposal_boxes = torch.stack([torch.tensor([t['xmin'], t['ymin'], t['xmax'], t['ymax']]) for t in proposals]).cuda()
+                gt_boxes = ground_truths[0].cuda()
+                proposal_boxes = proposals.cuda()
 
                 # Compute IoU
                 ious = box_iou(proposal_boxes, gt_boxes)
                 max_ious, matched_gt_indices = ious.max(dim=1)
 
                 # Process proposals
-                proposal_images = torch.stack(proposal_images_list[0]).cuda() # num_proposals x 3 x 256 x 256
+                proposal_images = proposal_images_list[0].cuda() # num_proposals x 3 x 256 x 256
                 outputs_cls, outputs_bbox_transforms = model(proposal_images)
 
                 assert outputs_cls.shape[1] == 2, "Must be two, (Logit for background and for pothole)"
 
-                for i in range(proposal_boxes.size(0)):
-                    total_proposals += 1
-                    pred_cls_logits = outputs_cls[i]
-                    pred_bbox = outputs_bbox_transforms[i]
-
-                    cls_probs = torch.softmax(pred_cls_logits, dim=0)
-                    pred_class = torch.argmax(cls_probs).item()
-
-                    iou = max_ious[i].item()
-                    matched_gt_idx = matched_gt_indices[i].item() if iou >= iou_threshold else None
-                    has_match = iou >= iou_threshold
-                    target_cls = 1 if has_match else 0
-
-                    loss_cls = criterion_cls(pred_cls_logits.unsqueeze(0), torch.tensor([target_cls]).cuda())
-                    val_cls_loss += cls_weight * loss_cls.item()
-
-                    if has_match:
-                        total_positive_proposals += 1
-                        gt_box = gt_boxes[matched_gt_idx]
-                        tx = (gt_box[0] - proposal_boxes[i, 0]) / (proposal_boxes[i, 2] - proposal_boxes[i, 0])
-                        ty = (gt_box[1] - proposal_boxes[i, 1]) / (proposal_boxes[i, 3] - proposal_boxes[i, 1])
-                        tw = torch.log((gt_box[2] - gt_box[0]) / (proposal_boxes[i, 2] - proposal_boxes[i, 0]))
-                        th = torch.log((gt_box[3] - gt_box[1]) / (proposal_boxes[i, 3] - proposal_boxes[i, 1]))
-                        target_bbox = torch.tensor([tx, ty, tw, th]).cuda()
-
-                        loss_bbox = criterion_bbox(pred_bbox.unsqueeze(0), target_bbox.unsqueeze(0))
-                        val_bbox_loss += reg_weight * loss_bbox.item()
+                # Proposals overlapping a ground truth box with at least iou_threshold are positives
+                has_match = max_ious >= iou_threshold
+                target_cls = has_match.long()
+                num_proposals = proposal_boxes.size(0)
+                num_positive = int(has_match.sum())
+
+                # One loss call per image. The criteria average over the batch, so multiplying by the number of
+                # rows gives the sum of the per proposal losses, which is averaged over all images below
+                loss_cls = criterion_cls(outputs_cls, target_cls)
+                val_cls_loss += cls_weight * loss_cls.item() * num_proposals
+                total_proposals += num_proposals
+
+                if num_positive > 0:
+                    target_bbox = box_coder.encode(proposal_boxes[has_match], gt_boxes[matched_gt_indices[has_match]])
+                    loss_bbox = criterion_bbox(outputs_bbox_transforms[has_match], target_bbox)
+                    val_bbox_loss += reg_weight * loss_bbox.item() * num_positive
+                    total_positive_proposals += num_positive
+
+                # Detection metrics from the same forward pass
+                boxes, scores = postprocess_detections(
+                    outputs_cls, outputs_bbox_transforms, proposals, image_size(images[0]), box_coder,
+                    confidence_threshold, nms_iou_threshold
+                )
+                evaluator.update((boxes, scores), ground_truths[0])
 
         avg_val_cls_loss = val_cls_loss / total_proposals if total_proposals > 0 else 0.0
         avg_val_bbox_loss = val_bbox_loss / total_positive_proposals if total_positive_proposals > 0 else 0.0
         avg_val_loss = avg_val_cls_loss + avg_val_bbox_loss
         val_losses.append(avg_val_loss)
+        val_metrics = evaluator.compute()
 
         # Early stopping check
         if avg_val_loss < best_val_loss - min_delta:
@@ -179,14 +199,18 @@ def train_model(
         logger.info(
             f"Epoch {epoch + 1}/{num_epochs} - "
             f"Train Loss: {avg_train_loss:.4f} (Cls: {avg_train_cls_loss:.4f}, Reg: {avg_train_bbox_loss:.4f}) - "
-            f"Val Loss: {avg_val_loss:.4f} (Cls: {avg_val_cls_loss:.4f}, Reg: {avg_val_bbox_loss:.4f})"
+            f"Val Loss: {avg_val_loss:.4f} (Cls: {avg_val_cls_loss:.4f}, Reg: {avg_val_bbox_loss:.4f}) - "
+            f"Val AP@[.50:.95]: {val_metrics['map']:.4f}, AP@.50: {val_metrics['ap50']:.4f}"
         )
 
                 # Log validation metrics to W&B
         wandb.log({
             "val/cls_loss": avg_val_cls_loss,
             "val/bbox_loss": avg_val_bbox_loss,
-            "val/total_loss": avg_val_loss
+            "val/total_loss": avg_val_loss,
+            "val/mAP": val_metrics['map'],
+            "val/AP50": val_metrics['ap50'],
+            "val/AP75": val_metrics['ap75']
         })
 
         # Stop training if patience is exceeded
@@ -229,7 +253,45 @@ def train_model(
     plt.savefig(os.path.join(figures_dir_svg, "loss_curve.svg"), format='svg', bbox_inches='tight')
 
 
-def evaluate_model(model, val_loader, split="val", iou_threshold=0.5, confidence_threshold=0.8, experiment_name="experiment"):
+def predict_proposals(model, original_image, proposal_images, proposal_boxes, device, roi_inference=False):
+    """
+    Runs the model on the proposals of one image and returns the logits and the bbox transforms.
+
+    With roi_inference=False every proposal crop goes through the full network. With roi_inference=True the
+    backbone runs once on the original image and the proposals are pooled from its feature map
+    (`ResNetTwoHeads.forward_rois`), the crops are not used.
+    """
+    if roi_inference:
+        image = image_to_tensor(original_image, device)
+        return model.forward_rois(image, [proposal_boxes.to(device)])
+
+    return model(proposal_images.to(device))
+
+
+def postprocess_detections(outputs_cls, outputs_bbox_transforms, proposals, image_size, box_coder,
+                           confidence_threshold=0.5, nms_iou_threshold=0.5, apply_bbox_deltas=True):
+    """
+    Turns the model outputs for the proposals of one image into detections.
+
+    The proposals are refined with the predicted bbox transforms (clipped to the image of size
+    (width, height)), proposals with a pothole probability below `confidence_threshold` are dropped and NMS
+    removes overlapping boxes. Returns the boxes (K x 4) and scores (K) on the CPU, sorted by decreasing score.
+    """
+    scores = torch.softmax(outputs_cls.detach().float(), dim=1)[:, 1].cpu()  # Get pothole scores
+    boxes = proposals.detach().float().cpu()
+    if apply_bbox_deltas:
+        boxes = box_coder.decode(boxes, outputs_bbox_transforms.detach().float().cpu(), image_size=image_size)
+
+    # Filter out low-confidence proposals
+    mask = scores >= confidence_threshold
+    boxes, scores = boxes[mask], scores[mask]
+
+    keep = nms(boxes, scores, iou_threshold=nms_iou_threshold)
+    return boxes[keep], scores[keep]
+
+
+def evaluate_model(model, val_loader, split="val", iou_threshold=0.5, confidence_threshold=0.8, experiment_name="experiment",
+                   roi_inference=False, apply_bbox_deltas=True):
     # Set model to evaluation mode
 
     # Define custom colors
@@ -239,82 +301,44 @@ def evaluate_model(model, val_loader, split="val", iou_threshold=0.5, confidence
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model.to(device)
 
-    # Lists to store per-image ground truths and predictions
-    ground_truths = []  # List[List[Dict]]
-    predictions = []    # List[List[Dict]]
+    # The evaluator only keeps the score and the true positive flags of every prediction
+    iou_thresholds = np.append(iou_threshold, IOU_THRESHOLDS)
+    evaluator = DetectionEvaluator(iou_thresholds)
+
+    box_coder = BoxCoder()
 
     with torch.no_grad():
         for images, proposal_images_list, coords, image_ids, ground_truths_batch in val_loader:
             batch_size = len(image_ids)
             # For each image in the batch
             for idx in range(batch_size):
-                image_id = image_ids[idx]
-                # Process ground truths for this image
-                gt_boxes = []
-                for gt in ground_truths_batch[idx]:
-                    xmin = gt.get('xmin').item()
-                    ymin = gt.get('ymin').item()
-                    xmax = gt.get('xmax').item()
-                    ymax = gt.get('ymax').item()
-                    gt_boxes.append({
-                        'xmin': xmin,
-                        'ymin': ymin,
-                        'xmax': xmax,
-                        'ymax': ymax
-                    })
-                ground_truths.append(gt_boxes)
-                
-                # Get proposals for the image
-                proposal_images = torch.stack(proposal_images_list[idx]).to(device)
-
-                outputs_cls, outputs_bbox_transforms = model(proposal_images)
-
-                # Convert outputs to CPU numpy arrays
-                outputs_cls = outputs_cls.detach().cpu()
-                outputs_bbox_transforms = outputs_bbox_transforms.detach().cpu()
-
-                # Process outputs 
-                scores = torch.softmax(outputs_cls, dim=1)[:, 1]  # Get pothole scores
-                boxes = coords[idx]  # coords for this image
-                # After computing scores in evaluate_model
-                #print(f"Scores before thresholding: {scores}")
-
-
-                # Filter out low-confidence proposals
-                mask = scores >= confidence_threshold
-                scores = scores[mask]
-                boxes = [boxes[i] for i in range(len(boxes)) if mask[i]]
-                #print(f"Number of scores before thresholding: {len(scores)}")
-
-                if len(scores) == 0:
-                    predictions.append([])  # No predictions for this image
-                    continue
-
-                # Prepare predictions for this image
-                pred_boxes = []
-                for i in range(len(scores)):
-                    pred_boxes.append({
-                        'pre_class': float(scores[i]),
-                        'pre_bbox_xmin': float(boxes[i]['xmin']),
-                        'pre_bbox_ymin': float(boxes[i]['ymin']),
-                        'pre_bbox_xmax': float(boxes[i]['xmax']),
-                        'pre_bbox_ymax': float(boxes[i]['ymax']),
-                    })
-                # Apply NMS using your provided function
-                nms_results = non_max_suppression(pred_boxes, iou_threshold=iou_threshold)
-
-                predictions.append(nms_results)
+                # Get predictions for the proposals of the image
+                outputs_cls, outputs_bbox_transforms = predict_proposals(
+                    model, images[idx], proposal_images_list[idx], coords[idx], device, roi_inference
+                )
+
+                # Thresholded, refined and suppressed detections of the image
+                boxes, scores = postprocess_detections(
+                    outputs_cls, outputs_bbox_transforms, coords[idx], image_size(images[idx]), box_coder,
+                    confidence_threshold, iou_threshold, apply_bbox_deltas
+                )
+                evaluator.update((boxes, scores), ground_truths_batch[idx])
 
     # After processing all batches
-    # Now calculate precision and recall
-    precision_values, recall_values = calculate_precision_recall(ground_truths, predictions, iou_threshold)
-
-    # Calculate mAP
-    mAP = calculate_mAP(precision_values, recall_values)
-
-    # Convert precision and recall lists to numpy arrays for plotting
-    precision = np.array(precision_values)
-    recall = np.array(recall_values)
+    # The predictions were matched once for the requested threshold and for 0.5:0.95
+    results = evaluator.compute()
+
+    # The AP, precision and recall at the requested threshold (first row)
+    mAP = float(results['ap'][0])
+    precision = results['precision'][0]
+    recall = results['recall'][0]
+
+    ap_coco = results['ap'][1:]
+    logger.info(
+        f"{split}: AP@{iou_threshold:.2f}: {mAP:.4f}, AP@[.50:.95]: {ap_coco.mean():.4f}, "
+        f"AP@.50: {ap_coco[0]:.4f}, AP@.75: {ap_coco[5]:.4f} "
+        f"({results['num_predictions']} predictions, {results['num_gt']} ground truth boxes)"
+    )
 
     # Save Precision-Recall curve with unique filename
 
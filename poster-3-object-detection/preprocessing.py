@@ -1,12 +1,24 @@
 import os
+import re
 import json
-import pickle
 import random
 import glob
 import sys
+import time
+import hashlib
+import argparse
+import cv2
+import torch
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
-from utils.load_data import get_xml_data, pickle_save, class_balance, save_ground_truth
+from utils.load_data import (
+    atomic_write_json,
+    make_proposal_record, save_proposal_record, build_proposal_store, proposal_record_path
+)
+from utils.crop_store import crops_to_array, save_crops, write_crop_store
+from utils.proposal_store import ProposalStore
+from utils.annotation_index import build_annotation_index
 from utils.selective_search import generate_proposals_and_targets_for_training, generate_proposals_for_test_and_val
 from torchvision import transforms
 from utils.logger import logger
@@ -16,11 +28,206 @@ def ensure_dir(directory):
         print(f"Directiory {(directory)} does not exists, Creating directory: ", directory)
         os.makedirs(directory)
 
+
+def parameter_hash(params):
+    """
+    Returns a short hash of every parameter that changes the generated proposals, so outputs produced with
+    other settings are not mistaken for finished work.
+    """
+    encoded = json.dumps(params, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:12]
+
+
+def done_marker_path(targets_dir, image_id, params_hash):
+    return os.path.join(targets_dir, '.done', f'{image_id}-{params_hash}.json')
+
+
+def crops_path(images_dir, image_id, params_hash):
+    return os.path.join(images_dir, f'train_crops_{image_id}-{params_hash}.npy')
+
+
+def remove_other_outputs(job):
+    """
+    Removes the done markers of the image for other parameters, together with the records and crops they
+    describe, so a marker never outlives the outputs it stands for.
+    """
+    markers_dir = os.path.join(job['targets_dir'], '.done')
+    if not os.path.isdir(markers_dir):
+        return
+
+    # Image ids can contain '-', so only names ending in another 12 hex digit hash belong to this image
+    pattern = re.compile(rf"^{re.escape(job['image_id'])}-([0-9a-f]{{12}})\.json$")
+    for name in os.listdir(markers_dir):
+        match = pattern.match(name)
+        if match is None or match.group(1) == job['params_hash']:
+            continue
+        other_hash = match.group(1)
+        paths = [os.path.join(markers_dir, name),
+                 proposal_record_path(job['targets_dir'], job['split'], job['image_id'], other_hash)]
+        # Only the training split has crops (the other splits run without an images_dir)
+        if job['images_dir'] is not None:
+            paths.append(crops_path(job['images_dir'], job['image_id'], other_hash))
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def init_worker():
+    # Every process handles one image at a time, so avoid oversubscribing the cores with library threads
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+
+
+def process_image(job):
+    """
+    Generates the proposals for one image and saves them. Runs inside a worker process.
+
+    The proposals are saved as a small per-image record (see `make_proposal_record`) which `run_split` later
+    collects into the proposal store of the split. Training images also save the crops of all their labeled
+    proposals as one n x 256 x 256 x 3 uint8 array, which `run_split` collects into the crop store. Both file
+    names contain the parameter hash, and the outputs of other parameters are removed when an image is redone.
+
+    Returns a tuple (image_id, status, seconds) where status is 'done', 'empty' (no labeled proposals) or
+    'skipped' (the outputs already exist for the same parameters).
+    """
+    split = job['split']
+    image_id = job['image_id']
+    params = job['params']
+    marker_path = done_marker_path(job['targets_dir'], image_id, job['params_hash'])
+
+    if not job['force'] and os.path.exists(marker_path):
+        return image_id, 'skipped', 0.0
+
+    start = time.perf_counter()
+    remove_other_outputs(job)
+
+    # Training crops are kept as uint8, the conversion to float happens per batch during training
+    transform = transforms.Compose([
+        transforms.Resize((256, 256)),
+        transforms.PILToTensor() if split == 'train' else transforms.ToTensor(),
+        ])
+
+    original_image = Image.open(job['image_path']).convert('RGB')
+    original_targets = job['ground_truth']
+    status = 'done'
+    record_path = proposal_record_path(job['targets_dir'], split, image_id, job['params_hash'])
+    image_crops_path = crops_path(job['images_dir'], image_id, job['params_hash']) if split == 'train' else None
+
+    if split == 'train':
+        # Generate proposals and targets
+        proposal_images, proposal_targets = generate_proposals_and_targets_for_training(
+            original_image, original_targets, transform, image_id,
+            params['iou_upper_limit'], params['iou_lower_limit'], params['method'], params['max_proposals'],
+            generate_target=True
+        )
+        # Every labeled proposal is kept, the balancing happens online during training (utils/proposal_sampler.py)
+        if len(proposal_images) > 0:
+            # The crops are saved in the same order as the rows of the record
+            save_crops(crops_to_array(proposal_images), image_crops_path)
+            save_proposal_record(make_proposal_record(image_id, proposal_targets, original_targets), record_path)
+        else:
+            status = 'empty'
+            # Drop the outputs left over from an interrupted run
+            for path in (record_path, image_crops_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    else:
+        # Generate proposals, only the validation split knows the targets
+        _, proposal_targets = generate_proposals_for_test_and_val(
+            original_image, original_targets, transform, image_id,
+            params['iou_upper_limit'], params['iou_lower_limit'], params['method'], params['max_proposals'],
+            generate_target=(split == 'val'), return_images=False
+        )
+
+        # Save the proposals together with the ground truth (original_targets)
+        save_proposal_record(make_proposal_record(image_id, proposal_targets, original_targets), record_path)
+
+    seconds = time.perf_counter() - start
+
+    # The marker is written last, so an interrupted image is always redone on the next run
+    os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+    atomic_write_json({'image_id': image_id, 'status': status, 'seconds': seconds, 'params': params}, marker_path)
+
+    return image_id, status, seconds
+
+
+def run_split(split, files, images_folder, images_dir, targets_dir, store_path, params, num_workers, annotations,
+              force=False, crop_store_path=None):
+    """
+    Runs `process_image` for every file of a split on a process pool and reports the per-image timing.
+    The ground truth of every image comes from the annotation index (annotations), the XML files are not parsed again.
+    Afterwards the records of all images are written to one proposal store at `store_path`, and for the
+    training split the crops are written to the crop store at `crop_store_path`.
+    """
+    params_hash = parameter_hash(params)
+    jobs = []
+    for file in files:
+        image_path = os.path.join(images_folder, file.replace('.xml', '.jpg'))
+        image_id = os.path.splitext(os.path.basename(image_path))[0]
+        jobs.append({
+            'split': split,
+            'image_id': image_id,
+            'image_path': image_path,
+            'ground_truth': annotations.ground_truth(annotations.index_of(image_id)),
+            'images_dir': images_dir,
+            'targets_dir': targets_dir,
+            'params': params,
+            'params_hash': params_hash,
+            'force': force,
+        })
+
+    logger.info(f"{split}: {len(jobs)} images, {num_workers} workers, parameter hash {params_hash}")
+
+    start = time.perf_counter()
+    timings = []
+    counts = {'done': 0, 'empty': 0, 'skipped': 0}
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker) as executor:
+        futures = [executor.submit(process_image, job) for job in jobs]
+        for count, future in enumerate(as_completed(futures), start=1):
+            image_id, status, seconds = future.result()
+            counts[status] += 1
+            if status != 'skipped':
+                timings.append(seconds)
+                logger.info(f"[{split} {count}/{len(jobs)}] {image_id}: {status} in {seconds:.1f}s")
+
+    elapsed = time.perf_counter() - start
+    mean_time = sum(timings) / len(timings) if timings else 0.0
+    logger.info(
+        f"{split}: {counts['done']} done, {counts['empty']} without proposals, {counts['skipped']} skipped - "
+        f"{elapsed:.1f}s wall clock, {mean_time:.1f}s per image on average"
+    )
+
+    # Collect the per-image records into one proposal store for the split
+    num_images = build_proposal_store(
+        targets_dir, split, [job['image_id'] for job in jobs], store_path, params_hash,
+        meta={'params': params}
+    )
+    logger.info(f"{split}: proposal store with {num_images} images saved to {store_path}")
+
+    if crop_store_path is not None:
+        # The crop store follows the image order of the proposal store, so row i of both belongs to the same crop
+        image_ids = ProposalStore(store_path).image_ids
+        num_crops = write_crop_store(
+            crop_store_path, image_ids,
+            [crops_path(images_dir, image_id, params_hash) for image_id in image_ids],
+            meta={'split': split, 'params_hash': params_hash}
+        )
+        logger.info(f"{split}: crop store with {num_crops} crops saved to {crop_store_path}")
+
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description="Precompute selective search proposals for the Potholes dataset.")
+    parser.add_argument('--num_workers', type=int, default=int(os.getenv('LSB_DJOB_NUMPROC', os.cpu_count() or 1)),
+                        help='Number of worker processes (defaults to the number of cores of the job)')
+    parser.add_argument('--force', action='store_true', help='Recompute images that are already done')
+    args = parser.parse_args()
+
     TRAIN_PROPOSALS = True
     VALIDATION_PROPOSALS = True
-    TEST_PROPOSALS = True 
+    TEST_PROPOSALS = True
 
     blackhole_path = os.getenv('BLACKHOLE')
     if not blackhole_path:
@@ -31,7 +238,7 @@ if __name__ == '__main__':
     get_images_from_folder_relative = 'Potholes/annotated-images'
     get_split_from_folder_relative = 'Potholes'
 
-    # save paths for training 
+    # save paths for training
     save_images_in_folder_relative = os.path.join(blackhole_path, 'DLCV/training_data/images')
     save_targets_in_folder_relative = os.path.join(blackhole_path, 'DLCV/training_data/targets')
 
@@ -44,16 +251,23 @@ if __name__ == '__main__':
 
 
     SEED = 42
-    VAL_PERCENT = 20 
+    VAL_PERCENT = 20
     IOU_UPPER_LIMIT = 0.5
     IOU_LOWER_LIMIT = 0.5
     METHOD = 'quality'
     MAX_PROPOSALS = 500
 
-    transform = transforms.Compose([
-        transforms.Resize((256, 256)),
-        transforms.ToTensor(),
-        ])
+    # Every parameter that changes the saved proposals. The hash of these decides if an image is already done
+    params = {
+        'seed': SEED,
+        'iou_upper_limit': IOU_UPPER_LIMIT,
+        'iou_lower_limit': IOU_LOWER_LIMIT,
+        'method': METHOD,
+        'max_proposals': MAX_PROPOSALS,
+        'resize': [256, 256],
+        'crop_format': 'uint8_hwc',
+        'train_proposals': 'all_labeled',
+    }
 
     # Ensure the dataset is accessed from the root of the repository
     base_path = os.path.abspath(os.path.join(os.path.dirname(__file__)))
@@ -69,11 +283,11 @@ if __name__ == '__main__':
     ensure_dir(save_targets_in_folder_full)
     ensure_dir(save_targets_in_folder_full_val)
     ensure_dir(save_targets_in_folder_full_test)
-    
+
 
 
 #    # Load the splits from the JSON file
-    json_path = os.path.join(get_split_from_folder_relative, "splits.json")
+    json_path = os.path.join(base_path, get_split_from_folder_relative, "splits.json")
     with open(json_path, 'r') as file:
         splits = json.load(file)
     train_files = splits['train']
@@ -82,10 +296,10 @@ if __name__ == '__main__':
 #    #If the validation percentage for the split is set, it will create a validation set based on the existing training set
     if VAL_PERCENT is not None:
         random.seed(SEED)
-        random.shuffle(train_files) 
-        
+        random.shuffle(train_files)
+
                 #Get all the files to calculate the precentage for validation set
-                #number_of_all_files = len(sorted(glob.glob(os.path.join(get_images_from_folder_full, 'img-*.jpg')))) #Get the number of all the files in the folder 
+                #number_of_all_files = len(sorted(glob.glob(os.path.join(get_images_from_folder_full, 'img-*.jpg')))) #Get the number of all the files in the folder
 
         # Calculate the number of validation samples
         val_count = int(len(train_files) * VAL_PERCENT/100)
@@ -93,113 +307,37 @@ if __name__ == '__main__':
         new_train_files = train_files[val_count:]
     else:
         raise Exception("Validation percentage is not set")
-    
+
+    # The ground truth of all images, parsed once from the XML files
+    annotations = build_annotation_index(
+        get_images_from_folder_full, os.path.join(blackhole_path, 'DLCV/annotations.npz'), num_workers=args.num_workers
+    )
+    logger.info(f"Annotation index with {len(annotations)} images and {len(annotations.boxes)} boxes")
+
     if TRAIN_PROPOSALS:
         logger.working_on(f"Creating training proposals with and targets {len(new_train_files)} images")
-        image_paths = [os.path.join(get_images_from_folder_full, file.replace('.xml', '.jpg')) for file in new_train_files]
-        xml_paths = [os.path.join(get_images_from_folder_full, file) for file in new_train_files]
-
-        count = 0
-        for image_path, xml_path in zip(image_paths, xml_paths):
-            original_image = Image.open(image_path).convert('RGB')
-            original_targets = get_xml_data(xml_path)
-            image_id = os.path.splitext(os.path.basename(image_path))[0]
-
-            if count % 50 == 0:
-                print(f"Processing training image {count}: {image_id}")
-            # Generate proposals and targets
-            proposal_images, proposal_targets = generate_proposals_and_targets_for_training(
-                original_image, original_targets, transform, image_id,
-                IOU_UPPER_LIMIT, IOU_LOWER_LIMIT, METHOD, MAX_PROPOSALS,
-                generate_target=True
-            )
-            # Perform class balancing
-            proposal_images_balanced, proposal_targets_balanced = class_balance(
-                proposal_images, proposal_targets, SEED, image_id
-            )
-
-            if proposal_images_balanced is not None:
-                pickle_save(
-                    proposal_images_balanced, proposal_targets_balanced,
-                    save_images_in_folder_full, save_targets_in_folder_full,
-                    index=image_id, split='train'
-                )
-            count += 1
-
+        run_split(
+            'train', new_train_files, get_images_from_folder_full,
+            save_images_in_folder_full, save_targets_in_folder_full,
+            os.path.join(blackhole_path, 'DLCV/train_proposals.store'), params, args.num_workers, annotations, force=args.force,
+            crop_store_path=os.path.join(blackhole_path, 'DLCV/train_crops.index.json')
+        )
         logger.success("Training proposals and targets created successfully")
 
     if VALIDATION_PROPOSALS and new_val_files:
         logger.working_on(f"Creating validation proposals with {len(new_val_files)} images")
-        image_paths_val = [os.path.join(get_images_from_folder_full, file.replace('.xml', '.jpg')) for file in new_val_files]
-        xml_paths_val = [os.path.join(get_images_from_folder_full, file) for file in new_val_files]
-
-        count = 0
-        for image_path, xml_path in zip(image_paths_val, xml_paths_val):
-            original_image = Image.open(image_path).convert('RGB')
-            original_targets = get_xml_data(xml_path)
-            image_id = os.path.splitext(os.path.basename(image_path))[0]
-
-            if count % 50 == 0:
-                print(f"Processing validation image {count}: {image_id}")
-
-            # Generate proposals
-            proposals = generate_proposals_for_test_and_val(
-                original_image, original_targets, transform, image_id,
-                IOU_UPPER_LIMIT, IOU_LOWER_LIMIT, METHOD, MAX_PROPOSALS,
-                generate_target=True, return_images=False
-            )
-
-            if proposals is not None:
-                # Save the proposals and image_id
-                pickle_save(
-                    None, proposals,
-                    None, save_targets_in_folder_full_val,
-                    index=image_id, split='val'
-                )
-
-                ground_truth_path = os.path.join(save_targets_in_folder_full_val, f"{image_id}_gt.pkl")
-                save_ground_truth(ground_truth_path, original_targets)
-
-                # Save the ground truth (original_targets)
-                ground_truth_path = os.path.join(save_targets_in_folder_full_val, f"{image_id}_gt.pkl")
-
-
-            count += 1
-
+        run_split(
+            'val', new_val_files, get_images_from_folder_full,
+            None, save_targets_in_folder_full_val,
+            os.path.join(blackhole_path, 'DLCV/val_proposals.store'), params, args.num_workers, annotations, force=args.force
+        )
         logger.success("Validation proposals and ground truth saved successfully")
+
     if TEST_PROPOSALS:
         logger.working_on(f"Creating test proposals with {len(test_files)} images")
-        image_paths_test = [os.path.join(get_images_from_folder_full, file.replace('.xml', '.jpg')) for file in test_files]
-        xml_paths_test = [os.path.join(get_images_from_folder_full, file) for file in test_files]
-
-        count = 0
-        for image_path, xml_path in zip(image_paths_test, xml_paths_test):
-            original_image = Image.open(image_path).convert('RGB')
-            original_targets = get_xml_data(xml_path)
-            image_id = os.path.splitext(os.path.basename(image_path))[0]
-
-            if count % 50 == 0:
-                print(f"Processing test image {count}: {image_id}")
-
-            # Generate proposals
-            proposals = generate_proposals_for_test_and_val(
-                original_image, original_targets, transform, image_id,
-                IOU_UPPER_LIMIT, IOU_LOWER_LIMIT, METHOD, MAX_PROPOSALS,
-                generate_target=False, return_images=False
-            )
-
-            if proposals is not None:
-                # Save the proposals and image_id
-                pickle_save(
-                    None, proposals,
-                    None, save_targets_in_folder_full_test,
-                    index=image_id, split='test'
-                )
-
-                # Save the ground truth (original_targets)
-                ground_truth_path = os.path.join(save_targets_in_folder_full_test, f"{image_id}_gt.pkl")
-                save_ground_truth(ground_truth_path, original_targets)
-
-            count += 1
-
+        run_split(
+            'test', test_files, get_images_from_folder_full,
+            None, save_targets_in_folder_full_test,
+            os.path.join(blackhole_path, 'DLCV/test_proposals.store'), params, args.num_workers, annotations, force=args.force
+        )
         logger.success("Test proposals and ground truth saved successfully")
@@ -0,0 +1,201 @@
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+from PIL import Image
+
+# Bump when the parsing or the stored arrays change
+ANNOTATION_INDEX_VERSION = 1
+
+# Label of every category, all other categories are background (0)
+CATEGORY_LABELS = {'pothole': 1}
+
+
+def parse_annotation(xml_path: str) -> Dict:
+    """
+    Parses one Pascal VOC XML file into plain arrays.
+
+    Returns:
+    --------
+    dict
+        'image_id' (file name without extension), 'size' ((width, height) from the <size> element), 'boxes'
+        (g x 4 float32 array of (xmin, ymin, xmax, ymax)) and 'labels' (g int8 array, 1 pothole, 0 other).
+    """
+    root = ET.parse(xml_path).getroot()
+
+    boxes = []
+    labels = []
+    for obj in root.iter('object'):
+        bndbox = obj.find('bndbox')
+        boxes.append([float(bndbox.findtext(key)) for key in ('xmin', 'ymin', 'xmax', 'ymax')])
+        labels.append(CATEGORY_LABELS.get(obj.findtext('name'), 0))
+
+    size = root.find('size')
+    width = int(size.findtext('width')) if size is not None else 0
+    height = int(size.findtext('height')) if size is not None else 0
+
+    return {
+        'image_id': os.path.splitext(os.path.basename(xml_path))[0],
+        'size': (width, height),
+        'boxes': np.array(boxes, dtype=np.float32).reshape(-1, 4),
+        'labels': np.array(labels, dtype=np.int8),
+    }
+
+
+def parse_data_json(json_path: str, image_dir: Optional[str] = None) -> List[Dict]:
+    """
+    Parses the annotations of all images from the `data.json` of the dataset, with the same records as
+    `parse_annotation`. The file has no image sizes, they are read from the image headers in image_dir (without
+    decoding the images) or left as (0, 0).
+    """
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+
+    records = []
+    for entry in data:
+        objects = entry['objects']
+        size = (0, 0)
+        if image_dir is not None:
+            with Image.open(os.path.join(image_dir, entry['image_name'])) as image:
+                size = image.size
+        records.append({
+            'image_id': os.path.splitext(entry['image_name'])[0],
+            'size': size,
+            'boxes': np.array([[o['x_min'], o['y_min'], o['x_max'], o['y_max']] for o in objects], dtype=np.float32).reshape(-1, 4),
+            'labels': np.array([CATEGORY_LABELS.get(o['category'], 0) for o in objects], dtype=np.int8),
+        })
+    return records
+
+
+def annotation_fingerprint(paths: List[str]) -> str:
+    """
+    Short hash of the annotation files (name, size and modification time), to rebuild a stale index.
+    """
+    sha = hashlib.sha1(f'{ANNOTATION_INDEX_VERSION}'.encode('utf-8'))
+    for path in sorted(paths):
+        stat = os.stat(path)
+        sha.update(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    return sha.hexdigest()[:16]
+
+
+def write_annotation_index(path: str, records: List[Dict], meta: Optional[Dict] = None) -> None:
+    """
+    Writes the annotations of all images into one .npz file: 'image_ids' (n), 'sizes' (n x 2 width, height),
+    'offsets' (n + 1, the boxes of image i are offsets[i]:offsets[i + 1]), 'boxes' (G x 4 float32) and 'labels'
+    (G int8). The file is written to a temporary path and renamed into place.
+    """
+    records = sorted(records, key=lambda r: r['image_id'])
+    num_boxes = [len(r['boxes']) for r in records]
+
+    arrays = {
+        'image_ids': np.array([r['image_id'] for r in records], dtype=str),
+        'sizes': np.array([r['size'] for r in records], dtype=np.int32).reshape(-1, 2),
+        'offsets': np.concatenate(([0], np.cumsum(num_boxes))).astype(np.int64),
+        'boxes': np.concatenate([r['boxes'] for r in records] + [np.zeros((0, 4), dtype=np.float32)]).astype(np.float32),
+        'labels': np.concatenate([r['labels'] for r in records] + [np.zeros(0, dtype=np.int8)]).astype(np.int8),
+        'meta': np.array(json.dumps(meta or {})),
+    }
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+class AnnotationIndex:
+    """
+    The ground truth of the whole dataset, loaded from an index written by `write_annotation_index`.
+
+    All boxes are kept in one G x 4 array, `ground_truth(idx)` returns views of the rows of one image, so
+    nothing is parsed or unpickled per image.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with np.load(path) as data:
+            self.image_ids = data['image_ids'].tolist()
+            self.sizes = data['sizes']
+            self.offsets = data['offsets']
+            self.boxes = data['boxes']
+            self.labels = data['labels']
+            self.meta = json.loads(str(data['meta']))
+        self._index = {image_id: i for i, image_id in enumerate(self.image_ids)}
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self._index
+
+    def index_of(self, image_id: str) -> int:
+        return self._index[image_id]
+
+    def size(self, idx: int):
+        """
+        (width, height) of image `idx`, like `PIL.Image.size`.
+        """
+        width, height = self.sizes[idx]
+        return int(width), int(height)
+
+    def ground_truth(self, idx: int) -> Dict[str, np.ndarray]:
+        """
+        Returns the g x 4 ground truth boxes and the g labels of image `idx` (see `ProposalStore.ground_truth`).
+        """
+        rows = slice(int(self.offsets[idx]), int(self.offsets[idx + 1]))
+        return {'boxes': self.boxes[rows], 'labels': self.labels[rows]}
+
+
+def build_annotation_index(annotation_dir: str, index_path: str, num_workers: int = 4, force: bool = False) -> AnnotationIndex:
+    """
+    Parses every Pascal VOC XML file in annotation_dir (e.g. 'Potholes/annotated-images') once, in parallel, and
+    saves the result as one annotation index. The index is reused as long as the XML files do not change.
+
+    Without XML files the annotations are read from the `data.json` next to annotation_dir instead.
+
+    Parameters:
+    -----------
+    annotation_dir : str
+        Directory with the images and their XML files.
+
+    index_path : str
+        Where to save the index, e.g. '$BLACKHOLE/DLCV/annotations.npz'.
+
+    num_workers : int
+        Number of worker processes for parsing.
+
+    force : bool
+        Rebuild the index even if it is up to date.
+
+    Returns:
+    --------
+    AnnotationIndex
+    """
+    xml_paths = sorted(glob.glob(os.path.join(annotation_dir, '*.xml')))
+    json_path = os.path.join(os.path.dirname(os.path.normpath(annotation_dir)), 'data.json')
+    source_paths = xml_paths if xml_paths else [json_path]
+    fingerprint = annotation_fingerprint(source_paths)
+
+    if not force and os.path.exists(index_path):
+        index = AnnotationIndex(index_path)
+        if index.meta.get('fingerprint') == fingerprint:
+            return index
+
+    if xml_paths:
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                records = list(executor.map(parse_annotation, xml_paths, chunksize=max(1, len(xml_paths) // (4 * num_workers))))
+        else:
+            records = [parse_annotation(path) for path in xml_paths]
+    else:
+        records = parse_data_json(json_path, annotation_dir)
+
+    write_annotation_index(index_path, records, meta={
+        'fingerprint': fingerprint,
+        'source': 'xml' if xml_paths else 'data.json',
+        'annotation_dir': os.path.abspath(annotation_dir),
+    })
+    return AnnotationIndex(index_path)
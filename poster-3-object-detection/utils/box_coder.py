@@ -0,0 +1,94 @@
+import math
+import torch
+
+from typing import Optional, Tuple
+from utils.box_ops import ArrayLike, as_box_tensor
+
+# Largest width/height delta applied when decoding, so exp() cannot blow a box up (same value as torchvision)
+BBOX_XFORM_CLIP = math.log(1000.0 / 16)
+
+
+class BoxCoder:
+    """
+    Encodes ground truth boxes as regression targets (tx, ty, tw, th) relative to the proposal boxes and decodes
+    predicted targets back into boxes, for whole N x 4 batches at once.
+
+    The parametrization is the one the regression head is trained with:
+        tx = (gt_xmin - p_xmin) / p_width
+        ty = (gt_ymin - p_ymin) / p_height
+        tw = log(gt_width / p_width)
+        th = log(gt_height / p_height)
+    i.e. the offset of the top left corner scaled by the proposal size, and the log ratio of the sizes.
+    """
+    def __init__(self, bbox_xform_clip: float = BBOX_XFORM_CLIP):
+        self.bbox_xform_clip = bbox_xform_clip
+
+    def encode(self, proposals: ArrayLike, gt_boxes: ArrayLike) -> torch.Tensor:
+        """
+        Computes the N x 4 regression targets of N proposals for their N matched ground truth boxes.
+
+        Parameters:
+        -----------
+        proposals : np.ndarray or torch.Tensor
+            An N x 4 array of (xmin, ymin, xmax, ymax) proposal boxes.
+
+        gt_boxes : np.ndarray or torch.Tensor
+            An N x 4 array with the matched ground truth box of every proposal.
+
+        Returns:
+        --------
+        torch.Tensor
+            An N x 4 tensor of (tx, ty, tw, th) on the device of `proposals`.
+        """
+        proposals = as_box_tensor(proposals)
+        gt_boxes = as_box_tensor(gt_boxes).to(device=proposals.device, dtype=proposals.dtype)
+
+        widths = proposals[:, 2] - proposals[:, 0]
+        heights = proposals[:, 3] - proposals[:, 1]
+
+        return torch.stack([
+            (gt_boxes[:, 0] - proposals[:, 0]) / widths,
+            (gt_boxes[:, 1] - proposals[:, 1]) / heights,
+            torch.log((gt_boxes[:, 2] - gt_boxes[:, 0]) / widths),
+            torch.log((gt_boxes[:, 3] - gt_boxes[:, 1]) / heights),
+        ], dim=1)
+
+    def decode(self, proposals: ArrayLike, deltas: torch.Tensor, image_size: Optional[Tuple[int, int]] = None) -> torch.Tensor:
+        """
+        Applies N x 4 predicted (tx, ty, tw, th) to N proposals, the inverse of `encode`.
+
+        Parameters:
+        -----------
+        proposals : np.ndarray or torch.Tensor
+            An N x 4 array of (xmin, ymin, xmax, ymax) proposal boxes.
+
+        deltas : torch.Tensor
+            The N x 4 output of the regression head.
+
+        image_size : tuple of int, optional
+            (width, height) of the image. If given, the decoded boxes are clipped to the image.
+
+        Returns:
+        --------
+        torch.Tensor
+            An N x 4 tensor of (xmin, ymin, xmax, ymax) boxes on the device of `deltas`.
+        """
+        deltas = torch.as_tensor(deltas)
+        proposals = as_box_tensor(proposals).to(device=deltas.device, dtype=deltas.dtype)
+
+        widths = proposals[:, 2] - proposals[:, 0]
+        heights = proposals[:, 3] - proposals[:, 1]
+
+        xmin = proposals[:, 0] + deltas[:, 0] * widths
+        ymin = proposals[:, 1] + deltas[:, 1] * heights
+        new_widths = widths * torch.exp(deltas[:, 2].clamp(max=self.bbox_xform_clip))
+        new_heights = heights * torch.exp(deltas[:, 3].clamp(max=self.bbox_xform_clip))
+
+        boxes = torch.stack([xmin, ymin, xmin + new_widths, ymin + new_heights], dim=1)
+
+        if image_size is not None:
+            width, height = image_size
+            boxes[:, 0::2] = boxes[:, 0::2].clamp(min=0, max=width)
+            boxes[:, 1::2] = boxes[:, 1::2].clamp(min=0, max=height)
+
+        return boxes
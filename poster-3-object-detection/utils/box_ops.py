@@ -0,0 +1,104 @@
+import numpy as np
+import torch
+
+from typing import Union
+
+ArrayLike = Union[np.ndarray, torch.Tensor]
+
+
+def as_box_tensor(boxes: ArrayLike) -> torch.Tensor:
+    """
+    Converts an N x 4 array of (xmin, ymin, xmax, ymax) boxes into a floating point tensor.
+
+    NumPy arrays are shared with the returned tensor when they already have a floating dtype, so this does not
+    copy. Integer boxes (e.g. the int16 proposal boxes) are converted to float32.
+    """
+    boxes = torch.as_tensor(boxes)
+    if not boxes.is_floating_point():
+        boxes = boxes.to(torch.float32)
+    return boxes.reshape(-1, 4)
+
+
+def like_input(x: torch.Tensor, reference: ArrayLike) -> ArrayLike:
+    # Return NumPy if the caller gave us NumPy, otherwise keep the tensor
+    if isinstance(reference, np.ndarray):
+        return x.cpu().numpy()
+    return x
+
+
+def _box_area(boxes: torch.Tensor) -> torch.Tensor:
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def _box_intersection(boxes1: torch.Tensor, boxes2: torch.Tensor) -> torch.Tensor:
+    top_left = torch.max(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = torch.min(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    wh = (bottom_right - top_left).clamp(min=0)
+    return wh[..., 0] * wh[..., 1]
+
+
+def _box_iou(boxes1: torch.Tensor, boxes2: torch.Tensor) -> torch.Tensor:
+    intersection = _box_intersection(boxes1, boxes2)
+    union = _box_area(boxes1)[:, None] + _box_area(boxes2)[None, :] - intersection
+    return torch.where(union > 0, intersection / union.clamp(min=torch.finfo(union.dtype).tiny), torch.zeros_like(union))
+
+
+def box_area(boxes: ArrayLike) -> ArrayLike:
+    """
+    Computes the area of every box in an N x 4 array of (xmin, ymin, xmax, ymax) boxes.
+    """
+    return like_input(_box_area(as_box_tensor(boxes)), boxes)
+
+
+def box_intersection(boxes1: ArrayLike, boxes2: ArrayLike) -> ArrayLike:
+    """
+    Computes the N x M matrix of intersection areas between two sets of boxes.
+    Boxes that do not overlap have an intersection of 0.
+    """
+    return like_input(_box_intersection(as_box_tensor(boxes1), as_box_tensor(boxes2)), boxes1)
+
+
+def box_iou(boxes1: ArrayLike, boxes2: ArrayLike) -> ArrayLike:
+    """
+    Computes the N x M Intersection over Union (IoU) matrix between two sets of boxes.
+
+    This is the batched version of `IoU` in utils/metrics.py: entry (i, j) is the IoU between boxes1[i] and
+    boxes2[j]. Boxes that do not overlap get an IoU of 0.0.
+
+    Parameters:
+    -----------
+    boxes1 : np.ndarray or torch.Tensor
+        An N x 4 array of (xmin, ymin, xmax, ymax) boxes.
+
+    boxes2 : np.ndarray or torch.Tensor
+        An M x 4 array of (xmin, ymin, xmax, ymax) boxes.
+
+    Returns:
+    --------
+    np.ndarray or torch.Tensor
+        An N x M matrix with IoU values between 0.0 and 1.0. The type follows the type of `boxes1`.
+    """
+    return like_input(_box_iou(as_box_tensor(boxes1), as_box_tensor(boxes2)), boxes1)
+
+
+def box_giou(boxes1: ArrayLike, boxes2: ArrayLike) -> ArrayLike:
+    """
+    Computes the N x M Generalized IoU (GIoU) matrix between two sets of boxes.
+
+    GIoU = IoU - (enclosing_area - union_area) / enclosing_area, where the enclosing box is the smallest box
+    covering both boxes. Unlike IoU it is also informative for boxes that do not overlap and ranges from -1 to 1.
+    """
+    b1 = as_box_tensor(boxes1)
+    b2 = as_box_tensor(boxes2)
+
+    intersection = _box_intersection(b1, b2)
+    union = _box_area(b1)[:, None] + _box_area(b2)[None, :] - intersection
+    iou = torch.where(union > 0, intersection / union.clamp(min=torch.finfo(union.dtype).tiny), torch.zeros_like(union))
+
+    top_left = torch.min(b1[:, None, :2], b2[None, :, :2])
+    bottom_right = torch.max(b1[:, None, 2:], b2[None, :, 2:])
+    wh = (bottom_right - top_left).clamp(min=0)
+    enclosing = wh[..., 0] * wh[..., 1]
+
+    giou = iou - torch.where(enclosing > 0, (enclosing - union) / enclosing.clamp(min=torch.finfo(enclosing.dtype).tiny), torch.zeros_like(enclosing))
+    return like_input(giou, boxes1)
@@ -0,0 +1,201 @@
+import os
+import json
+import numpy as np
+import torch
+
+from typing import List, Optional
+
+# Every crop is saved as a 256 x 256 x 3 uint8 image (HWC), i.e. 196 KB instead of 786 KB for a float32 tensor
+CROP_SHAPE = (256, 256, 3)
+CROP_DTYPE = np.uint8
+
+# Number of crops per shard file (~800 MB for 256 x 256 x 3 crops)
+DEFAULT_SHARD_ROWS = 4096
+
+
+def crops_to_array(crops: List[torch.Tensor]) -> np.ndarray:
+    """
+    Converts a list of uint8 C x H x W crop tensors (e.g. from `transforms.PILToTensor`) into one n x H x W x C array.
+    """
+    if len(crops) == 0:
+        return np.zeros((0,) + CROP_SHAPE, dtype=CROP_DTYPE)
+    crops = torch.stack(list(crops))
+    assert crops.dtype == torch.uint8, f"Expected uint8 crops, got {crops.dtype}"
+    return crops.permute(0, 2, 3, 1).contiguous().numpy()
+
+
+def save_crops(crops: np.ndarray, path: str) -> None:
+    """
+    Saves the n x H x W x C uint8 crops of one image to a temporary file and renames it into place.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(crops, dtype=CROP_DTYPE))
+    os.replace(tmp_path, path)
+
+
+def write_crop_store(
+    index_path: str,
+    image_ids: List[str],
+    crop_paths: List[str],
+    shard_rows: int = DEFAULT_SHARD_ROWS,
+    meta: Optional[dict] = None
+) -> int:
+    """
+    Collects the per-image crop files into fixed-shape uint8 shards plus one JSON index.
+
+    The crops of an image are never split over two shards. The shards are named after the index
+    (e.g. 'train_crops.index.json' -> 'train_crops.00000.u8') and contain the raw n x H x W x C bytes, so they
+    can be memory-mapped without any header.
+
+    Parameters:
+    -----------
+    index_path : str
+        Where to save the index, e.g. '$BLACKHOLE/DLCV/train_crops.index.json'.
+
+    image_ids : list of str
+        The images in the order of the proposal store.
+
+    crop_paths : list of str
+        The .npy file with the crops of every image (see `save_crops`).
+
+    shard_rows : int
+        Maximum number of crops per shard. An image with more crops gets a shard of its own.
+
+    meta : dict, optional
+        Extra JSON serializable information saved in the index.
+
+    Returns:
+    --------
+    int
+        The total number of crops.
+    """
+    prefix = index_path[:-len('.index.json')] if index_path.endswith('.index.json') else index_path
+    directory = os.path.dirname(index_path)
+
+    shards = []
+    images = []
+    shard_file = None
+
+    def close_shard():
+        if shard_file is not None:
+            shard_file.close()
+            os.replace(shards[-1]['tmp_path'], os.path.join(directory, shards[-1]['file']))
+
+    try:
+        for image_id, crop_path in zip(image_ids, crop_paths):
+            crops = np.load(crop_path, mmap_mode='r')
+            assert crops.shape[1:] == CROP_SHAPE and crops.dtype == CROP_DTYPE, \
+                f"Unexpected crops in {crop_path}: {crops.shape} {crops.dtype}"
+
+            # Start a new shard when the crops of this image do not fit into the current one
+            if not shards or (shards[-1]['rows'] > 0 and shards[-1]['rows'] + len(crops) > shard_rows):
+                close_shard()
+                name = f"{os.path.basename(prefix)}.{len(shards):05d}.u8"
+                shards.append({'file': name, 'rows': 0, 'tmp_path': os.path.join(directory, f"{name}.tmp-{os.getpid()}")})
+                shard_file = open(shards[-1]['tmp_path'], 'wb')
+
+            images.append([len(shards) - 1, shards[-1]['rows'], len(crops)])
+            shard_file.write(np.ascontiguousarray(crops).tobytes())
+            shards[-1]['rows'] += len(crops)
+        close_shard()
+        shard_file = None
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    index = {
+        'crop_shape': list(CROP_SHAPE),
+        'dtype': np.dtype(CROP_DTYPE).str,
+        'image_ids': list(image_ids),
+        'images': images,  # (shard, first row, number of crops) of every image
+        'shards': [{'file': shard['file'], 'rows': shard['rows']} for shard in shards],
+        'meta': meta or {},
+    }
+    tmp_path = f"{index_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    return sum(shard['rows'] for shard in shards)
+
+
+class CropStore:
+    """
+    Read-only, memory-mapped view of the training crops written by `write_crop_store`.
+
+    `crops(idx)` returns the n x H x W x C uint8 crops of image `idx` as a view into the shard, so DataLoader
+    workers only touch the pages they need and nothing is unpickled. Conversion to float happens per batch,
+    see `prepare_crops`.
+    """
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+
+        self.crop_shape = tuple(index['crop_shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.image_ids = index['image_ids']
+        self.meta = index['meta']
+        self._images = index['images']
+        self._index = {image_id: i for i, image_id in enumerate(self.image_ids)}
+
+        # Copy-on-write mapping: the file is never modified, but torch.from_numpy accepts the views without a copy
+        directory = os.path.dirname(index_path)
+        self.shards = [
+            np.memmap(os.path.join(directory, shard['file']), dtype=self.dtype, mode='c',
+                      shape=(shard['rows'],) + self.crop_shape)
+            if shard['rows'] > 0 else np.zeros((0,) + self.crop_shape, dtype=self.dtype)
+            for shard in index['shards']
+        ]
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def index_of(self, image_id: str) -> int:
+        return self._index[image_id]
+
+    def num_crops(self, idx: int) -> int:
+        return self._images[idx][2]
+
+    def crops(self, idx: int) -> np.ndarray:
+        shard, start, count = self._images[idx]
+        if count == 0:
+            return np.zeros((0,) + self.crop_shape, dtype=self.dtype)
+        return self.shards[shard][start:start + count]
+
+    def crops_at(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the crops of arbitrary global proposal rows (the row order of the proposal store) as one
+        n x H x W x C array. The shards hold the crops of all images back to back, so a global row is found
+        from the number of rows of the shards before it.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        shard_starts = np.cumsum([0] + [len(shard) for shard in self.shards])
+        shard_of_row = np.searchsorted(shard_starts, rows, side='right') - 1
+
+        crops = np.empty((len(rows),) + self.crop_shape, dtype=self.dtype)
+        for shard in np.unique(shard_of_row):
+            selected = shard_of_row == shard
+            crops[selected] = self.shards[shard][rows[selected] - shard_starts[shard]]
+        return crops
+
+
+def prepare_crops(images: torch.Tensor, device=None, mean=None, std=None) -> torch.Tensor:
+    """
+    Turns a batch of n x H x W x C uint8 crops into the n x C x H x W float tensor the model expects.
+
+    The batch is moved to `device` while it is still uint8 (4x less data to copy), then scaled to [0, 1] and
+    optionally normalized with the per channel `mean` and `std`. The result equals what `transforms.ToTensor`
+    (and `transforms.Normalize`) produce for every crop.
+    """
+    if device is not None:
+        images = images.to(device, non_blocking=True)
+    images = images.permute(0, 3, 1, 2).float().div_(255)
+    if mean is not None and std is not None:
+        mean = torch.as_tensor(mean, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+        std = torch.as_tensor(std, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+        images = images.sub_(mean).div_(std)
+    return images.contiguous()
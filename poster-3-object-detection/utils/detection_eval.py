@@ -0,0 +1,276 @@
+import numpy as np
+
+from typing import Dict, List, Sequence, Tuple
+from utils.box_ops import box_iou
+
+# The COCO thresholds 0.5, 0.55, ..., 0.95
+IOU_THRESHOLDS = np.round(np.arange(0.5, 0.951, 0.05), 2)
+
+
+def as_box_array(boxes) -> np.ndarray:
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def prediction_arrays(pred_dicts: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Converts the prediction dictionaries of one image ('pre_bbox_xmin', ..., 'pre_class') into a P x 4 box
+    array and an array with P scores.
+    """
+    boxes = as_box_array([
+        [p['pre_bbox_xmin'], p['pre_bbox_ymin'], p['pre_bbox_xmax'], p['pre_bbox_ymax']] for p in pred_dicts
+    ])
+    scores = np.asarray([float(p['pre_class']) for p in pred_dicts], dtype=np.float64)
+    return boxes, scores
+
+
+def ground_truth_array(gt_dicts: List[Dict]) -> np.ndarray:
+    """
+    Converts the ground truth dictionaries of one image ('xmin', 'ymin', 'xmax', 'ymax') into a G x 4 array.
+    """
+    return as_box_array([[g['xmin'], g['ymin'], g['xmax'], g['ymax']] for g in gt_dicts])
+
+
+def match_predictions(ious: np.ndarray, iou_thresholds: Sequence[float]) -> np.ndarray:
+    """
+    Greedy matching of the predictions of one image to its ground truth boxes, for several IoU thresholds.
+
+    The predictions (rows of `ious`) must be sorted by decreasing score. Every prediction takes the unmatched
+    ground truth box with the highest IoU; it is a true positive when that IoU is at least the threshold, and the
+    ground truth box cannot be matched again.
+
+    Instead of visiting the predictions one by one, every round finds the first remaining prediction that has an
+    unmatched ground truth box above the threshold with one vectorized operation. All predictions before it are
+    false positives (the set of unmatched boxes only shrinks), so there are at most G + 1 rounds per threshold
+    regardless of the number of predictions.
+
+    Parameters:
+    -----------
+    ious : np.ndarray
+        A P x G IoU matrix between the sorted predictions and the ground truth boxes.
+
+    iou_thresholds : sequence of float
+        The T thresholds to match with.
+
+    Returns:
+    --------
+    np.ndarray
+        A T x P boolean array, True where the prediction is a true positive at the threshold.
+    """
+    num_predictions, num_gt = ious.shape
+    tp = np.zeros((len(iou_thresholds), num_predictions), dtype=bool)
+    if num_predictions == 0 or num_gt == 0:
+        return tp
+
+    for t, threshold in enumerate(iou_thresholds):
+        unmatched = np.ones(num_gt, dtype=bool)
+        start = 0
+        while start < num_predictions and unmatched.any():
+            # IoU with the still unmatched ground truth boxes of all remaining predictions
+            candidate_ious = np.where(unmatched[None, :], ious[start:], 0.0)
+            hits = np.flatnonzero(candidate_ious.max(axis=1) >= threshold)
+            if len(hits) == 0:
+                break
+
+            first = hits[0]
+            tp[t, start + first] = True
+            unmatched[candidate_ious[first].argmax()] = False
+            start += first + 1
+
+    return tp
+
+
+def match_image(pred_boxes, pred_scores, gt_boxes, iou_thresholds=IOU_THRESHOLDS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Matches the predictions of one image. Returns the scores sorted by decreasing value and the T x P true
+    positive array in the same order.
+    """
+    pred_boxes = as_box_array(pred_boxes)
+    pred_scores = np.asarray(pred_scores, dtype=np.float64).reshape(-1)
+    gt_boxes = as_box_array(gt_boxes)
+
+    # Stable sort, so predictions with the same score keep their order
+    order = np.argsort(-pred_scores, kind='stable')
+    ious = box_iou(pred_boxes[order], gt_boxes)
+
+    return pred_scores[order], match_predictions(ious, iou_thresholds)
+
+
+def precision_recall_curve(scores: np.ndarray, tp: np.ndarray, num_gt: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the precision and recall after every prediction, with the predictions of all images ranked by score.
+
+    Parameters:
+    -----------
+    scores : np.ndarray
+        The N scores of all predictions.
+
+    tp : np.ndarray
+        A T x N boolean array, True where the prediction is a true positive at threshold t.
+
+    num_gt : int
+        The number of ground truth boxes of all images.
+
+    Returns:
+    --------
+    tuple
+        - precision : T x N array.
+        - recall : T x N array.
+    """
+    order = np.argsort(-scores, kind='stable')
+    tp = tp[:, order]
+
+    cumulative_tp = np.cumsum(tp, axis=1, dtype=np.float64)
+    cumulative_fp = np.cumsum(~tp, axis=1, dtype=np.float64)
+    epsilon = np.finfo(float).eps
+
+    precision = cumulative_tp / (cumulative_tp + cumulative_fp + epsilon)
+    recall = cumulative_tp / (num_gt + epsilon)
+    return precision, recall
+
+
+def average_precision(precision: np.ndarray, recall: np.ndarray) -> np.ndarray:
+    """
+    All-point interpolated average precision of every row of T x N precision and recall arrays: the area under
+    the precision envelope (the highest precision at any larger recall). Returns an array with T values.
+    """
+    precision = np.atleast_2d(precision)
+    recall = np.atleast_2d(recall)
+    if precision.shape[1] == 0:
+        return np.zeros(len(precision))
+
+    # Sentinel values at the start and end
+    zeros = np.zeros((len(precision), 1))
+    mrec = np.concatenate((zeros, recall, zeros + 1.0), axis=1)
+    mpre = np.concatenate((zeros, precision, zeros), axis=1)
+
+    # Precision envelope, a running maximum from the right
+    mpre = np.maximum.accumulate(mpre[:, ::-1], axis=1)[:, ::-1]
+
+    return np.sum((mrec[:, 1:] - mrec[:, :-1]) * mpre[:, 1:], axis=1)
+
+
+def summarize(scores: np.ndarray, tp: np.ndarray, num_gt: int, iou_thresholds=IOU_THRESHOLDS) -> Dict:
+    """
+    Computes the PR curves and the AP at every threshold from the matched predictions of all images.
+
+    Returns a dictionary with:
+    - 'iou_thresholds', 'ap' (one AP per threshold)
+    - 'map' (mean AP over the thresholds, AP@[.5:.95] for the default thresholds), 'ap50', 'ap75'
+    - 'precision', 'recall' (T x N curves), 'num_gt', 'num_predictions'
+    """
+    iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+    precision, recall = precision_recall_curve(scores, tp, num_gt)
+    ap = average_precision(precision, recall)
+
+    def ap_at(threshold):
+        hits = np.flatnonzero(np.isclose(iou_thresholds, threshold))
+        return float(ap[hits[0]]) if len(hits) else float('nan')
+
+    return {
+        'iou_thresholds': iou_thresholds,
+        'ap': ap,
+        'map': float(ap.mean()) if len(ap) else 0.0,
+        'ap50': ap_at(0.5),
+        'ap75': ap_at(0.75),
+        'precision': precision,
+        'recall': recall,
+        'num_gt': int(num_gt),
+        'num_predictions': int(len(scores)),
+    }
+
+
+def evaluate_detections(ground_truths, predictions, iou_thresholds=IOU_THRESHOLDS) -> Dict:
+    """
+    Evaluates the detections of a whole split at several IoU thresholds in one pass.
+
+    The IoU matrix of every image is computed once and reused for all thresholds, and the PR curves come from
+    cumulative sums over the ranked predictions, so the cost grows with the number of predictions only through
+    the sort.
+
+    Parameters:
+    -----------
+    ground_truths : list
+        Per image either a G x 4 array of (xmin, ymin, xmax, ymax) boxes or a list of dictionaries with the keys
+        'xmin', 'ymin', 'xmax', 'ymax'.
+
+    predictions : list
+        Per image either a (boxes, scores) tuple with a P x 4 array and P scores, or a list of dictionaries with
+        the keys 'pre_bbox_xmin', 'pre_bbox_ymin', 'pre_bbox_xmax', 'pre_bbox_ymax' and 'pre_class'.
+
+    iou_thresholds : sequence of float
+        The IoU thresholds. Defaults to 0.5:0.05:0.95.
+
+    Returns:
+    --------
+    dict
+        See `summarize`.
+    """
+    evaluator = DetectionEvaluator(iou_thresholds)
+    for gt, pred in zip(ground_truths, predictions):
+        evaluator.update(pred, gt)
+    return evaluator.compute()
+
+
+class DetectionEvaluator:
+    """
+    Incremental version of `evaluate_detections`: call `update` once per image and `compute` at the end.
+
+    Only the score and the T true positive flags of every prediction and the number of ground truth boxes are
+    kept, not the boxes or any dictionaries, so the memory grows with 1 float and T booleans per prediction.
+    `reset` clears the state, e.g. at the start of every validation epoch.
+
+    Example:
+    --------
+        evaluator = DetectionEvaluator()
+        for ...:
+            evaluator.update((pred_boxes, pred_scores), gt_boxes)
+        results = evaluator.compute()
+        print(results['map'], results['ap50'])
+    """
+    def __init__(self, iou_thresholds=IOU_THRESHOLDS):
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        self._scores = []
+        self._tp = []
+        self.num_gt = 0
+        self.num_images = 0
+
+    def update(self, image_preds, image_gts):
+        """
+        Matches the predictions of one image and keeps the result.
+
+        Parameters:
+        -----------
+        image_preds : tuple or list of dict
+            A (boxes, scores) tuple with a P x 4 array (NumPy or torch) and P scores, or the prediction
+            dictionaries of the image.
+
+        image_gts : array or list of dict
+            A G x 4 array (NumPy or torch) of ground truth boxes, or the ground truth dictionaries of the image.
+        """
+        if isinstance(image_preds, list):
+            pred_boxes, pred_scores = prediction_arrays(image_preds)
+        else:
+            pred_boxes, pred_scores = (_to_numpy(x) for x in image_preds)
+        gt_boxes = ground_truth_array(image_gts) if isinstance(image_gts, list) else as_box_array(_to_numpy(image_gts))
+
+        scores, tp = match_image(pred_boxes, pred_scores, gt_boxes, self.iou_thresholds)
+        self._scores.append(scores.astype(np.float32))
+        self._tp.append(tp)
+        self.num_gt += len(gt_boxes)
+        self.num_images += 1
+
+    def compute(self) -> Dict:
+        """
+        Returns the same dictionary as `evaluate_detections` for all images seen since the last `reset`.
+        """
+        scores = np.concatenate(self._scores).astype(np.float64) if self._scores else np.zeros(0)
+        tp = np.concatenate(self._tp, axis=1) if self._tp else np.zeros((len(self.iou_thresholds), 0), dtype=bool)
+        return summarize(scores, tp, self.num_gt, self.iou_thresholds)
+
+
+def _to_numpy(x):
+    # Accept torch tensors without importing torch here
+    return x.detach().cpu().numpy() if hasattr(x, 'detach') else np.asarray(x)
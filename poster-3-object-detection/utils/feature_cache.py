@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import torch
+
+from torch.utils.data import Dataset
+from utils.crop_store import CropStore, prepare_crops
+from utils.proposal_store import ProposalStore
+from utils.logger import logger
+
+FEATURE_DTYPE = np.float16
+
+
+def backbone_fingerprint(backbone, crop_store, mean=None, std=None):
+    """
+    Returns a short hash of everything that changes the cached features: the backbone weights (including the
+    BatchNorm running statistics), the crops they are computed from and the preprocessing of the crops.
+    """
+    sha = hashlib.sha1()
+    for name, tensor in sorted(backbone.state_dict().items()):
+        sha.update(name.encode('utf-8'))
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    transform = {
+        'crop_shape': list(crop_store.crop_shape),
+        'crops': crop_store.meta,
+        'scale': 1 / 255,
+        'mean': None if mean is None else [float(m) for m in mean],
+        'std': None if std is None else [float(s) for s in std],
+    }
+    sha.update(json.dumps(transform, sort_keys=True).encode('utf-8'))
+    return sha.hexdigest()[:16]
+
+
+def build_feature_cache(model, crop_store_path, cache_dir, batch_size=256, device=None, mean=None, std=None):
+    """
+    Computes the backbone features of every stored training crop once and saves them as a float16 memmap.
+
+    Row i of the cache belongs to proposal i of the proposal store (the crop store has the same order), so the
+    global proposal row is the key of a feature. The file name contains the fingerprint of the backbone weights
+    and the preprocessing, so a changed backbone or transform never reads stale features. An existing cache with
+    the same fingerprint is reused.
+
+    Parameters:
+    -----------
+    model : ResNetTwoHeads
+        The model whose frozen `backbone` computes the features. The backbone runs in eval mode.
+
+    crop_store_path : str
+        The index of the training crop store, e.g. '$BLACKHOLE/DLCV/train_crops.index.json'.
+
+    cache_dir : str
+        Directory for the cache files.
+
+    batch_size : int
+        Number of crops per backbone forward pass.
+
+    device : torch.device, optional
+        Where to run the backbone. Defaults to cuda when available.
+
+    mean, std : sequence of float, optional
+        Normalization of the crops, see `prepare_crops`.
+
+    Returns:
+    --------
+    str
+        The path of the cache index (JSON), to be passed to `CachedFeatureset`.
+    """
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    crop_store = CropStore(crop_store_path)
+    fingerprint = backbone_fingerprint(model.backbone, crop_store, mean, std)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, f'train_features_{fingerprint}.json')
+    data_path = os.path.join(cache_dir, f'train_features_{fingerprint}.f16')
+    if os.path.exists(index_path) and os.path.exists(data_path):
+        logger.info(f"Reusing feature cache {index_path}")
+        return index_path
+
+    num_rows = sum(len(shard) for shard in crop_store.shards)
+    was_training = model.training
+    backbone = model.backbone.to(device).eval()
+
+    # Dry run on one crop to get the feature size (512 for ResNet18)
+    with torch.no_grad():
+        num_features = backbone(prepare_crops(torch.zeros((1,) + crop_store.crop_shape, dtype=torch.uint8), device, mean, std)).shape[1]
+
+    start = time.perf_counter()
+    tmp_path = f"{data_path}.tmp-{os.getpid()}"
+    features = np.memmap(tmp_path, dtype=FEATURE_DTYPE, mode='w+', shape=(max(num_rows, 1), num_features))
+
+    # The shards hold the crops of all images back to back in proposal order, so they are read in plain chunks
+    row = 0
+    with torch.no_grad():
+        for shard in crop_store.shards:
+            for first in range(0, len(shard), batch_size):
+                crops = torch.from_numpy(shard[first:first + batch_size])
+                batch_features = backbone(prepare_crops(crops, device, mean, std))
+                features[row:row + len(crops)] = batch_features.half().cpu().numpy()
+                row += len(crops)
+    features.flush()
+    del features
+    os.replace(tmp_path, data_path)
+
+    model.train(was_training)
+
+    index = {
+        'fingerprint': fingerprint,
+        'file': os.path.basename(data_path),
+        'rows': num_rows,
+        'num_features': int(num_features),
+        'dtype': np.dtype(FEATURE_DTYPE).str,
+        'image_ids': crop_store.image_ids,
+    }
+    tmp_path = f"{index_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    logger.info(f"Feature cache with {num_rows} x {num_features} features saved to {data_path} "
+                f"in {time.perf_counter() - start:.1f}s")
+    return index_path
+
+
+class FeatureCache:
+    """
+    Read-only, memory-mapped view of the features written by `build_feature_cache`.
+    Row i holds the float16 backbone features of proposal i of the proposal store.
+    """
+    def __init__(self, index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+
+        self.fingerprint = index['fingerprint']
+        self.image_ids = index['image_ids']
+        self.num_features = index['num_features']
+        self.features = np.memmap(
+            os.path.join(os.path.dirname(index_path), index['file']), dtype=np.dtype(index['dtype']), mode='c',
+            shape=(max(index['rows'], 1), index['num_features'])
+        )[:index['rows']]
+
+    def __len__(self):
+        return len(self.features)
+
+
+class CachedFeatureset(Dataset):
+    """
+    Like `Trainingset`, but returns the cached n x 512 float16 backbone features of the proposals of an image
+    instead of the crops. Only the shared fully connected layer and the heads have to run during training,
+    see `ResNetTwoHeads.heads`.
+    """
+    def __init__(self, feature_cache_path, store_path):
+        self.store = ProposalStore(store_path)
+        self.cache = FeatureCache(feature_cache_path)
+
+        assert self.cache.image_ids == self.store.image_ids and len(self.cache) == len(self.store.boxes), \
+            "The feature cache was not built from this proposal store, rebuild it"
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        features = torch.from_numpy(self.cache.features[self.store.proposal_slice(idx)])
+
+        proposals = self.store.proposals(idx)
+        proposal_targets = {
+            'boxes': torch.from_numpy(proposals['boxes'].astype(np.float32)),
+            'labels': torch.from_numpy(proposals['labels'].astype(np.int64)),
+            'gt_boxes': torch.from_numpy(self.store.matched_gt_boxes(idx)),
+            'image_id': self.store.image_ids[idx],
+        }
+
+        return features, proposal_targets, idx
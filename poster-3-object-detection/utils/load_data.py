@@ -1,175 +1,201 @@
 import os
-import glob
 import time
 import torch
 import json
-import xml.etree.ElementTree as ET
-import random
-import pickle as pk
 import numpy as np
 import matplotlib.pyplot as plt
 
 from PIL import Image
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
-from tensordict import TensorDict
+from torchvision.ops import roi_align
+from torchvision.transforms import functional as TF
+from utils.box_ops import box_iou
+from utils.proposal_store import ProposalStore, write_proposal_store
+from utils.crop_store import CropStore
 from utils.selective_search import generate_proposals_for_test_and_val
+from utils.logger import logger
 
 def collate_fn(batch):
-    images = [img for proposal_images in batch for img in proposal_images[0]]
-    targets = [tgt for proposal_targets in batch for tgt in proposal_targets[1]]
+    # The crops stay uint8 (n x H x W x C) until `prepare_crops` converts the whole batch
+    images = torch.cat([proposal_images for proposal_images, _, _ in batch])
+    targets = {
+        'boxes': torch.cat([t['boxes'] for _, t, _ in batch]),
+        'labels': torch.cat([t['labels'] for _, t, _ in batch]),
+        'gt_boxes': torch.cat([t['gt_boxes'] for _, t, _ in batch]),
+        'image_ids': [t['image_id'] for _, t, _ in batch],
+    }
     indices = [idx for _, _, idx in batch]
 
-    return torch.stack(images), targets, indices
+    return images, targets, indices
 
 class Trainingset(Dataset):
-    def __init__(self, image_dir, target_dir, transform=None):
-        self.image_files = sorted(glob.glob(os.path.join(image_dir, 'train_image_*.pkl')))
-        self.target_files = sorted(glob.glob(os.path.join(target_dir, 'train_target_*.pkl')))
-        self.transform = transform
+    """
+    Training proposals of every image. The crops come from the uint8 crop store and the targets from the
+    columnar proposal store of the split. Returns the n x H x W x C uint8 crops and one tensor per column:
+    - 'boxes': n x 4 proposal boxes in the original image
+    - 'labels': n labels (1 pothole, 0 background)
+    - 'gt_boxes': n x 4 matched ground truth boxes (zeros for background proposals)
 
-        assert len(self.image_files) == len(self.target_files), "Number of images and targets must be the same."
+    The crops are not converted to float here, use `prepare_crops` on the batch.
+    """
+    def __init__(self, crop_store_path, store_path):
+        self.store = ProposalStore(store_path)
+        self.crop_store = CropStore(crop_store_path)
+
+        assert self.crop_store.image_ids == self.store.image_ids, \
+            "The crop store and the proposal store were not built from the same images, rerun preprocessing.py"
 
     def __len__(self):
-        return len(self.image_files)
+        return len(self.store)
 
     def __getitem__(self, idx):
-        # Load the image proposals from the pickle file
-        with open(self.image_files[idx], 'rb') as img_f:
-            proposal_images = pk.load(img_f)
+        # View into the memory-mapped shard, only copied when the batch is collated
+        proposal_images = torch.from_numpy(self.crop_store.crops(idx))
 
-        # Load the corresponding target proposals from the pickle file
-        with open(self.target_files[idx], 'rb') as tgt_f:
-            proposal_targets = pk.load(tgt_f)
+        # Read the target columns of the image from the store
+        proposals = self.store.proposals(idx)
+        proposal_targets = {
+            'boxes': torch.from_numpy(proposals['boxes'].astype(np.float32)),
+            'labels': torch.from_numpy(proposals['labels'].astype(np.int64)),
+            'gt_boxes': torch.from_numpy(self.store.matched_gt_boxes(idx)),
+            'image_id': self.store.image_ids[idx],
+        }
 
-        # Apply the transformation, if any, to each proposal image
-        if self.transform:
-            proposal_images = [self.transform(img) if isinstance(img, Image.Image) else img for img in proposal_images]
+        assert len(proposal_images) == len(proposal_targets['labels']), "Number of images and targets must be the same."
 
         return proposal_images, proposal_targets, idx  
-    
-        
-def load_proposal_data(files, orig_data_path, proposal_dir, split):
-    image_paths = []
-    proposal_coords = []
-    image_ids = []
-    ground_truths = []
 
-    for file in files:
-        image_id = file
 
-        image_path = os.path.join(orig_data_path, "annotated-images", f"img-{image_id}.jpg")
+def crop_and_resize(image, boxes, output_size=(256, 256)):
+    """
+    Cuts all proposals out of one image and resizes them in a single batched `roi_align` call.
 
-        # Set paths for proposals and ground truths based on split
-        proposal_pickle_path = os.path.join(proposal_dir, f'{split}_target_img-{image_id}.pkl')
-        ground_truth_path = os.path.join(proposal_dir, f'img-{image_id}_gt.pkl')
+    RoIAlign with aligned=True treats the integer box corners as pixel borders, like `Image.crop`, and the adaptive
+    sampling ratio averages ceil(box size / output size) samples per output pixel, so large proposals are smoothed
+    like an antialiased resize. The result is close to `Image.crop` + `transforms.Resize` + `transforms.ToTensor`.
 
-        if not os.path.exists(proposal_pickle_path):
-            print(f"File not found: {proposal_pickle_path}")
-            continue
-        if not os.path.exists(ground_truth_path):
-            print(f"Ground truth file not found: {ground_truth_path}")
-            continue
+    Parameters:
+    -----------
+    image : torch.Tensor
+        3 x H x W float image in [0, 1] (e.g. from `TF.to_tensor`).
 
-        try:
-            # Load proposals
-            with open(proposal_pickle_path, 'rb') as f:
-                proposal_data = pk.load(f)
+    boxes : torch.Tensor
+        n x 4 proposal boxes (xmin, ymin, xmax, ymax) in pixels of the image.
 
-            if isinstance(proposal_data, tuple) and len(proposal_data) >= 2:
-                proposal_targets = proposal_data[1]
-            else:
-                print(f"Unexpected data format in {proposal_pickle_path}")
-                continue
-
-            if not proposal_targets:
-                print(f"No proposals found for image {image_id}")
-                continue
-
-            # Load ground truth data
-            with open(ground_truth_path, 'rb') as f:
-                ground_truth = pk.load(f)
-
-            coords = []
-            for target in proposal_targets:
-                if target is None:
-                    continue
-                try:
-                    x_min = int(target['image_xmin'])
-                    y_min = int(target['image_ymin'])
-                    x_max = int(target['image_xmax'])
-                    y_max = int(target['image_ymax'])
-
-                    if x_max > x_min and y_max > y_min:
-                        coords.append(TensorDict({
-                            'xmin': torch.tensor(x_min, dtype=torch.float32),
-                            'ymin': torch.tensor(y_min, dtype=torch.float32),
-                            'xmax': torch.tensor(x_max, dtype=torch.float32),
-                            'ymax': torch.tensor(y_max, dtype=torch.float32),
-                            'original_image_name': image_id
-                        }))
-                except KeyError as e:
-                    print(f"KeyError: {e} in target {target}")
-                    continue
-
-            if coords:
-                image_paths.append(image_path)
-                proposal_coords.append(coords)
-                image_ids.append(image_id)
-                ground_truths.append(ground_truth)
-            else:
-                print(f"No valid coordinates for image {image_id}")
+    output_size : tuple of int
+        (height, width) of the crops.
 
-        except Exception as e:
-            print(f"Error loading proposals for image {image_id}: {e}")
+    Returns:
+    --------
+    torch.Tensor
+        n x 3 x height x width float tensor.
+    """
+    boxes = boxes.to(device=image.device, dtype=image.dtype)
+    if len(boxes) == 0:
+        return image.new_zeros((0, image.shape[0]) + tuple(output_size))
+    return roi_align(image.unsqueeze(0), [boxes], output_size=output_size, spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+
+class ProposalCrops:
+    """
+    The proposal crops of one image, cut lazily: only the decoded 3 x H x W uint8 image and the n x 4 boxes are
+    kept. `to(device)` moves the image (instead of n resized crops) to the device and cuts and resizes all crops
+    there with `crop_and_resize`, so the DataLoader workers neither crop nor pass n x 3 x 256 x 256 floats around.
+
+    Used like the n x 3 x H x W crop tensor: `crops.to(device)` / `crops.cuda()` return that tensor.
+    """
+    def __init__(self, image, boxes, crop_size=(256, 256)):
+        self.image = image
+        self.boxes = boxes
+        self.crop_size = tuple(crop_size)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def to(self, device=None, non_blocking=False):
+        image = self.image.to(device, non_blocking=non_blocking).float().div_(255)
+        return crop_and_resize(image, self.boxes, self.crop_size)
 
-    return image_paths, proposal_coords, image_ids, ground_truths
+    def cuda(self, non_blocking=False):
+        return self.to('cuda', non_blocking=non_blocking)
+
+    def pin_memory(self):
+        # Called by a DataLoader with pin_memory=True
+        return ProposalCrops(self.image.pin_memory(), self.boxes.pin_memory(), self.crop_size)
 
 
 class ValAndTestDataset(Dataset):
-    def __init__(self, base_dir, split='val', transform=None, orig_data_path='Potholes'):
+    """
+    Validation and test images with their proposals. Returns the original image, the n x 3 x H x W proposal
+    crops, the n x 4 proposal boxes, the image id and the g x 4 ground truth boxes.
+
+    With crop_size=(H, W) the crops are returned as `ProposalCrops`: all crops are cut and resized together from
+    the decoded image with `crop_and_resize` once they are moved to the device. Otherwise every proposal is
+    cropped with PIL and passed through transform (slow, one proposal at a time).
+
+    With crop_proposals=False the crops are left out (an empty list is returned), e.g. for the shared-backbone
+    inference of `ResNetTwoHeads.forward_rois` which only needs the original image and the boxes.
+
+    With as_tensors=True the original image is returned as a 3 x H x W uint8 tensor instead of a PIL image, so
+    every payload except the image id is a tensor that DataLoader workers can pass through shared (and pinned)
+    memory. Use `image_size` and `image_to_tensor` to handle both.
+    """
+    def __init__(self, base_dir, split='val', transform=None, orig_data_path='Potholes', crop_proposals=True,
+                 crop_size=None, as_tensors=False):
         self.transform = transform
         self.split = split.lower()
+        self.crop_proposals = crop_proposals
+        self.crop_size = tuple(crop_size) if crop_size is not None else None
+        self.as_tensors = as_tensors
 
         assert split in ["val", "test"], "Split must be either 'val' or 'test'"
-        self.proposal_dir = os.path.join(base_dir, f'{self.split}_data', 'targets')
-
-        if not os.path.exists(self.proposal_dir):
-            raise FileNotFoundError(f"Directory not found: {self.proposal_dir}")
+        store_path = os.path.join(base_dir, f'{self.split}_proposals.store')
 
-        proposal_files = glob.glob(os.path.join(self.proposal_dir, f'{self.split}_target_img-*.pkl'))
-        self.files = [os.path.basename(file).replace(f'{self.split}_target_img-', '').replace('.pkl', '') for file in proposal_files]
+        if not os.path.exists(store_path):
+            raise FileNotFoundError(f"Proposal store not found: {store_path}")
 
+        self.store = ProposalStore(store_path)
 
-        self.image_paths, self.proposal_coords, self.image_ids, self.ground_truths = load_proposal_data(
-            self.files, orig_data_path, self.proposal_dir, split=split
-        )
+        # Only keep images that have proposals
+        self.indices = [i for i in range(len(self.store)) if self.store.num_proposals(i) > 0]
+        self.image_ids = [self.store.image_ids[i] for i in self.indices]
+        self.image_paths = [os.path.join(orig_data_path, "annotated-images", f"{image_id}.jpg") for image_id in self.image_ids]
 
     def __len__(self):
         return len(self.image_paths)
 
     def __getitem__(self, idx):
+        store_idx = self.indices[idx]
         image_path = self.image_paths[idx]
-        coords = self.proposal_coords[idx]
-        ground_truth = self.ground_truths[idx]
+        coords = torch.from_numpy(self.store.proposals(store_idx)['boxes'].astype(np.float32))
+        ground_truth = torch.from_numpy(np.array(self.store.ground_truth(store_idx)['boxes'], dtype=np.float32))
 
         with Image.open(image_path) as img:
             original_image = img.convert('RGB')
+        # The crops and the returned image share the decoded tensor
+        image_tensor = TF.pil_to_tensor(original_image) if self.as_tensors or self.crop_size is not None else None
+        if self.as_tensors:
+            original_image = image_tensor
 
         cropped_proposals_images = []
-        for coord in coords:
-            x_min = int(coord['xmin'])
-            y_min = int(coord['ymin'])
-            x_max = int(coord['xmax'])
-            y_max = int(coord['ymax'])
-            proposal_image = original_image.crop((x_min, y_min, x_max, y_max))
+        if not self.crop_proposals:
+            return original_image, cropped_proposals_images, coords, self.image_ids[idx], ground_truth
+
+        if self.crop_size is not None:
+            cropped_proposals_images = ProposalCrops(image_tensor, coords, self.crop_size)
+            return original_image, cropped_proposals_images, coords, self.image_ids[idx], ground_truth
+
+        pil_image = as_pil_image(original_image)
+        for x_min, y_min, x_max, y_max in coords.to(torch.int64).tolist():
+            proposal_image = pil_image.crop((x_min, y_min, x_max, y_max))
 
             if self.transform:
                 proposal_image = self.transform(proposal_image)
 
             cropped_proposals_images.append(proposal_image)
 
-        return original_image, cropped_proposals_images, coords, self.image_ids[idx], ground_truth
+        return original_image, torch.stack(cropped_proposals_images), coords, self.image_ids[idx], ground_truth
 
 
 def val_test_collate_fn_cropped(batch):
@@ -187,128 +213,200 @@ def val_test_collate_fn_cropped(batch):
         batch_ground_truths.append(ground_truth)
 
     return batch_original_images, batch_proposal_images, batch_coords, batch_image_ids, batch_ground_truths
-def get_xml_data(xml_path):
-    
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
 
-    # Initialize lists for the target
-    targets = []
 
-    # Iterate through each object in the XML file
-    for obj in root.findall('object'):
-    
-        # If the box is a pothole the label is 1 (True)
-        if obj.find('name').text == 'pothole':
-            label = 1
-        else:
-            label = 0
-
-        # Extract bounding box coordinates
-        bndbox = obj.find('bndbox')
-        xmin = int(bndbox.find('xmin').text)
-        ymin = int(bndbox.find('ymin').text)
-        xmax = int(bndbox.find('xmax').text)
-        ymax = int(bndbox.find('ymax').text)
-
-        # Append bounding box and label. TensorDict is used to convert the dictionary to a tensor
-        directory = TensorDict({
-            'xmin'  : torch.tensor(xmin, dtype=torch.float32),
-            'ymin'  : torch.tensor(ymin, dtype=torch.float32),
-            'xmax'  : torch.tensor(xmax, dtype=torch.float32),
-            'ymax'  : torch.tensor(ymax, dtype=torch.float32),
-            'labels': torch.tensor(label, dtype=torch.int64)
-        })
-
-        targets.append(directory)
-    
-    return targets
-    
-def pickle_save(final_image, final_target, save_images_path, save_targets_path, index, split='train' ):
-    if split == 'train':
-        # Create the directory in the blackhole path if it doesn't exist
-        os.makedirs(save_images_path, exist_ok=True)
-        os.makedirs(save_targets_path, exist_ok=True)
-
-        # Save the files to the BLACKHOLE path
-        with open(os.path.join(save_images_path, f'train_image_{index}.pkl'), 'wb') as f:
-            pk.dump(final_image, f)
-        with open(os.path.join(save_targets_path, f'train_target_{index}.pkl'), 'wb') as f:
-            pk.dump(final_target, f)
-
-    elif split == 'val':
-        os.makedirs(save_targets_path, exist_ok=True)
-
-        # Save the files to the BLACKHOLE path
-        with open(os.path.join(save_targets_path, f'val_target_{index}.pkl'), 'wb') as f:
-            pk.dump(final_target, f)
-    elif split == 'test':
-        os.makedirs(save_targets_path, exist_ok=True)
-
-        # Save the files to the BLACKHOLE path
-        with open(os.path.join(save_targets_path, f'test_target_{index}.pkl'), 'wb') as f:
-            pk.dump(final_target, f)
-
-
-def class_balance(proposal_images, proposal_targets, seed, count):
-    # Initialize lists for the proposals and targets
-    class_1_proposals = []
-    class_1_targets = []
-    class_0_proposals = []
-    class_0_targets = []
-    
-    random.seed(seed)
-    # Loop through each proposal and target
-    for image, target in zip(proposal_images, proposal_targets):
-        if int(target['label']) == 1:  # Assuming 'labels' is the correct key
-            class_1_proposals.append(image)
-            class_1_targets.append(target)
-        else:
-            class_0_proposals.append(image)
-            class_0_targets.append(target)                
-
-    # Class balancing
-    total_class_1 = len(class_1_proposals)   # 25 % of the class 0 proposals
-    total_class_0_ideal = int(total_class_1 * 3)     # 75 % of the class 0 proposals 
-    total_class_0 = len(class_0_proposals)
-
-    # If the number of class 0 proposals is greater than the ideal number of class 0 proposals
-    if total_class_0 > total_class_0_ideal:
-        # Randomly sample the indices of the class 0 proposals to keep 
-        indicies = random.sample(range(total_class_0), total_class_0_ideal)
-        # Create new lists of class 0 proposals and targets with the sampled indices
-        class_0_proposals_new = [class_0_proposals[i] for i in indicies]
-        class_0_targets_new = [class_0_targets[i] for i in indicies]
-    else:
-        class_0_proposals_new = class_0_proposals
-        class_0_targets_new = class_0_targets
-        
-    # sanity check that the ideal and the new class 0 proposals are the same
-    assert len(class_0_proposals_new) == total_class_0_ideal, \
-        f"Expected {total_class_0_ideal} class 0 proposals, but got {len(class_0_proposals_new)}"
-
-    # Combine the class 0 and class 1 proposals
-    image_proposals = class_0_proposals_new + class_1_proposals
-    image_targets = class_0_targets_new + class_1_targets
-
-    if image_proposals and image_targets:
-        # combine the proposals and targets and shuffle them
-        combined = list(zip(image_proposals, image_targets))
-        random.shuffle(combined)
-        image_proposals, image_targets = zip(*combined)
-
-        return image_proposals, image_targets
+def image_size(image):
+    """
+    (width, height) of an original image, a PIL image or a 3 x H x W tensor (like `PIL.Image.size`).
+    """
+    if isinstance(image, torch.Tensor):
+        return int(image.shape[-1]), int(image.shape[-2])
+    return image.size
+
+
+def image_to_tensor(image, device=None):
+    """
+    The original image as a 1 x 3 x H x W float tensor in [0, 1] on device (like `TF.to_tensor`), from a PIL
+    image or a 3 x H x W uint8 tensor.
+    """
+    if not isinstance(image, torch.Tensor):
+        return TF.to_tensor(image).unsqueeze(0).to(device)
+    image = image.to(device, non_blocking=True)
+    if image.dtype == torch.uint8:
+        image = image.float().div_(255)
+    return image.unsqueeze(0)
+
+
+def as_pil_image(image):
+    """
+    The original image as a PIL image (for plotting), from a PIL image or a 3 x H x W uint8 tensor.
+    """
+    if isinstance(image, torch.Tensor):
+        return TF.to_pil_image(image.cpu())
+    return image
+
+
+class EvalPrefetcher:
+    """
+    Wraps a validation or test DataLoader (`val_test_collate_fn_cropped` batches of a `ValAndTestDataset` with
+    as_tensors=True) and moves the next batch to the device while the current one is evaluated.
+
+    Before batch k is handed out, the images, boxes and crops of batch k + 1 are already requested from the
+    DataLoader workers and copied to the device (`ProposalCrops` are cut and resized there). On CUDA this runs on
+    a side stream, so the copies and the crop preparation of image k + 1 overlap with the inference on image k.
+    Ground truth boxes stay on the CPU.
+
+    After every full pass the wall-clock time spent waiting for data (loading, copying and cropping) and the
+    time spent by the caller (compute) are logged. With CUDA the times are host side, asynchronous kernels are
+    counted where the host waits for them.
+    """
+    def __init__(self, data_loader, device, name='eval'):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.name = name
+        self.stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+        self.load_time = 0.0
+        self.compute_time = 0.0
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    @property
+    def dataset(self):
+        return self.data_loader.dataset
+
+    def _to_device(self, batch):
+        images, proposal_images_list, coords, image_ids, ground_truths = batch
+        images = [image.to(self.device, non_blocking=True) if isinstance(image, torch.Tensor) else image for image in images]
+        proposal_images_list = [crops.to(self.device, non_blocking=True) if len(crops) > 0 else crops
+                                for crops in proposal_images_list]
+        coords = [boxes.to(self.device, non_blocking=True) for boxes in coords]
+        return images, proposal_images_list, coords, image_ids, ground_truths
+
+    def _load(self, data_iter):
+        start = time.perf_counter()
+        batch = next(data_iter, None)
+        if batch is not None:
+            if self.stream is not None:
+                with torch.cuda.stream(self.stream):
+                    batch = self._to_device(batch)
+            else:
+                batch = self._to_device(batch)
+        self.load_time += time.perf_counter() - start
+        return batch
+
+    def __iter__(self):
+        self.load_time = 0.0
+        self.compute_time = 0.0
+        num_images = 0
+
+        data_iter = iter(self.data_loader)
+        next_batch = self._load(data_iter)
+        while next_batch is not None:
+            batch = next_batch
+            if self.stream is not None:
+                # The default stream must not use the tensors before the side stream has finished them
+                torch.cuda.current_stream().wait_stream(self.stream)
+                for tensor in [t for group in batch[:3] for t in group if isinstance(t, torch.Tensor)]:
+                    tensor.record_stream(torch.cuda.current_stream())
+
+            # Start loading the next batch before the caller works on this one
+            next_batch = self._load(data_iter)
+            num_images += len(batch[3])
+
+            start = time.perf_counter()
+            yield batch
+            self.compute_time += time.perf_counter() - start
+
+        total = self.load_time + self.compute_time
+        if total > 0:
+            logger.info(
+                f"{self.name}: {num_images} images in {total:.1f}s - loading {self.load_time:.1f}s "
+                f"({100 * self.load_time / total:.0f}%), compute {self.compute_time:.1f}s ({100 * self.compute_time / total:.0f}%)"
+            )
+
+
+def make_proposal_record(image_id, proposal_targets, original_targets):
+    """
+    Converts the proposal target dictionaries of one image into the column arrays of the proposal store.
+    original_targets is the ground truth of the image as plain arrays, see `AnnotationIndex.ground_truth`.
+
+    The best matching ground truth of every proposal is found with one IoU matrix. Proposals that carry a
+    'label' (training) keep it, all others are stored with label -1.
+    """
+    boxes = np.array([
+        [float(t['image_xmin']), float(t['image_ymin']), float(t['image_xmax']), float(t['image_ymax'])]
+        for t in proposal_targets
+    ], dtype=np.float64).reshape(-1, 4)
+    gt_boxes = np.asarray(original_targets['boxes'], dtype=np.float64).reshape(-1, 4)
+    gt_labels = np.asarray(original_targets['labels'], dtype=np.int8)
+
+    if len(boxes) > 0 and len(gt_boxes) > 0:
+        ious = box_iou(boxes, gt_boxes)
+        best_ious = ious.max(axis=1)
+        best_gt = ious.argmax(axis=1)
     else:
-        print(f"No proposals and targets found for the image")
-        print(f"- Proposals generated in total: {len(proposal_images)}")
-        print(f"- Class 0 proposals: {len(class_0_proposals)}")
-        print(f"- Class 1 proposals: {len(class_1_proposals)}")
+        best_ious = np.zeros(len(boxes))
+        best_gt = np.full(len(boxes), -1)
+
+    labels = np.array([int(t['label']) if 'label' in t else -1 for t in proposal_targets], dtype=np.int8)
+
+    # Only positive proposals are matched with a ground truth box
+    gt_index = np.where(labels == 1, best_gt, -1)
+
+    return {
+        'image_id': image_id,
+        'boxes': boxes.astype(np.int16),
+        'labels': labels,
+        'gt_index': gt_index.astype(np.int16),
+        'ious': best_ious.astype(np.float32),
+        'gt_boxes': gt_boxes.astype(np.float32),
+        'gt_labels': gt_labels,
+    }
+
+
+def save_proposal_record(record, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+    np.savez(tmp_path, **record)
+    os.replace(tmp_path, path)
+
+
+def load_proposal_record(path):
+    with np.load(path) as data:
+        record = {key: data[key] for key in data.files}
+    record['image_id'] = str(record['image_id'])
+    return record
+
+
+def proposal_record_path(records_dir, split, image_id, params_hash):
+    """
+    Path of the per-image record of a split, the parameter hash keeps records of other settings apart.
+    """
+    return os.path.join(records_dir, f'{split}_record_{image_id}-{params_hash}.npz')
+
+
+def build_proposal_store(records_dir, split, image_ids, store_path, params_hash, meta=None):
+    """
+    Collects the per-image records of a split (written by the preprocessing workers with the parameters of
+    params_hash) into one proposal store. Images without a record (e.g. no labeled proposals) are left out.
+    """
+    records = []
+    for image_id in image_ids:
+        record_path = proposal_record_path(records_dir, split, image_id, params_hash)
+        if os.path.exists(record_path):
+            records.append(load_proposal_record(record_path))
+
+    write_proposal_store(store_path, records, meta={'split': split, 'params_hash': params_hash, **(meta or {})})
+    return len(records)
+
+
+def atomic_write_json(obj, path):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
 
-        return None, None
-    
-def save_ground_truth(ground_truth_path, original_targets):
-    with open(ground_truth_path, 'wb') as f:
-        pk.dump(original_targets, f)
 
 import matplotlib.patches as patches
 
@@ -318,7 +416,7 @@ def plot_original_and_crops(original_image, ground_truth, cropped_images, n=5):
     
     Parameters:
     - original_image: PIL.Image.Image, the original image.
-    - ground_truth: list of TensorDicts, each containing 'xmin', 'ymin', 'xmax', 'ymax', and optionally 'labels'.
+    - ground_truth: g x 4 tensor or array of (xmin, ymin, xmax, ymax) ground truth boxes.
     - cropped_images: list of transformed proposal images (torch.Tensor).
     - n: int, number of cropped images to display.
     """
@@ -340,11 +438,7 @@ def plot_original_and_crops(original_image, ground_truth, cropped_images, n=5):
     ax = axes[0]
     for gt in ground_truth:
         try:
-            xmin = gt['xmin'].item()
-            ymin = gt['ymin'].item()
-            xmax = gt['xmax'].item()
-            ymax = gt['ymax'].item()
-            label = gt['labels'].item() if 'labels' in gt.keys() else None
+            xmin, ymin, xmax, ymax = [float(v) for v in gt]
             
             # Create a Rectangle patch
             rect = patches.Rectangle((xmin, ymin), xmax - xmin, ymax - ymin, 
@@ -352,11 +446,6 @@ def plot_original_and_crops(original_image, ground_truth, cropped_images, n=5):
             # Add the patch to the Axes
             ax.add_patch(rect)
             
-            # Optionally, add labels
-            #if label is not None:
-            #    ax.text(xmin, ymin - 5, f'Label: {label}', 
-            #            color='yellow', fontsize=8, 
-            #            bbox=dict(facecolor='red', alpha=0.5))
         except Exception as e:
             print(f"Error plotting ground truth box: {e}")
     
@@ -3,6 +3,9 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import torch
 from typing import Dict, List
+from utils.box_ops import box_iou
+from utils.nms import nms, soft_nms
+from utils.detection_eval import evaluate_detections, average_precision
 
 def IoU(
     box1_xmin: float,
@@ -87,34 +90,45 @@ def best_proposal(proposals, ground_truth_box, return_box=False):
     Gets the highest IoU of one ground truth with all proposals.
     Can also return the box coordinates for the best proposal.
     (The BO in MABO)
+
+    The proposals are an N x 4 array (or list) of (xmin, ymin, xmax, ymax) boxes and the ground truth is a
+    single (xmin, ymin, xmax, ymax) box. All IoUs are computed with one call to box_iou.
     '''
-    if not proposals:
+    if len(proposals) == 0:
         return (0.0, None) if return_box else 0.0
-    
-    best_iou = 0.0
-    best_box = None
-
-    for prop in proposals:
-        iou = IoU(ground_truth_box, prop)
-        if iou > best_iou:
-            best_iou = iou
-            best_box = prop
+
+    proposals = np.asarray(proposals, dtype=np.float64).reshape(-1, 4)
+    ious = box_iou(np.asarray(ground_truth_box, dtype=np.float64).reshape(1, 4), proposals)[0]
+    best_idx = int(np.argmax(ious))
+    best_iou = float(ious[best_idx])
     
     if return_box:
-        return best_iou, best_box
+        return best_iou, (proposals[best_idx] if best_iou > 0 else None)
     else:
         return best_iou
 
 
+def best_overlaps(ground_truth_boxes, proposals):
+    '''
+    Gets the best IoU of every ground truth box with all proposals as an array, using one G x N IoU matrix.
+    '''
+    ground_truth_boxes = np.asarray(ground_truth_boxes, dtype=np.float64).reshape(-1, 4)
+    proposals = np.asarray(proposals, dtype=np.float64).reshape(-1, 4)
+    if len(ground_truth_boxes) == 0 or len(proposals) == 0:
+        return np.zeros(len(ground_truth_boxes))
+
+    return box_iou(ground_truth_boxes, proposals).max(axis=1)
+
+
 def abo(ground_truth_boxes, proposals):
     '''
     Gets the average best IoU over all objects in an image.
     '''
-    if not ground_truth_boxes:
+    if len(ground_truth_boxes) == 0:
         return 0
 
-    # Calculate the sum of best IoUs for each ground truth box
-    abo = sum(best_proposal(proposals, gt_box) for gt_box in ground_truth_boxes) / len(ground_truth_boxes)
+    # Average of the best IoU for each ground truth box
+    abo = float(best_overlaps(ground_truth_boxes, proposals).mean())
 
     return abo
 
@@ -128,60 +142,84 @@ def recall(ground_truth_boxes, proposals, k=0.5):
     '''
     Returns the recall percentage for all objects of one class.
     '''
-    if not ground_truth_boxes:
+    if len(ground_truth_boxes) == 0:
         return 0
 
     # Count ground truth boxes with at least one "good" proposal
-    num_good = sum(1 for gt_box in ground_truth_boxes if best_proposal(proposals, gt_box) > k)
+    num_good = int((best_overlaps(ground_truth_boxes, proposals) > k).sum())
     recall = num_good / len(ground_truth_boxes)
     return recall
 
 
 def non_max_suppression(
     tensor_dict_list: List[Dict], 
-    iou_threshold: float = 0.3
+    iou_threshold: float = 0.3,
+    method: str = 'greedy',
+    sigma: float = 0.5,
+    score_threshold: float = 0.001
 ) -> List[Dict]:
     """
     Applies Non-Maximum Suppression (NMS) to filter overlapping bounding boxes based on their Intersection over Union (IoU) scores.
-    """
-    if not tensor_dict_list:
-        return []
 
-    # Sort the predictions by confidence score in descending order
-    sorted_targets = sorted(
-        tensor_dict_list,
-        key=lambda x: x['pre_class'],
-        reverse=True
-    )
+    This is a thin adapter around the array based engine in utils/nms.py. It takes the prediction dictionaries
+    ('pre_bbox_xmin', 'pre_bbox_ymin', 'pre_bbox_xmax', 'pre_bbox_ymax', 'pre_class') and returns the kept
+    dictionaries sorted by decreasing 'pre_class'.
 
-    bboxes_after_nms = []
+    Parameters:
+    -----------
+    tensor_dict_list : List[Dict]
+        The predictions for one image.
 
-    while sorted_targets:
-        # Select the target with the highest 'pre_class'
-        chosen_target = sorted_targets.pop(0)
-        bboxes_after_nms.append(chosen_target)
+    iou_threshold : float
+        Boxes overlapping a kept box with at least this IoU are removed ('greedy') or decayed ('soft_linear').
 
-        # Filter out overlapping boxes based on IoU
-        remaining_targets = []
-        for target in sorted_targets:
-            iou = IoU(
-                chosen_target["pre_bbox_xmin"], chosen_target["pre_bbox_ymin"],
-                chosen_target["pre_bbox_xmax"], chosen_target["pre_bbox_ymax"], 
-                target["pre_bbox_xmin"], target["pre_bbox_ymin"],
-                target["pre_bbox_xmax"], target["pre_bbox_ymax"]
-            )
+    method : str
+        'greedy' for standard NMS, 'soft' for Gaussian Soft-NMS or 'soft_linear' for linear Soft-NMS.
+        With Soft-NMS the returned dictionaries are copies with the decayed score in 'pre_class'.
 
-            if iou < iou_threshold:
-                remaining_targets.append(target)
+    sigma : float
+        Sigma of the Gaussian Soft-NMS.
 
-        sorted_targets = remaining_targets
+    score_threshold : float
+        Soft-NMS drops boxes whose decayed score is below this value.
+    """
+    if not tensor_dict_list:
+        return []
 
-    return bboxes_after_nms
+    boxes = np.array([
+        [float(t['pre_bbox_xmin']), float(t['pre_bbox_ymin']), float(t['pre_bbox_xmax']), float(t['pre_bbox_ymax'])]
+        for t in tensor_dict_list
+    ], dtype=np.float32)
+    scores = np.array([float(t['pre_class']) for t in tensor_dict_list], dtype=np.float32)
+
+    if method == 'greedy':
+        keep = nms(boxes, scores, iou_threshold=iou_threshold)
+        return [tensor_dict_list[i] for i in keep]
+
+    elif method in ('soft', 'soft_linear'):
+        keep, new_scores = soft_nms(
+            boxes, scores, iou_threshold=iou_threshold, sigma=sigma, score_threshold=score_threshold,
+            method='gaussian' if method == 'soft' else 'linear'
+        )
+        bboxes_after_nms = []
+        for i, score in zip(keep, new_scores):
+            target = dict(tensor_dict_list[i])
+            target['pre_class'] = float(score)
+            bboxes_after_nms.append(target)
+        return bboxes_after_nms
+
+    else:
+        raise ValueError(f"NMS method '{method}' is not recognized.")
 
 
 def calculate_precision_recall(ground_truths, predictions, iou_threshold):
     """
-    Calculate precision, recall, and mean average precision (mAP) for object detection.
+    Calculate precision and recall for object detection.
+
+    The predictions of every image are greedily matched to its ground truth boxes in order of decreasing
+    probability, and every ground truth box can be matched only once. The precision and recall are then
+    computed after every prediction, with the predictions of all images ranked by probability. See
+    utils/detection_eval.py for the vectorized implementation and for several thresholds at once.
 
     Parameters:
     -----------
@@ -197,119 +235,23 @@ def calculate_precision_recall(ground_truths, predictions, iou_threshold):
     Returns:
     --------
     np.ndarray
-        A numpy array with columns [precision, recall].
+        The precision after every ranked prediction.
 
-    float
-        The mean average precision (mAP) calculated without interpolation.
+    np.ndarray
+        The recall after every ranked prediction, relative to the number of ground truth boxes.
     """
-
-    TP = []
-    FP = []
-    total_gt = []
-    pre_prob = []
-    
-    # Get ground truth and predictions for one image
-
-    for gt_boxes, pred_boxes in zip(ground_truths, predictions):
-        # Sort the predictions so we are looking on the boxes with the highest probability
-        pred_boxes = sorted(pred_boxes, key=lambda x: x['pre_class'], reverse=True)
-
-        # Create an set, to ensure that we are not going to match multiple prediction with the same ground truth box
-        gt_matched = set()
-
-        for i, pred_box in enumerate(pred_boxes):
-            
-            # This below is used to keep track of the highest IoU for a prediction. We use j as the index for the ground truth 
-            best_iou = 0.0
-            best_gt_idx = -1
-            for j, gt_box in enumerate(gt_boxes):
-
-                #If we don't have the ground truth in our set we will calculate the IoU
-                if j not in gt_matched:
-                    iou = IoU(pred_box["pre_bbox_xmin"], pred_box["pre_bbox_ymin"],
-                        pred_box["pre_bbox_xmax"], pred_box["pre_bbox_ymax"], 
-                        gt_box["xmin"], gt_box["ymin"],
-                        gt_box["xmax"], gt_box["ymax"]
-                    )
-
-                    # If it is above the best IoU, we will remember it
-                    if iou > best_iou:
-                        best_iou = iou
-                        best_gt_idx = j
-
-            # Append the predicted probability so we can use it to sort when calculation the mAP
-            pre_prob.append(pred_box['pre_class'])
-            # Check if the best IoU is above a certain threshold. If it is, we will append 1 to TP and 0 to FP
-            if best_iou >= iou_threshold:
-                TP.append(1)
-                FP.append(0)
-                total_gt.append(1)
-            else:
-                TP.append(0)
-                FP.append(1)
-
-    # Convert the list into numpy, so we can sort based on the highest probability             
-    TP = np.array(TP)
-    FP = np.array(FP)
-    pre_prob = np.array(pre_prob)
-
-    # Get the sorted indices based on pre_prob in descending order
-    sorted_indices = np.argsort(pre_prob)[::-1] # argsort return for lowest to highest but since we want it reverse we use the slicing syntax
-
-    # Sort TP, FP, and pre_prob based on these indices
-    TP_sorted = TP[sorted_indices]
-    FP_sorted = FP[sorted_indices]
-    pre_prob_sorted = pre_prob[sorted_indices]
-
-    # Calculate the precision and recall
-
-    precision_values = []
-    recall_values = []
-
-    cumulative_TP = 0 
-    cumulative_FP = 0 
-    epsilon = np.finfo(float).eps
-    for i in range(len(TP_sorted)):
-        # Update cumulative TP and FP up to the current index
-        cumulative_TP += TP_sorted[i]
-        cumulative_FP += FP_sorted[i]
-
-        # Calculate precision and recall at the current step
-
-        precision = cumulative_TP / (cumulative_TP + cumulative_FP + epsilon)
-        recall = cumulative_TP / ( len(total_gt) + epsilon)
-
-        # Append to the lists
-        precision_values.append(precision)
-        recall_values.append(recall)
-    
-    return precision_values, recall_values
+    result = evaluate_detections(ground_truths, predictions, iou_thresholds=[iou_threshold])
+    return result['precision'][0], result['recall'][0]
 
 def calculate_mAP(precision_list, recall_list):
     """
     Calculate mean Average Precision (mAP) from precision and recall lists.
     """
-    # Convert lists to numpy arrays
-    precision = np.array(precision_list)
-    recall = np.array(recall_list)
-
     # Check if precision and recall lists are empty
-    if len(precision) == 0 or len(recall) == 0:
+    if len(precision_list) == 0 or len(recall_list) == 0:
         return 0.0
 
-    # Append sentinel values at the start and end
-    mrec = np.concatenate(([0.0], recall, [1.0]))
-    mpre = np.concatenate(([0.0], precision, [0.0]))
-
-    # Compute the precision envelope
-    for i in range(len(mpre) - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
-
-    # Calculate mAP
-    idx = np.where(mrec[1:] != mrec[:-1])[0]
-    mAP = np.sum((mrec[idx + 1] - mrec[idx]) * mpre[idx + 1])
-
-    return mAP
+    return float(average_precision(np.asarray(precision_list, dtype=np.float64), np.asarray(recall_list, dtype=np.float64))[0])
 
 # utils/metrics.py
 def compute_iou(box1, box2):
@@ -0,0 +1,178 @@
+import torch
+
+from typing import Tuple
+from utils.box_ops import ArrayLike, as_box_tensor, like_input, box_iou
+
+
+def nms(boxes: ArrayLike, scores: ArrayLike, iou_threshold: float = 0.3) -> ArrayLike:
+    """
+    Greedy Non-Maximum Suppression on an array of boxes.
+
+    The IoU matrix is computed once for all boxes, after which the greedy pass only walks the boxes in score
+    order and suppresses whole rows at a time. A box is suppressed when its IoU with an already kept box is
+    greater than or equal to `iou_threshold`, which is the same rule as the original dict based implementation.
+
+    Parameters:
+    -----------
+    boxes : np.ndarray or torch.Tensor
+        An N x 4 array of (xmin, ymin, xmax, ymax) boxes.
+
+    scores : np.ndarray or torch.Tensor
+        An array with N confidence scores.
+
+    iou_threshold : float
+        Boxes overlapping a kept box with at least this IoU are removed.
+
+    Returns:
+    --------
+    np.ndarray or torch.Tensor
+        The indices of the kept boxes sorted by decreasing score. The type follows the type of `boxes`.
+    """
+    boxes_t = as_box_tensor(boxes)
+    scores_t = torch.as_tensor(scores, dtype=torch.float32).reshape(-1)
+
+    if boxes_t.shape[0] == 0:
+        return like_input(torch.empty(0, dtype=torch.int64), boxes)
+
+    # Stable sort so that boxes with the same score keep their original order
+    order = torch.sort(scores_t, descending=True, stable=True).indices
+    ious = box_iou(boxes_t[order], boxes_t[order])
+
+    suppressed = torch.zeros(len(order), dtype=torch.bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= ious[i] >= iou_threshold
+
+    keep = order[torch.tensor(keep, dtype=torch.int64)]
+    return like_input(keep, boxes)
+
+
+def soft_nms(
+    boxes: ArrayLike,
+    scores: ArrayLike,
+    iou_threshold: float = 0.3,
+    sigma: float = 0.5,
+    score_threshold: float = 0.001,
+    method: str = 'gaussian'
+) -> Tuple[ArrayLike, ArrayLike]:
+    """
+    Soft Non-Maximum Suppression (Bodla et al., 2017).
+
+    Instead of removing overlapping boxes, their scores are decayed based on the IoU with the currently selected
+    box. Boxes whose score falls below `score_threshold` are dropped.
+
+    Parameters:
+    -----------
+    boxes : np.ndarray or torch.Tensor
+        An N x 4 array of (xmin, ymin, xmax, ymax) boxes.
+
+    scores : np.ndarray or torch.Tensor
+        An array with N confidence scores.
+
+    iou_threshold : float
+        Only used by the 'linear' method. Boxes with an IoU above this value get their score scaled by (1 - IoU).
+
+    sigma : float
+        Only used by the 'gaussian' method. The score is scaled by exp(-IoU^2 / sigma).
+
+    score_threshold : float
+        Boxes with a decayed score below this value are removed.
+
+    method : str
+        Either 'gaussian' or 'linear'.
+
+    Returns:
+    --------
+    tuple
+        - keep : indices of the kept boxes in the order they were selected.
+        - scores : the decayed scores of the kept boxes.
+    """
+    if method not in ('gaussian', 'linear'):
+        raise ValueError(f"Soft-NMS method '{method}' is not recognized.")
+
+    boxes_t = as_box_tensor(boxes)
+    scores_t = torch.as_tensor(scores, dtype=torch.float32).reshape(-1).clone()
+
+    if boxes_t.shape[0] == 0:
+        return like_input(torch.empty(0, dtype=torch.int64), boxes), like_input(torch.empty(0), scores)
+
+    ious = box_iou(boxes_t, boxes_t)
+    remaining = torch.ones(len(scores_t), dtype=torch.bool)
+    keep = []
+    kept_scores = []
+
+    while remaining.any():
+        # Pick the remaining box with the highest (decayed) score
+        masked_scores = torch.where(remaining, scores_t, torch.full_like(scores_t, -float('inf')))
+        i = int(torch.argmax(masked_scores))
+        if scores_t[i] < score_threshold:
+            break
+
+        keep.append(i)
+        kept_scores.append(float(scores_t[i]))
+        remaining[i] = False
+
+        # Decay the scores of all the remaining boxes at once
+        iou = ious[i]
+        if method == 'gaussian':
+            decay = torch.exp(-(iou ** 2) / sigma)
+        else:
+            decay = torch.where(iou > iou_threshold, 1.0 - iou, torch.ones_like(iou))
+        scores_t = torch.where(remaining, scores_t * decay, scores_t)
+        remaining &= scores_t >= score_threshold
+
+    keep = torch.tensor(keep, dtype=torch.int64)
+    kept_scores = torch.tensor(kept_scores, dtype=torch.float32)
+    return like_input(keep, boxes), like_input(kept_scores, scores)
+
+
+def batched_nms(
+    boxes: ArrayLike,
+    scores: ArrayLike,
+    group_ids: ArrayLike,
+    iou_threshold: float = 0.3
+) -> ArrayLike:
+    """
+    Runs greedy NMS independently for every group (e.g. every image or every class) in one call.
+
+    The boxes are split by group and every group gets its own NMS, so the IoU matrices only cover the boxes of
+    one group and boxes of different groups never suppress each other.
+
+    Parameters:
+    -----------
+    boxes : np.ndarray or torch.Tensor
+        An N x 4 array of (xmin, ymin, xmax, ymax) boxes.
+
+    scores : np.ndarray or torch.Tensor
+        An array with N confidence scores.
+
+    group_ids : np.ndarray or torch.Tensor
+        An array with N integers telling which group (image) every box belongs to.
+
+    iou_threshold : float
+        Boxes overlapping a kept box of the same group with at least this IoU are removed.
+
+    Returns:
+    --------
+    np.ndarray or torch.Tensor
+        The indices of the kept boxes sorted by decreasing score.
+    """
+    boxes_t = as_box_tensor(boxes)
+    scores_t = torch.as_tensor(scores, dtype=torch.float32).reshape(-1)
+    group_t = torch.as_tensor(group_ids, dtype=torch.int64).reshape(-1)
+
+    if boxes_t.shape[0] == 0:
+        return like_input(torch.empty(0, dtype=torch.int64), boxes)
+
+    keep = []
+    for group in torch.unique(group_t):
+        indices = torch.nonzero(group_t == group).reshape(-1)
+        keep.append(indices[nms(boxes_t[indices], scores_t[indices], iou_threshold)])
+
+    # Same order as a single NMS over all boxes: by decreasing score, ties in the original order
+    keep = torch.sort(torch.cat(keep)).values
+    keep = keep[torch.sort(scores_t[keep], descending=True, stable=True).indices]
+    return like_input(keep, boxes)
@@ -0,0 +1,237 @@
+import math
+import numpy as np
+import torch
+
+from torch.utils.data import Dataset, Sampler
+
+
+class ProposalBatchSampler(Sampler):
+    """
+    Draws balanced mini-batches of training proposals online, so the ratio of positives and negatives can change
+    without rerunning the preprocessing (the proposal store keeps every labeled proposal). Every epoch draws new
+    negatives.
+
+    Two modes:
+    - per_image=False: fixed-size batches of batch_size global proposal rows across all training images, of which
+      round(batch_size * positive_fraction) are positives (label 1) and the rest negatives (label 0). When the
+      positives run out the batch is filled up with negatives, so the batch size never changes. Positives and
+      negatives are drawn from their own shuffled order and reshuffled when exhausted, so every positive is seen
+      once per epoch before any is repeated.
+    - per_image=True: one batch per image (with positives) in random order, with all its positives and as many
+      negatives as make positive_fraction of the batch positives (1:3 for 0.25), like the balancing that used to
+      be done once during preprocessing.
+
+    With hard_negative_fraction > 0 that fraction of the negatives of every batch are hard negatives: the
+    negatives with the highest pothole probability the classifier gave them the last time they were trained on
+    (see `update_scores`). Negatives that were never scored count as hard.
+
+    Use it as the `sampler` of a DataLoader with batch_size=None over a `ProposalBatchset`, so workers prefetch
+    whole mini-batches.
+
+    Parameters:
+    -----------
+    labels : array of int
+        The label of every proposal row of the store (`ProposalStore.labels`), -1 rows are never sampled.
+
+    offsets : array of int
+        The proposal offsets of the store (`ProposalStore.offsets`).
+
+    image_indices : list of int, optional
+        Only sample proposals of these images (e.g. the indices of a training subset).
+
+    batch_size : int
+        Number of proposals per batch (per_image=False).
+
+    positive_fraction : float
+        Fraction of positives per batch.
+
+    num_batches : int, optional
+        Number of batches per epoch (per_image=False). Defaults to the number of batches needed to see every
+        positive once.
+
+    per_image : bool
+        Draw one batch per image instead of fixed-size batches across the images.
+
+    hard_negative_fraction : float
+        Fraction of the negatives of a batch that are hard negatives.
+
+    seed : int
+        Seed of the sampling, the order of epoch e is drawn with seed + e.
+    """
+    def __init__(self, labels, offsets, image_indices=None, batch_size=128, positive_fraction=0.25,
+                 num_batches=None, per_image=False, hard_negative_fraction=0.0, seed=0):
+        if not 0.0 < positive_fraction < 1.0:
+            raise ValueError("positive_fraction must be between 0 and 1")
+        if not 0.0 <= hard_negative_fraction <= 1.0:
+            raise ValueError("hard_negative_fraction must be between 0 and 1")
+
+        labels = np.asarray(labels)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if image_indices is None:
+            image_indices = np.arange(len(offsets) - 1)
+        self.image_indices = np.asarray(image_indices, dtype=np.int64)
+        self.offsets = offsets
+        self.labels = labels
+
+        rows = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in self.image_indices] + [np.zeros(0, dtype=np.int64)])
+        self.positives = rows[labels[rows] == 1]
+        self.negatives = rows[labels[rows] == 0]
+        self.batch_size = batch_size
+        self.positive_fraction = positive_fraction
+        self.num_positive = int(round(batch_size * positive_fraction))
+        self.per_image = per_image
+        self.hard_negative_fraction = hard_negative_fraction
+        self.seed = seed
+        self.epoch = 0
+
+        # Last pothole probability of every proposal, 1 (hard) until it is scored
+        self.scores = np.ones(len(labels), dtype=np.float32)
+
+        if per_image:
+            num_batches = int(sum((labels[offsets[i]:offsets[i + 1]] == 1).any() for i in self.image_indices))
+        else:
+            if len(self.positives) + len(self.negatives) < batch_size:
+                raise ValueError(f"Only {len(self.positives) + len(self.negatives)} labeled proposals for batches of {batch_size}")
+            if num_batches is None:
+                if self.num_positive > 0 and len(self.positives) > 0:
+                    num_batches = math.ceil(len(self.positives) / self.num_positive)
+                else:
+                    num_batches = math.ceil(len(self.negatives) / batch_size)
+        self.num_batches = max(1, num_batches)
+
+    def __len__(self):
+        return self.num_batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def update_scores(self, rows, scores):
+        """
+        Saves the pothole probabilities the classifier gave the proposal rows of a batch, used to pick the hard
+        negatives of the following batches.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        self.scores[rows] = np.asarray(scores, dtype=np.float32)
+
+    @staticmethod
+    def _draw(rows, count, state, rng):
+        """
+        Takes the next `count` rows of the shuffled order in state, reshuffling when it is exhausted. The rows
+        already taken in this call go to the end of the new order, so a draw only repeats rows when count is
+        larger than the number of rows.
+        """
+        drawn = []
+        while count > 0 and len(rows) > 0:
+            if state['position'] >= len(state['order']):
+                order = rows[rng.permutation(len(rows))]
+                if drawn:
+                    taken = np.isin(order, np.concatenate(drawn))
+                    order = np.concatenate((order[~taken], order[taken]))
+                state['order'] = order
+                state['position'] = 0
+            taken = state['order'][state['position']:state['position'] + count]
+            state['position'] += len(taken)
+            count -= len(taken)
+            drawn.append(taken)
+        return np.concatenate(drawn) if drawn else np.zeros(0, dtype=np.int64)
+
+    def _hardest(self, negatives, count):
+        """
+        The `count` negatives with the highest scores, ties are broken by the (shuffled) order of negatives.
+        """
+        if count <= 0:
+            return negatives[:0]
+        order = np.argsort(-self.scores[negatives], kind='stable')
+        return negatives[order[:count]]
+
+    def _image_batches(self, rng):
+        for i in self.image_indices[rng.permutation(len(self.image_indices))]:
+            rows = np.arange(self.offsets[i], self.offsets[i + 1])
+            positives = rows[self.labels[rows] == 1]
+            if len(positives) == 0:
+                continue
+            negatives = rows[self.labels[rows] == 0]
+            negatives = negatives[rng.permutation(len(negatives))]
+
+            num_negative = min(int(round(len(positives) * (1 - self.positive_fraction) / self.positive_fraction)), len(negatives))
+            hard = self._hardest(negatives, int(round(num_negative * self.hard_negative_fraction)))
+            rest = np.setdiff1d(negatives, hard, assume_unique=True)
+            rest = rest[rng.permutation(len(rest))][:num_negative - len(hard)]
+            yield np.sort(np.concatenate((positives, hard, rest)))
+
+    def _mixed_batches(self, rng):
+        # The hard negatives of the epoch are the highest scored negatives at its start, every one is drawn once
+        num_hard = int(round((self.batch_size - self.num_positive) * self.hard_negative_fraction))
+        shuffled = self.negatives[rng.permutation(len(self.negatives))]
+        hard_pool = self._hardest(shuffled, min(num_hard * self.num_batches, len(shuffled)))
+        random_pool = np.setdiff1d(self.negatives, hard_pool, assume_unique=True)
+
+        positive_state = {'order': self.positives[rng.permutation(len(self.positives))], 'position': 0}
+        hard_state = {'order': hard_pool, 'position': 0}
+        negative_state = {'order': random_pool[rng.permutation(len(random_pool))], 'position': 0}
+        for _ in range(self.num_batches):
+            # Stop at the last positive of the epoch instead of wrapping around, the negatives fill the batch
+            num_positive = min(self.num_positive, len(positive_state['order']) - positive_state['position'])
+            positives = self._draw(self.positives, num_positive, positive_state, rng)
+            hard = self._draw(hard_pool, min(num_hard, self.batch_size - len(positives)), hard_state, rng)
+            num_fill = self.batch_size - len(positives) - len(hard)
+            if len(random_pool) > 0:
+                negatives = self._draw(random_pool, num_fill, negative_state, rng)
+            else:
+                # The hard pool holds every negative, fill up with the negatives not already in the batch
+                rest = np.setdiff1d(self.negatives, hard)
+                negatives = rest[rng.permutation(len(rest))[:num_fill]]
+            negatives = np.concatenate((hard, negatives))
+            if len(positives) + len(negatives) < self.batch_size:
+                # Not enough negatives in the (subset of the) store, top up with repeated positives
+                positives = np.concatenate((positives, self._draw(
+                    self.positives, self.batch_size - len(positives) - len(negatives), positive_state, rng)))
+
+            # Sorted rows read the crop shards front to back
+            yield np.sort(np.concatenate((positives, negatives)))
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+
+        if self.per_image:
+            return self._image_batches(rng)
+        return self._mixed_batches(rng)
+
+
+class ProposalBatchset(Dataset):
+    """
+    Returns the mini-batch of a `ProposalBatchSampler` in one call: `batch[rows]` gives the same
+    (images, targets, indices) as `collate_fn` over the images of a `Trainingset` or `CachedFeatureset`, but for
+    arbitrary global proposal rows. 'image_ids' has the image of every row, 'rows' the global proposal rows (for
+    `ProposalBatchSampler.update_scores`) and indices the image indices.
+
+    Parameters:
+    -----------
+    dataset : Trainingset or CachedFeatureset
+        Gives the proposal store and the crops (uint8, see `prepare_crops`) or the cached backbone features.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.store = dataset.store
+
+    def __len__(self):
+        return len(self.store.labels)
+
+    def __getitem__(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        if hasattr(self.dataset, 'crop_store'):
+            images = torch.from_numpy(self.dataset.crop_store.crops_at(rows))
+        else:
+            images = torch.from_numpy(np.asarray(self.dataset.cache.features[rows]))
+
+        image_indices = self.store.image_index(rows)
+        targets = {
+            'boxes': torch.from_numpy(self.store.boxes[rows].astype(np.float32)),
+            'labels': torch.from_numpy(self.store.labels[rows].astype(np.int64)),
+            'gt_boxes': torch.from_numpy(self.store.matched_gt_boxes_at(rows)),
+            'image_ids': [self.store.image_ids[i] for i in image_indices],
+            'rows': torch.from_numpy(rows),
+        }
+
+        return images, targets, image_indices.tolist()
@@ -0,0 +1,175 @@
+import os
+import json
+import numpy as np
+
+from typing import Dict, List, Optional
+
+# Every column of the store with its dtype and the number of values per row
+# - proposal columns have one row per proposal, the rows of image i are offsets[i]:offsets[i + 1]
+# - ground truth columns have one row per ground truth box, the rows of image i are gt_offsets[i]:gt_offsets[i + 1]
+PROPOSAL_COLUMNS = {
+    'boxes': (np.int16, 4),       # (xmin, ymin, xmax, ymax) of the proposal in the original image
+    'labels': (np.int8, 1),       # 1 pothole, 0 background, -1 not labeled
+    'gt_index': (np.int16, 1),    # index of the matched ground truth box within the image, -1 if none
+    'ious': (np.float32, 1),      # best IoU of the proposal with any ground truth box of the image
+}
+GT_COLUMNS = {
+    'gt_boxes': (np.float32, 4),
+    'gt_labels': (np.int8, 1),
+}
+
+_MAGIC = b'PROPSTR1'
+_ALIGNMENT = 64
+
+
+def _column_shape(rows, width):
+    return (rows, width) if width > 1 else (rows,)
+
+
+def write_proposal_store(path: str, records: List[Dict], meta: Optional[Dict] = None) -> None:
+    """
+    Writes the proposals of a whole split into one memory-mappable file.
+
+    The file starts with a magic string and a JSON header describing where every column starts, followed by
+    the raw column data (aligned to 64 bytes). The file is written to a temporary path and renamed into place.
+
+    Parameters:
+    -----------
+    path : str
+        Where to save the store, e.g. '$BLACKHOLE/DLCV/train_proposals.store'.
+
+    records : list of dict
+        One record per image with the keys 'image_id', 'boxes' (n x 4), 'labels' (n), 'gt_index' (n),
+        'ious' (n), 'gt_boxes' (g x 4) and 'gt_labels' (g).
+
+    meta : dict, optional
+        Extra JSON serializable information saved in the header (e.g. the preprocessing parameters).
+    """
+    num_proposals = [len(r['boxes']) for r in records]
+    num_gt = [len(r['gt_boxes']) for r in records]
+
+    columns = {
+        'offsets': np.concatenate(([0], np.cumsum(num_proposals))).astype(np.int64),
+        'gt_offsets': np.concatenate(([0], np.cumsum(num_gt))).astype(np.int64),
+    }
+    for name, (dtype, width) in {**PROPOSAL_COLUMNS, **GT_COLUMNS}.items():
+        total = sum(num_gt) if name in GT_COLUMNS else sum(num_proposals)
+        parts = [np.asarray(r[name]).reshape(_column_shape(-1, width)) for r in records]
+        if parts:
+            columns[name] = np.concatenate(parts).astype(dtype).reshape(_column_shape(total, width))
+        else:
+            columns[name] = np.zeros(_column_shape(0, width), dtype=dtype)
+
+    # Lay out the columns after the header
+    header = {'image_ids': [r['image_id'] for r in records], 'meta': meta or {}, 'columns': {}}
+    position = 0
+    for name, array in columns.items():
+        header['columns'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        position += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(_MAGIC) + 8 + len(header_bytes)) // _ALIGNMENT) * _ALIGNMENT
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(np.int64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in columns.items():
+            f.seek(data_start + header['columns'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + position)
+    os.replace(tmp_path, path)
+
+
+class ProposalStore:
+    """
+    Read-only, memory-mapped view of a proposal store written by `write_proposal_store`.
+
+    Every column is a NumPy memmap, so opening a store does not read the proposals and DataLoader workers share
+    the pages through the OS page cache instead of unpickling Python objects.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f"{path} is not a proposal store")
+            header_length = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        data_start = -(-(len(_MAGIC) + 8 + header_length) // _ALIGNMENT) * _ALIGNMENT
+
+        self.image_ids = header['image_ids']
+        self.meta = header['meta']
+        self._index = {image_id: i for i, image_id in enumerate(self.image_ids)}
+
+        for name, column in header['columns'].items():
+            shape = tuple(column['shape'])
+            if shape[0] == 0:
+                array = np.zeros(shape, dtype=np.dtype(column['dtype']))
+            else:
+                array = np.memmap(path, dtype=np.dtype(column['dtype']), mode='r',
+                                  offset=data_start + column['offset'], shape=shape)
+            setattr(self, name, array)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def index_of(self, image_id: str) -> int:
+        return self._index[image_id]
+
+    def proposal_slice(self, idx: int) -> slice:
+        return slice(int(self.offsets[idx]), int(self.offsets[idx + 1]))
+
+    def gt_slice(self, idx: int) -> slice:
+        return slice(int(self.gt_offsets[idx]), int(self.gt_offsets[idx + 1]))
+
+    def num_proposals(self, idx: int) -> int:
+        return int(self.offsets[idx + 1] - self.offsets[idx])
+
+    def proposals(self, idx: int) -> Dict[str, np.ndarray]:
+        """
+        Returns the proposal columns of image `idx`. The arrays are views into the memmap, nothing is copied.
+        """
+        rows = self.proposal_slice(idx)
+        return {name: getattr(self, name)[rows] for name in PROPOSAL_COLUMNS}
+
+    def ground_truth(self, idx: int) -> Dict[str, np.ndarray]:
+        """
+        Returns the ground truth boxes and labels of image `idx`.
+        """
+        rows = self.gt_slice(idx)
+        return {'boxes': self.gt_boxes[rows], 'labels': self.gt_labels[rows]}
+
+    def matched_gt_boxes(self, idx: int) -> np.ndarray:
+        """
+        Returns an n x 4 float32 array with the matched ground truth box of every proposal of image `idx`.
+        Proposals without a match (gt_index == -1) get zeros.
+        """
+        gt_index = np.asarray(self.gt_index[self.proposal_slice(idx)], dtype=np.int64)
+        gt_boxes = self.gt_boxes[self.gt_slice(idx)]
+        matched = np.zeros((len(gt_index), 4), dtype=np.float32)
+        has_match = gt_index >= 0
+        if has_match.any():
+            matched[has_match] = gt_boxes[gt_index[has_match]]
+        return matched
+
+    def image_index(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the index of the image every global proposal row belongs to.
+        """
+        return np.searchsorted(self.offsets, rows, side='right') - 1
+
+    def matched_gt_boxes_at(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Like `matched_gt_boxes`, but for arbitrary global proposal rows (e.g. a mini-batch drawn from many images).
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        gt_index = np.asarray(self.gt_index[rows], dtype=np.int64)
+        matched = np.zeros((len(rows), 4), dtype=np.float32)
+        has_match = gt_index >= 0
+        if has_match.any():
+            gt_rows = self.gt_offsets[self.image_index(rows[has_match])] + gt_index[has_match]
+            matched[has_match] = self.gt_boxes[gt_rows]
+        return matched
@@ -3,14 +3,13 @@ import cv2
 import numpy as np
 
 from PIL import Image
-from tensordict import TensorDict
-from utils.metrics import IoU
+from utils.box_ops import box_iou
 from typing import Callable, Tuple, Dict, List, Optional, Any
 from torchvision import transforms
 
 def generate_proposals_for_test_and_val(
     original_image: 'PIL.Image.Image',
-    original_targets: List[Dict[str, torch.Tensor]],
+    original_targets: Dict[str, np.ndarray],
     transform: Callable[[Image.Image], torch.Tensor],
     original_image_name: str,
     iou_upper_limit: float,
@@ -30,9 +29,9 @@ def generate_proposals_for_test_and_val(
     original_image : PIL.Image.Image
         The original image from which the proposals will be generated.
     
-    original_targets : list of dict
-        A list of dictionaries, each representing a ground truth bounding box. Each dictionary contains bounding 
-        box keys ('xmin', 'ymin', 'xmax', 'ymax') representing the coordinates of the ground truth box.
+    original_targets : dict
+        The ground truth of the image as plain arrays (see `AnnotationIndex.ground_truth`): 'boxes', a g x 4 array
+        of (xmin, ymin, xmax, ymax), and 'labels'.
 
     transform : callable
         A transformation function that takes an image (PIL.Image) and returns a transformed tensor. This 
@@ -127,7 +126,7 @@ def generate_proposals_for_test_and_val(
 
 def generate_proposals_and_targets_for_training(
     original_image: 'PIL.Image.Image',
-    original_targets: List[Dict[str, torch.Tensor]],
+    original_targets: Dict[str, np.ndarray],
     transform: Callable[[np.ndarray], torch.Tensor],
     original_image_name: str,
     iou_upper_limit: float,
@@ -147,9 +146,9 @@ def generate_proposals_and_targets_for_training(
     original_image : PIL.Image.Image
         The original image from which the proposals will be generated. The image is expected to be in HxWxC format.
     
-    original_targets : list of dict
-        A list of dictionaries, each representing a ground truth bounding box. Each dictionary contains bounding 
-        box keys ('xmin', 'ymin', 'xmax', 'ymax') representing the coordinates of the ground truth box.
+    original_targets : dict
+        The ground truth of the image as plain arrays (see `AnnotationIndex.ground_truth`): 'boxes', a g x 4 array
+        of (xmin, ymin, xmax, ymax), and 'labels'.
 
     transform : callable
         A transformation function that takes an image (np.array) and returns a transformed tensor. This 
@@ -207,7 +206,7 @@ def generate_proposals_and_targets_for_training(
     # Limit the number of proposals
     coord_proposals = coord_proposals[:max_proposals]
 
-    # Convert rects to proposals in TensorDict format
+    # Convert rects to proposals in dictionary format
     proposal_images = []
     proposal_targets = []
     proposal_images_tensor = []
@@ -251,7 +250,7 @@ def generate_proposals_and_targets_for_training(
 def apply_transform_and_label_target(
     proposal_images: List[np.ndarray],
     proposal_targets: List[Dict[str, torch.Tensor]],
-    original_targets: List[Dict[str, torch.Tensor]],
+    original_targets: Dict[str, np.ndarray],
     transform: Callable[[np.ndarray], torch.Tensor],
     iou_upper_limit: float,
     iou_lower_limit: float
@@ -266,12 +265,12 @@ def apply_transform_and_label_target(
         A list of input proposal images, each represented as a 3D array (height, width, channels).
     
     proposal_targets : list of dict
-        A list of dictionaries (e.g., `TensorDict`) representing target attributes for each proposal image. Each dictionary
+        A list of dictionaries representing target attributes for each proposal image. Each dictionary
         must include bounding box keys ('image_xmin', 'image_ymin', 'image_xmax', 'image_ymax').
 
-    original_targets : list of dict
-        A list of dictionaries representing the ground truth bounding boxes. Each dictionary must include bounding box
-        keys ('xmin', 'ymin', 'xmax', 'ymax').
+    original_targets : dict
+        The ground truth of the image as plain arrays (see `AnnotationIndex.ground_truth`): 'boxes', a g x 4 array
+        of (xmin, ymin, xmax, ymax), and 'labels'.
 
     transform : callable
         A transformation function (e.g., a PyTorch transform) that takes an image (e.g., PIL Image) and outputs
@@ -296,45 +295,42 @@ def apply_transform_and_label_target(
     """
 
 
-    # Loop through each proposal
     images = []
     targets = []
-    for proposal_image, proposal_target in zip(proposal_images, proposal_targets):
-
-        # Track matches for each ground truth box
-        iou_values = []
-        for gt_box in original_targets:
-
-            # copy an instance for the proposal target so we don't overwrite it
-            proposal_target_copy = proposal_target.copy()
-
-            gt_bbox = {
-                'xmin': gt_box['xmin'].item(),
-                'ymin': gt_box['ymin'].item(),
-                'xmax': gt_box['xmax'].item(),
-                'ymax': gt_box['ymax'].item()
-            }
-            iou = IoU(gt_bbox['xmin'], gt_bbox['ymin'], gt_bbox['xmax'], gt_bbox['ymax'], proposal_target['image_xmin'],  proposal_target['image_ymin'],  proposal_target['image_xmax'],  proposal_target['image_ymax'])
-            iou_values.append(iou)
-
-        if iou_values:  # Ensure the list is not empty
-            iou_max = max(iou_values)
-            iou_max_index = iou_values.index(iou_max)  # Find the index of the maximum IoU
-
-            # Add to matches if IoU is above threshold
-            if iou_max > iou_upper_limit:
-                proposal_target_copy.setdefault('label', torch.tensor(1, dtype=torch.int64))
-
-                proposal_image_transformed, proposal_target_copy = apply_transformation_on_proposal_image_and_target(proposal_image, proposal_target_copy, transform, original_targets[iou_max_index])
-                images.append(proposal_image_transformed)
-                targets.append(proposal_target_copy)
-
-            elif iou_max < iou_lower_limit:
-                proposal_target_copy.setdefault('label', torch.tensor(0, dtype=torch.int64))
-                proposal_image_transformed, proposal_target_copy = apply_transformation_on_proposal_image_and_target(proposal_image, proposal_target_copy, transform, None)
-
-                images.append(proposal_image_transformed)
-                targets.append(proposal_target_copy)
+    gt_boxes = np.asarray(original_targets['boxes'], dtype=np.float64).reshape(-1, 4)
+    if len(proposal_targets) == 0 or len(gt_boxes) == 0:
+        return images, targets
+
+    # Compute the IoU between every proposal and every ground truth box with one matrix operation
+    proposal_boxes = np.array([
+        [float(t['image_xmin']), float(t['image_ymin']), float(t['image_xmax']), float(t['image_ymax'])]
+        for t in proposal_targets
+    ], dtype=np.float64)
+
+    iou_matrix = box_iou(proposal_boxes, gt_boxes)
+    iou_max_values = iou_matrix.max(axis=1)
+    iou_max_indices = iou_matrix.argmax(axis=1)
+
+    # Loop through each proposal
+    for proposal_image, proposal_target, iou_max, iou_max_index in zip(proposal_images, proposal_targets, iou_max_values, iou_max_indices):
+
+        # copy an instance for the proposal target so we don't overwrite it
+        proposal_target_copy = proposal_target.copy()
+
+        # Add to matches if IoU is above threshold
+        if iou_max > iou_upper_limit:
+            proposal_target_copy.setdefault('label', torch.tensor(1, dtype=torch.int64))
+
+            proposal_image_transformed, proposal_target_copy = apply_transformation_on_proposal_image_and_target(proposal_image, proposal_target_copy, transform, gt_boxes[int(iou_max_index)])
+            images.append(proposal_image_transformed)
+            targets.append(proposal_target_copy)
+
+        elif iou_max < iou_lower_limit:
+            proposal_target_copy.setdefault('label', torch.tensor(0, dtype=torch.int64))
+            proposal_image_transformed, proposal_target_copy = apply_transformation_on_proposal_image_and_target(proposal_image, proposal_target_copy, transform, None)
+
+            images.append(proposal_image_transformed)
+            targets.append(proposal_target_copy)
     
     return images, targets
 
@@ -344,7 +340,7 @@ def apply_transformation_on_proposal_image_and_target(
     proposal_image: np.ndarray,
     proposal_target: Dict[str, torch.Tensor],
     transform: Callable[[np.ndarray], torch.Tensor],
-    gt_bbox: Dict[str, torch.Tensor]
+    gt_bbox: Optional[np.ndarray]
 ) -> Tuple[torch.Tensor, Dict[str, torch.Tensor]]:
 
     """
@@ -361,7 +357,7 @@ def apply_transformation_on_proposal_image_and_target(
         The input proposal image, represented as a 3D array (height, width, channels).
     
     proposal_target : dict
-        A dictionary-like structure (e.g., a `TensorDict`) representing target attributes. Must include at least:
+        A dictionary representing target attributes. Must include at least:
         - 'label': The label indicating if the proposal has a valid target (1 for valid, otherwise ignored).
         - 'image_xmin', 'image_ymin', 'image_xmax', 'image_ymax': Bounding box coordinates.
     
@@ -369,9 +365,8 @@ def apply_transformation_on_proposal_image_and_target(
         A transformation function (e.g., a PyTorch transform) that takes an image (e.g., PIL Image) and outputs
         a transformed tensor.
 
-    gt_bbox : dict
-        A dictionary-like structure representing the ground truth bounding box with keys:
-        - 'xmin', 'ymin', 'xmax', 'ymax': Coordinates of the bounding box.
+    gt_bbox : numpy.ndarray or None
+        The matched ground truth bounding box (xmin, ymin, xmax, ymax), None for negative proposals.
 
     Returns:
     --------
@@ -396,10 +391,11 @@ def apply_transformation_on_proposal_image_and_target(
     y_scale = new_height / original_height
 
     if int(proposal_target['label']) == 1: 
-        proposal_target.setdefault('gt_bbox_xmin', torch.tensor(float(gt_bbox['xmin'])))
-        proposal_target.setdefault('gt_bbox_ymin', torch.tensor(float(gt_bbox['ymin'])))
-        proposal_target.setdefault('gt_bbox_xmax', torch.tensor(float(gt_bbox['xmax'])))
-        proposal_target.setdefault('gt_bbox_ymax', torch.tensor(float(gt_bbox['ymax'])))
+        xmin, ymin, xmax, ymax = (float(v) for v in gt_bbox)
+        proposal_target.setdefault('gt_bbox_xmin', torch.tensor(xmin))
+        proposal_target.setdefault('gt_bbox_ymin', torch.tensor(ymin))
+        proposal_target.setdefault('gt_bbox_xmax', torch.tensor(xmax))
+        proposal_target.setdefault('gt_bbox_ymax', torch.tensor(ymax))
 
     return proposal_image_tensor, proposal_target
                 
\ No newline at end of file
@@ -6,9 +6,14 @@ import random
 import os
 import torch
 from PIL import Image
+from torchvision.transforms import functional as TF
+from utils.load_data import as_pil_image
 import matplotlib as mpl
 import cv2
 from utils.metrics import non_max_suppression
+from utils.crop_store import prepare_crops
+from utils.box_coder import BoxCoder
+from utils.box_ops import as_box_tensor
 
 color_primary = '#990000'  # University red
 color_secondary = '#2F3EEA'  # University blue
@@ -94,7 +99,8 @@ def visualize_proposals(image, proposals, num_proposals=500, box_thickness=1, fi
 
     Args:
         image (Tensor, numpy array, or PIL Image): The image on which to draw proposals.
-        proposals (list): A list of TensorDict objects containing bounding box coordinates.
+        proposals (numpy array or Tensor): An N x 4 array of (xmin, ymin, xmax, ymax) boxes, e.g. the 'boxes' of
+            a proposal record or the rows of one image in `ProposalStore.boxes`.
         num_proposals (int): The number of proposals to visualize.
     """
     # Convert image to PIL Image if it's a tensor or numpy array
@@ -117,12 +123,7 @@ def visualize_proposals(image, proposals, num_proposals=500, box_thickness=1, fi
     ax = plt.gca()
     
     # Draw bounding boxes
-    for proposal in proposals[:num_proposals]:
-        xmin = proposal['xmin'].item()
-        ymin = proposal['ymin'].item()
-        xmax = proposal['xmax'].item()
-        ymax = proposal['ymax'].item()
-        
+    for xmin, ymin, xmax, ymax in as_box_tensor(proposals)[:num_proposals].tolist():
         rect = patches.Rectangle((xmin, ymin), abs(xmax - xmin), abs(ymax - ymin),
                                  linewidth=box_thickness, edgecolor=color_primary, facecolor='none')
         ax.add_patch(rect)
@@ -169,8 +170,10 @@ def visualize_proposal(image_proposal, target_proposal, box_thickness=1, figname
     plt.savefig(f"../figures/{figname}", bbox_inches='tight', dpi=300)
     plt.show()
 
-def visualize_predictions(model, dataloader, use_nms=True, iou_threshold=0.3, num_images=5, experiment_name='experiment'):
+def visualize_predictions(model, dataloader, use_nms=True, iou_threshold=0.3, num_images=5, experiment_name='experiment',
+                          roi_inference=False, apply_bbox_deltas=True):
     model.eval()
+    box_coder = BoxCoder()
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model = model.to(device)
 
@@ -179,29 +182,35 @@ def visualize_predictions(model, dataloader, use_nms=True, iou_threshold=0.3, nu
             if idx >= num_images:
                 break
             
-            original_image = original_images[0]  # Single image in batch
+            original_image = as_pil_image(original_images[0])  # Single image in batch
             proposals = coords[0]
             
-            # Prepare proposals for the model
-            proposal_images = torch.stack(proposal_images_list[0]).to(device)
-
-            # Get predictions
-            outputs_cls, outputs_bbox_transforms, cls_probs = model.predict(proposal_images)
+            # Get predictions, either from the proposal crops or from the shared feature map of the image
+            if roi_inference:
+                image = TF.to_tensor(original_image).unsqueeze(0).to(device)
+                outputs_cls, outputs_bbox_transforms, cls_probs = model.predict_rois(image, [proposals.to(device)])
+            else:
+                proposal_images = proposal_images_list[0].to(device)
+                outputs_cls, outputs_bbox_transforms, cls_probs = model.predict(proposal_images)
 
             print(f"Image ID: {image_ids[0]}")
             print(f"Number of Proposals: {len(proposals)}")
             #print(f"Predicted Class Probabilities: {cls_probs.tolist()}")
 
+            # Refine the proposals with the predicted bbox transforms
+            if apply_bbox_deltas:
+                proposals = box_coder.decode(proposals, outputs_bbox_transforms, image_size=original_image.size).cpu()
+
             # Prepare predictions
             predictions = []
-            for i, proposal in enumerate(proposals):
+            for i, (xmin, ymin, xmax, ymax) in enumerate(proposals.tolist()):
                 pred_prob = cls_probs[i, 1].item()  # Probability of being a pothole
                 if pred_prob >= 0.5:  # Filter low-confidence predictions
                     predictions.append({
-                        "pre_bbox_xmin": proposal['xmin'].item(),
-                        "pre_bbox_ymin": proposal['ymin'].item(),
-                        "pre_bbox_xmax": proposal['xmax'].item(),
-                        "pre_bbox_ymax": proposal['ymax'].item(),
+                        "pre_bbox_xmin": xmin,
+                        "pre_bbox_ymin": ymin,
+                        "pre_bbox_xmax": xmax,
+                        "pre_bbox_ymax": ymax,
                         "pre_class": pred_prob
                     })
 
@@ -249,118 +258,6 @@ def visualize_predictions(model, dataloader, use_nms=True, iou_threshold=0.3, nu
             plt.savefig(f"figures/png/{experiment_name}/predictions_image_{experiment_name}_{image_ids[0]}_nms_{nms}.png", bbox_inches='tight', dpi=300)
             plt.savefig(f"figures/svg/{experiment_name}/predictions_image_{experiment_name}_{image_ids[0]}_nms_{nms}.svg", bbox_inches='tight', dpi=300)
 
-def visualize_pred_training_data(model, train_loader, use_nms=True, iou_threshold=0.3, num_images=5, experiment_name='experiment'):
-    """
-    Visualize predictions and ground truth for training data.
-
-    Args:
-        model: The trained model.
-        train_loader: DataLoader for the training data.
-        use_nms: Whether to apply non-max suppression.
-        iou_threshold: IoU threshold for NMS.
-        num_images: Number of images to visualize.
-        experiment_name: Name of the experiment (used for saving figures).
-    """
-    model.eval()
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = model.to(device)
-
-    with torch.no_grad():
-        for idx, (images, targets, indices) in enumerate(train_loader):
-            if idx >= num_images:
-                break
-            
-            images = images.to(device)
-            outputs_cls, outputs_bbox_transforms, cls_probs = model.predict(images)
-
-            print(f"Image Index: {indices}")
-            print(f"Number of Proposals: {len(targets)}")
-
-            # Prepare ground truth and predictions
-            ground_truths = []
-            predictions = []
-            ground_truths = []
-
-            for target in targets:
-                # Only include positive proposals
-                if target["label"].item() == 1:
-                    gt_bbox = {
-                        "xmin": target["gt_bbox_xmin"].item(),
-                        "ymin": target["gt_bbox_ymin"].item(),
-                        "xmax": target["gt_bbox_xmax"].item(),
-                        "ymax": target["gt_bbox_ymax"].item(),
-                    }
-                    ground_truths.append(gt_bbox)
-
-            # Extract predictions
-            for i, target in enumerate(targets):
-                pred_prob = cls_probs[i, 1].item()  # Probability of being a pothole
-                if pred_prob >= 0.5:  # Filter low-confidence predictions
-                    pred_bbox = {
-                        "pre_bbox_xmin": target['image_xmin'].item(),
-                        "pre_bbox_ymin": target['image_ymin'].item(),
-                        "pre_bbox_xmax": target['image_xmax'].item(),
-                        "pre_bbox_ymax": target['image_ymax'].item(),
-                        "pre_class": pred_prob
-                    }
-                    predictions.append(pred_bbox)
-
-            print(f"Ground Truth Boxes: {len(ground_truths)}")
-            print(f"Predictions Before NMS: {len(predictions)}")
-
-            # Apply Non-Max Suppression if required
-            if use_nms:
-                predictions = non_max_suppression(predictions, iou_threshold=iou_threshold)
-                print(f"Predictions After NMS: {len(predictions)}")
-
-            # Visualize the original image, predictions, and ground truth
-            fig, ax = plt.subplots(1, figsize=(10, 8))
-            ax.imshow(images[0].permute(1, 2, 0).cpu().numpy())
-            ax.set_title(f"Training Data Visualization - Index: {indices[0]}")
-            ax.axis('off')
-
-            # Plot ground truth boxes
-            for gt in ground_truths:
-                rect = patches.Rectangle(
-                    (gt["xmin"], gt["ymin"]),
-                    gt["xmax"] - gt["xmin"],
-                    gt["ymax"] - gt["ymin"],
-                    linewidth=2,
-                    edgecolor='g',
-                    facecolor='none'
-                )
-                ax.add_patch(rect)
-
-            # Plot predicted boxes
-            for pred in predictions:
-                rect = patches.Rectangle(
-                    (pred["pre_bbox_xmin"], pred["pre_bbox_ymin"]),
-                    pred["pre_bbox_xmax"] - pred["pre_bbox_xmin"],
-                    pred["pre_bbox_ymax"] - pred["pre_bbox_ymin"],
-                    linewidth=2,
-                    edgecolor='r',
-                    facecolor='none'
-                )
-                ax.add_patch(rect)
-                ax.text(
-                    pred["pre_bbox_xmin"], pred["pre_bbox_ymin"] - 10,
-                    f"Conf: {pred['pre_class']:.2f}",
-                    color='white', fontsize=8,
-                    bbox=dict(facecolor='red', alpha=0.5)
-                )
-
-            plt.axis('off')
-            plt.tight_layout()
-            plt.show()
-
-            os.makedirs(f'figures/png/{experiment_name}', exist_ok=True)
-            os.makedirs(f'figures/svg/{experiment_name}', exist_ok=True)
-            # Save the visualization
-            nms = "true" if use_nms else "false"
-            plt.savefig(f"figures/png/{experiment_name}/training_visualization_{experiment_name}_{indices[0]}_nms_{nms}.png", bbox_inches='tight', dpi=300)
-            plt.savefig(f"figures/svg/{experiment_name}/training_visualization_{experiment_name}_{indices[0]}_nms_{nms}.svg", bbox_inches='tight', dpi=300)
-
-
 def visualize_pred_training_data(
     model, 
     train_loader, 
@@ -368,7 +265,8 @@ def visualize_pred_training_data(
     iou_threshold=0.3, 
     num_images=5, 
     experiment_name='experiment', 
-    image_dir='Potholes/annotated-images'
+    image_dir='Potholes/annotated-images',
+    apply_bbox_deltas=True
 ):
     """
     Visualize predictions and ground truth for training data with the original image.
@@ -381,8 +279,10 @@ def visualize_pred_training_data(
         num_images: Number of images to visualize.
         experiment_name: Name of the experiment (used for saving figures).
         image_dir: Directory containing the original images.
+        apply_bbox_deltas: Whether to refine the proposals with the predicted bbox transforms.
     """
     model.eval()
+    box_coder = BoxCoder()
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model = model.to(device)
 
@@ -392,7 +292,7 @@ def visualize_pred_training_data(
                 break
 
             # Retrieve the corresponding original image name
-            original_image_name = targets[0]['original_image_name']  # Assuming all targets share the same image
+            original_image_name = targets['image_ids'][0]  # Assuming all targets share the same image
             image_path = os.path.join(image_dir, f"{original_image_name}.jpg")
 
             if not os.path.exists(image_path):
@@ -404,33 +304,36 @@ def visualize_pred_training_data(
                 original_image = img.convert("RGB")
 
             # Prepare predictions
-            outputs_cls, outputs_bbox_transforms, cls_probs = model.predict(images.to(device))
+            outputs_cls, outputs_bbox_transforms, cls_probs = model.predict(prepare_crops(images, device=device))
             print(f"Image Index: {indices}")
-            print(f"Number of Proposals: {len(targets)}")
+            print(f"Number of Proposals: {len(targets['labels'])}")
 
             ground_truths = []
             predictions = []
 
-            # Collect ground truth bounding boxes
-            for target in targets:
-                if target["label"].item() == 1:  # Include only positive proposals
-                    gt_bbox = {
-                        "xmin": target["gt_bbox_xmin"].item(),
-                        "ymin": target["gt_bbox_ymin"].item(),
-                        "xmax": target["gt_bbox_xmax"].item(),
-                        "ymax": target["gt_bbox_ymax"].item(),
-                    }
-                    ground_truths.append(gt_bbox)
+            # Collect ground truth bounding boxes, only positive proposals have one
+            positive = targets['labels'] == 1
+            for xmin, ymin, xmax, ymax in targets['gt_boxes'][positive].tolist():
+                gt_bbox = {
+                    "xmin": xmin,
+                    "ymin": ymin,
+                    "xmax": xmax,
+                    "ymax": ymax,
+                }
+                ground_truths.append(gt_bbox)
 
             # Collect predictions
-            for i, target in enumerate(targets):
+            pred_boxes = targets['boxes']
+            if apply_bbox_deltas:
+                pred_boxes = box_coder.decode(pred_boxes, outputs_bbox_transforms, image_size=original_image.size).cpu()
+            for i, (xmin, ymin, xmax, ymax) in enumerate(pred_boxes.tolist()):
                 pred_prob = cls_probs[i, 1].item()  # Probability of being a pothole
                 if pred_prob >= 0.5:  # Filter low-confidence predictions
                     pred_bbox = {
-                        "pre_bbox_xmin": target['image_xmin'].item(),
-                        "pre_bbox_ymin": target['image_ymin'].item(),
-                        "pre_bbox_xmax": target['image_xmax'].item(),
-                        "pre_bbox_ymax": target['image_ymax'].item(),
+                        "pre_bbox_xmin": xmin,
+                        "pre_bbox_ymin": ymin,
+                        "pre_bbox_xmax": xmax,
+                        "pre_bbox_ymax": ymax,
                         "pre_class": pred_prob
                     }
                     predictions.append(pred_bbox)